@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+qosbench: times the engine on synthetic zxtm logs
+
+every benchmark runs in its own process so its peak RSS can be measured.
+results are written as JSON and can be checked against a baseline:
+
+    qosbench.py -o baseline.json
+    qosbench.py -b baseline.json --threshold 10
+"""
+
+import os, os.path
+import sys
+import time
+import json
+import shutil
+import resource
+import tempfile
+import optparse
+import platform
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from qostool import qostool
+from qostool import workset
+from qostool import sync
+from qostool import zxtm
+
+import zxtmgen
+
+BENCH_CONFIG = """
+[global]
+root = %(root)s
+services = www
+rollup = false
+
+[www.service]
+name = www
+apps = web,media,api
+zxtm_vservers = vs1
+munin_apps = web
+keep_params_re = ^lang$
+
+[zxtm]
+root = %(zxtm_root)s
+vservers = vs1
+"""
+
+class BenchContext:
+    def __init__(self, folder, options):
+        self.folder = folder
+        self.options = options
+        self.zxtm_root = os.path.join(folder, "zxtm")
+        self.log_file = os.path.join(self.zxtm_root, "vs1.www." + zxtm.get_actual_time_period() + ".log")
+        self.workset_file = os.path.join(folder, "parsed.ws")
+        self.config_file = os.path.join(folder, "qos.cfg")
+
+    def prepare(self):
+        os.makedirs(self.zxtm_root)
+        generator = zxtmgen.LogGenerator(seed=self.options.seed, url_count=self.options.urls)
+        generator.write(self.log_file, self.options.lines)
+        self.urls = generator.urls
+
+        config_file = open(self.config_file, "w")
+        config_file.write(BENCH_CONFIG % { 'root': os.path.join(self.folder, "root"), 'zxtm_root': self.zxtm_root })
+        config_file.close()
+
+        qostool.parse_cmd([self.log_file, self.workset_file])
+        self.aggregate_sources = []
+        for i in range(self.options.aggregate_files):
+            fname = os.path.join(self.folder, "agg%d.ws" % (i))
+            shutil.copy(self.workset_file, fname)
+            self.aggregate_sources.append(fname)
+
+    def scratch_file(self, name):
+        fname = os.path.join(self.folder, name)
+        if os.path.exists(fname):
+            os.unlink(fname)
+        return fname
+
+
+def bench_parse(ctx):
+    qostool.parse_cmd([ctx.log_file, ctx.scratch_file("bench_parse.ws")])
+    return ctx.options.lines
+
+def bench_sync(ctx):
+    root = os.path.join(ctx.folder, "root")
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+    sync.SyncEngine(ctx.config_file).sync()
+    return ctx.options.lines
+
+def bench_load(ctx):
+    workset.WorkSetManager().load(ctx.workset_file)
+
+def bench_save(ctx):
+    manager = workset.WorkSetManager()
+    wkset = manager.load(ctx.workset_file)
+    start = time.time()
+    manager.save(wkset, ctx.scratch_file("bench_save.ws"))
+    return None, time.time() - start
+
+def bench_aggregate(ctx):
+    qostool.create_aggregate_workset(qostool.DefaultEngine(), ctx.aggregate_sources)
+
+def bench_grep(ctx):
+    qostool.grep_cmd(["search"] + ctx.aggregate_sources)
+
+def bench_top(ctx):
+    qostool.top_cmd(list(ctx.aggregate_sources))
+
+def bench_cleanup_url(ctx):
+    urls = ctx.urls * 10
+    for url in urls:
+        workset.cleanup_url(url)
+    return len(urls)
+
+BENCHMARKS = [
+    ("parse", bench_parse),
+    ("sync", bench_sync),
+    ("load", bench_load),
+    ("save", bench_save),
+    ("aggregate", bench_aggregate),
+    ("grep", bench_grep),
+    ("top", bench_top),
+    ("cleanup_url", bench_cleanup_url),
+]
+
+def run_in_child(function, ctx, queue):
+    # some output goes through default arguments bound to the original
+    # sys.stdout, so redirect the file descriptor itself
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    try:
+        start = time.time()
+        result = function(ctx)
+        elapsed = time.time() - start
+        items = result
+        if isinstance(result, tuple):
+            items, elapsed = result
+        queue.put((elapsed, items, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    except Exception, error:
+        queue.put((None, repr(error), None))
+
+def run_benchmark(function, ctx, repeat):
+    best = None
+    for i in range(repeat):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_in_child, args=(function, ctx, queue))
+        process.start()
+        elapsed, items, max_rss = queue.get()
+        process.join()
+        if elapsed is None:
+            raise Exception("benchmark %s failed: %s" % (function.__name__, items))
+        if best is None or elapsed < best["seconds"]:
+            best = { "seconds": elapsed, "max_rss_kb": max_rss }
+            if items:
+                best["items_per_second"] = items / elapsed
+    return best
+
+def compare(results, baseline, threshold):
+    """ returns the list of (name, metric, baseline value, value) that got
+        worse by more than threshold %
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name, None)
+        if reference is None:
+            continue
+        for metric in ("seconds", "max_rss_kb"):
+            if reference.get(metric, 0) > 0 and result[metric] > reference[metric] * (1 + threshold / 100.0):
+                regressions.append((name, metric, reference[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [BENCHMARK ...]")
+    parser.add_option("-n", "--lines", type="int", default=200000, help="number of generated log lines")
+    parser.add_option("-u", "--urls", type="int", default=20000, help="number of distinct urls")
+    parser.add_option("-s", "--seed", type="int", default=1)
+    parser.add_option("-a", "--aggregate-files", type="int", default=4, help="number of worksets for aggregate/grep/top")
+    parser.add_option("-r", "--repeat", type="int", default=3, help="runs per benchmark, the best one is kept")
+    parser.add_option("-o", "--output", help="write the JSON results to this file")
+    parser.add_option("-b", "--baseline", help="compare with this JSON results file")
+    parser.add_option("-t", "--threshold", type="float", default=10.0, help="allowed regression in %")
+    options, names = parser.parse_args()
+
+    benchmarks = [ (name, function) for name, function in BENCHMARKS if len(names) == 0 or name in names ]
+
+    folder = tempfile.mkdtemp(prefix="qosbench")
+    try:
+        ctx = BenchContext(folder, options)
+        ctx.prepare()
+        results = {}
+        for name, function in benchmarks:
+            results[name] = run_benchmark(function, ctx, options.repeat)
+            print >> sys.stderr, "%-12s %8.3fs %10d KB" % (name, results[name]["seconds"], results[name]["max_rss_kb"])
+    finally:
+        shutil.rmtree(folder)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "lines": options.lines,
+            "urls": options.urls,
+            "seed": options.seed,
+            "aggregate_files": options.aggregate_files,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        outfile = open(options.output, "w")
+        outfile.write(output)
+        outfile.close()
+    else:
+        print output
+
+    if options.baseline:
+        infile = open(options.baseline)
+        baseline = json.load(infile)
+        infile.close()
+        regressions = compare(results, baseline, options.threshold)
+        for name, metric, reference, value in regressions:
+            print >> sys.stderr, "REGRESSION %s %s: %.3f -> %.3f" % (name, metric, reference, value)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+zxtmgen: deterministic synthetic zxtm log generator, for benchmarks
+
+usage: zxtmgen.py [options] DESTINATION
+"""
+
+import sys
+import math
+import time
+import random
+import optparse
+
+DEFAULT_STATUS_MIX = "200:90,304:4,302:2,404:2,500:1,503:1"
+
+CONTENT_TYPES = ["text/html", "image/gif", "text/css", "application/x-javascript"]
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows; U; Windows NT 6.0; fr; rv:1.8.0.12) Gecko/20070508 Firefox/1.5.0.12",
+    "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 2.0.50727)",
+]
+
+class LogGenerator:
+    """ generates zxtm log lines:
+        - urls: url_count distinct paths under the given apps, picked with a
+          skewed (zipf like) popularity, some with query strings
+        - durations: log-normal around median_time, error_pc % are '-'
+        - status codes: weighted mix, ie. "200:90,404:5,500:5"
+    """
+
+    def __init__(self, seed=1, url_count=10000, apps=("web", "media", "api"), hosts=("www.example.com",),
+                 node_count=4, median_time=0.1, time_sigma=1.0, error_pc=0.5, status_mix=DEFAULT_STATUS_MIX,
+                 skew=3.0, start_time=1195653600):
+        self.random = random.Random(seed)
+        self.url_count = url_count
+        self.apps = list(apps)
+        self.hosts = list(hosts)
+        self.nodes = [ "10.1.42.%d:8080" % (i + 1) for i in range(node_count) ]
+        self.mu = math.log(median_time)
+        self.time_sigma = time_sigma
+        self.error_pc = error_pc
+        self.skew = skew
+        self.start_time = start_time
+        self.statuses = []
+        self.status_weights = []
+        total = 0
+        for item in status_mix.split(','):
+            code, weight = item.split(':')
+            total += float(weight)
+            self.statuses.append(code)
+            self.status_weights.append(total)
+        self.status_total = total
+        self.urls = [ self.make_url(i) for i in range(url_count) ]
+
+    def make_url(self, i):
+        app = self.apps[i % len(self.apps)]
+        kind = i % 5
+        if kind == 0:
+            return "/%s/page%d.jsp?id=%d&lang=fr" % (app, i, i * 7)
+        elif kind == 1:
+            return "/%s/servlet%d;jsessionid=a%dZ?U=%d" % (app, i, i, i * 13)
+        elif kind == 2:
+            return "/%s/img/%d.gif" % (app, i)
+        elif kind == 3:
+            return "/%s/search?q=%d&page=%d&onlyOnline=true" % (app, i, i % 10)
+        return "/%s/static/%d.css" % (app, i)
+
+    def pick_status(self):
+        value = self.random.random() * self.status_total
+        for code, weight in zip(self.statuses, self.status_weights):
+            if value < weight:
+                return code
+        return self.statuses[-1]
+
+    def line(self, index):
+        r = self.random
+        url = self.urls[int(self.url_count * r.random() ** self.skew)]
+        if r.random() * 100 < self.error_pc:
+            duration = "-"
+        else:
+            duration = "%.6f" % r.lognormvariate(self.mu, self.time_sigma)
+        timestamp = time.strftime("[%d/%b/%Y:%H:%M:%S +0000]", time.gmtime(self.start_time + index / 100))
+        node = self.nodes[index % len(self.nodes)]
+        return "|".join([
+            timestamp, duration, r.choice(self.hosts), "77.200.%d.%d" % (index % 250, index % 200), "GET",
+            url, r.choice(CONTENT_TYPES), self.pick_status(), "-", str(r.randint(200, 20000)),
+            "JSESSIONID=a%d" % (index % 997), "http://www.example.com/", r.choice(USER_AGENTS), "0", node, node,
+        ])
+
+    def write(self, filename, line_count):
+        outfile = open(filename, "w")
+        for i in xrange(line_count):
+            outfile.write(self.line(i))
+            outfile.write("\n")
+        outfile.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] DESTINATION")
+    parser.add_option("-n", "--lines", type="int", default=100000, help="number of lines")
+    parser.add_option("-s", "--seed", type="int", default=1)
+    parser.add_option("-u", "--urls", type="int", default=10000, help="number of distinct urls")
+    parser.add_option("--apps", default="web,media,api", help="comma separated url prefixes")
+    parser.add_option("--hosts", default="www.example.com", help="comma separated hosts")
+    parser.add_option("--nodes", type="int", default=4, help="number of nodes")
+    parser.add_option("--median-time", type="float", default=0.1, help="median duration in seconds")
+    parser.add_option("--time-sigma", type="float", default=1.0, help="log-normal sigma of the durations")
+    parser.add_option("--error-pc", type="float", default=0.5, help="% of lines without duration")
+    parser.add_option("--status-mix", default=DEFAULT_STATUS_MIX, help="code:weight,...")
+    parser.add_option("--skew", type="float", default=3.0, help="url popularity skew (1: uniform)")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("missing destination file")
+
+    generator = LogGenerator(options.seed, options.urls, options.apps.split(','), options.hosts.split(','),
+                             options.nodes, options.median_time, options.time_sigma, options.error_pc,
+                             options.status_mix, options.skew)
+    generator.write(args[0], options.lines)
+
+
+if __name__ == '__main__':
+    main()
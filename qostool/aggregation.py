@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+aggregation: merges many workset files using every core
+"""
+
+import logging
+import multiprocessing
+
+import workset
+
+
+class UrlOnlyPage:
+    def __init__(self):
+        self.url = None
+
+class PageFilter:
+    """ url filter for WorkSetManager.load built from a grep/search matcher,
+        so pages that don't match are never materialized. matchers only look
+        at page.url. with a urlindex.UrlQuery, indexed files only check the
+        urls it selects.
+    """
+    def __init__(self, matcher, pattern, options, query=None):
+        self.matcher = matcher
+        self.pattern = pattern
+        self.options = options
+        self.query = query
+        self.page = UrlOnlyPage()
+
+    def __call__(self, url):
+        page = self.page
+        page.url = url
+        return self.matcher(self.pattern, page, self.options)
+
+
+def aggregate_files(task):
+    """ folds the given workset files one at a time (runs in the workers)
+    """
+    filenames, url_filter = task
+    workset_manager = workset.WorkSetManager()
+    wkset = workset_manager.new_workset()
+    for filename in filenames:
+        wkset.aggregate(workset_manager.load(filename, url_filter))
+    return wkset
+
+def merge_pair(pair):
+    left, right = pair
+    left.aggregate(right)
+    return left
+
+def split_chunks(items, count):
+    """ splits items in count contiguous chunks of nearly the same size
+    """
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + (len(items) - start) / (count - i)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+class AggregationEngine:
+    """ every worker folds a contiguous chunk of the sources into a partial
+        workset, the partials are then merged pairwise by the workers until two
+        are left, the last merge is done here. a worker only holds its partial
+        and the file being loaded, and pages are only copied when two sources
+        share them.
+    """
+
+    def __init__(self, workset_manager, jobs=None):
+        self.workset_manager = workset_manager
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        if not workset_manager.parallel:
+            jobs = 1
+        self.jobs = jobs
+
+    def aggregate(self, sources, url_filter=None):
+        unique_sources = []
+        seen = set()
+        for source in sources:
+            if source not in seen:
+                seen.add(source)
+                unique_sources.append(source)
+
+        jobs = min(self.jobs, len(unique_sources))
+        if jobs <= 1:
+            wkset = self.workset_manager.new_workset()
+            for filename in unique_sources:
+                wkset.aggregate(self.workset_manager.load(filename, url_filter))
+            return wkset
+
+        logging.debug("AggregationEngine: aggregating %d worksets with %d jobs", len(unique_sources), jobs)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            partials = pool.map(aggregate_files, [ (chunk, url_filter) for chunk in split_chunks(unique_sources, jobs) ])
+            while len(partials) > 2:
+                pairs = [ (partials[i], partials[i + 1]) for i in range(0, len(partials) - 1, 2) ]
+                odd = partials[-1:] * (len(partials) % 2)
+                partials = pool.map(merge_pair, pairs) + odd
+        finally:
+            pool.close()
+            pool.join()
+
+        wkset = partials[0]
+        for partial in partials[1:]:
+            wkset.aggregate(partial)
+        return wkset
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+compare: ranks the page changes between two worksets by their impact on the
+global qos
+
+the pages of both worksets are joined on their url through columns of per
+page counters (PageColumns), so no Page object is built and only the lines
+shown are formatted. the impact of a page is the change of its share of the
+global hits above the target time, in points of %: the impacts of all the
+pages add up to the change of the global slow %.
+"""
+
+import sys
+import heapq
+import itertools
+
+import workset
+from sheet import Sheet
+
+DEFAULT_TARGET_TIME = 0.5 # in seconds
+DEFAULT_LIMIT = 20 # lines of the sheet
+
+COLUMNS = ("URL", "Hits", "dHits", "%Slow", "d%Slow", "Mean", "dMean", "%5xx", "d%5xx", "Impact")
+IMPACT_COLUMN = len(COLUMNS) - 1
+
+def add_columns(columns):
+    """ element-wise sum of equal length columns
+    """
+    if len(columns) == 1:
+        return list(columns[0])
+    # one tuple per row is about twice as quick as adding the columns two by two
+    return map(sum, itertools.izip(*columns))
+
+def get_ratio(count, total):
+    if total == 0:
+        return 0.0
+    return float(count) / total * 100
+
+def get_mean(total_time, timed_hits):
+    if timed_hits <= 0:
+        return None
+    return total_time / timed_hits
+
+
+class PageColumns:
+    """ the counters of the pages of a workset compare needs, one row per
+        page: hits, errors, total times, timed hits (shape hits), hits above
+        the target time and 5xx hits. ids gives the row of an url.
+    """
+    def __init__(self, wkset, target_time):
+        if isinstance(wkset, workset.ArrayWorkSet):
+            self.fill_arrays(wkset, target_time)
+        else:
+            self.fill_pages(wkset, target_time)
+
+    def fill_arrays(self, wkset, target_time):
+        columns = wkset.page_columns
+        self.ids = wkset.url_ids
+        self.hits = columns.hits
+        self.errors = columns.errors
+        self.total_times = columns.total_times
+        self.timed_hits = columns.shape_hits
+        count = columns.count
+        width = columns.width
+        # the shape buckets of every page are interleaved: bucket i of the
+        # pages is shape[i::width]
+        self.slow_hits = [0] * count
+        start = columns.template.index(target_time)
+        if count > 0 and start < width:
+            self.slow_hits = add_columns([ columns.shape[i::width] for i in range(start, width) ])
+        self.http_5xx = [0] * count
+        codes = [ column for code, column in columns.codes.iteritems() if 500 <= code < 600 ]
+        if count > 0 and len(codes) > 0:
+            self.http_5xx = add_columns(codes)
+
+    def fill_pages(self, wkset, target_time):
+        pages = wkset.pages.values()
+        self.ids = dict(itertools.izip([ page.url for page in pages ], itertools.count()))
+        self.hits = [ page.hits for page in pages ]
+        self.errors = [ page.errors for page in pages ]
+        self.total_times = [ page.total_time for page in pages ]
+        self.timed_hits = [ page.shape.total_hits for page in pages ]
+        self.slow_hits = [ page.shape.get_hits_above(target_time) for page in pages ]
+        self.http_5xx = [ sum([ count for code, count in page.http_codes.iteritems() if 500 <= code < 600 ])
+                          for page in pages ]
+
+
+class Comparison:
+    """ the pages of the old and new worksets joined on their url. rows
+        missing on one side count as empty pages there.
+    """
+    def __init__(self, old_workset, new_workset, target_time=DEFAULT_TARGET_TIME):
+        self.old_workset = old_workset
+        self.new_workset = new_workset
+        self.target_time = target_time
+        self.old = PageColumns(old_workset, target_time)
+        self.new = PageColumns(new_workset, target_time)
+
+        # hash join: the rows of each url on both sides, -1 when missing
+        old_ids = self.old.ids
+        self.urls = self.new.ids.keys()
+        self.new_rows = [ self.new.ids[url] for url in self.urls ]
+        self.old_rows = [ old_ids.get(url, -1) for url in self.urls ]
+        new_ids = self.new.ids
+        removed = [ url for url in old_ids.iterkeys() if url not in new_ids ]
+        self.urls.extend(removed)
+        self.new_rows.extend([-1] * len(removed))
+        self.old_rows.extend([ old_ids[url] for url in removed ])
+
+        old_scale = get_ratio(1, old_workset.shape.total_hits)
+        new_scale = get_ratio(1, new_workset.shape.total_hits)
+        old_slow = self.get_column(self.old.slow_hits, self.old_rows)
+        new_slow = self.get_column(self.new.slow_hits, self.new_rows)
+        self.impacts = [ new * new_scale - old * old_scale for old, new in itertools.izip(old_slow, new_slow) ]
+
+    def get_column(self, column, rows):
+        """ column read along the joined rows, 0 for missing rows
+        """
+        return [ row >= 0 and column[row] or 0 for row in rows ]
+
+    def get_side_fields(self, columns, row):
+        """ (hits, slow %, mean time, 5xx %) of a row, of an empty page for -1
+        """
+        if row < 0:
+            return 0, 0.0, None, 0.0
+        hits = columns.hits[row]
+        return (hits, get_ratio(columns.slow_hits[row], columns.timed_hits[row]),
+                get_mean(columns.total_times[row], hits - columns.errors[row]), get_ratio(columns.http_5xx[row], hits))
+
+    def get_fields(self, i):
+        """ the COLUMNS of the joined row i, the mean times are None when
+            unknown
+        """
+        old_hits, old_slow, old_mean, old_5xx = self.get_side_fields(self.old, self.old_rows[i])
+        new_hits, new_slow, new_mean, new_5xx = self.get_side_fields(self.new, self.new_rows[i])
+        mean_diff = None
+        if old_mean is not None and new_mean is not None:
+            mean_diff = new_mean - old_mean
+        return (self.urls[i], new_hits, new_hits - old_hits, new_slow, new_slow - old_slow,
+                new_mean, mean_diff, new_5xx, new_5xx - old_5xx, self.impacts[i])
+
+    def get_total_fields(self):
+        fields = []
+        for wkset, columns in ((self.old_workset, self.old), (self.new_workset, self.new)):
+            http_5xx = sum([ count for code, count in wkset.http_codes.iteritems() if 500 <= code < 600 ])
+            fields.append((wkset.total_hits, get_ratio(wkset.shape.get_hits_above(self.target_time), wkset.shape.total_hits),
+                           get_mean(sum(columns.total_times), sum(columns.hits) - sum(columns.errors)),
+                           get_ratio(http_5xx, wkset.total_hits)))
+        (old_hits, old_slow, old_mean, old_5xx), (new_hits, new_slow, new_mean, new_5xx) = fields
+        mean_diff = None
+        if old_mean is not None and new_mean is not None:
+            mean_diff = new_mean - old_mean
+        return ("Total", new_hits, new_hits - old_hits, new_slow, new_slow - old_slow,
+                new_mean, mean_diff, new_5xx, new_5xx - old_5xx, new_slow - old_slow)
+
+    def get_ranking(self, limit=None):
+        """ the joined rows by decreasing impact, the limit first ones
+        """
+        impacts = self.impacts
+        if limit is None:
+            return sorted(xrange(len(impacts)), key=impacts.__getitem__, reverse=True)
+        return heapq.nlargest(limit, xrange(len(impacts)), key=impacts.__getitem__)
+
+    def show(self, limit=DEFAULT_LIMIT, out=sys.stdout):
+        """ prints the limit biggest regressions, the biggest last
+        """
+        result_sheet = Sheet()
+        result_sheet.header(*COLUMNS)
+        result_sheet.top(IMPACT_COLUMN, limit)
+        for i in self.get_ranking(limit):
+            result_sheet.line(*[ field is None and '-' or field for field in self.get_fields(i) ])
+        result_sheet.end_line(*[ field is None and '-' or field for field in self.get_total_fields() ])
+        result_sheet.show(out=out)
+
+    def write_tsv(self, limit=None, out=sys.stdout):
+        """ writes the rows by decreasing impact as tab separated values,
+            after a line of column names. unknown values are empty.
+        """
+        print >> out, '\t'.join(COLUMNS)
+        for fields in itertools.chain([ self.get_total_fields() ], itertools.imap(self.get_fields, self.get_ranking(limit))):
+            print >> out, '\t'.join([ format_tsv(field) for field in fields ])
+
+def format_tsv(value):
+    if value is None:
+        return ''
+    if type(value) == float:
+        return "%.6g" % (value)
+    return str(value)
@@ -9,15 +9,27 @@ import re
 import logging
 
 import util
+import workset
 
 
 
+DEFAULT_CONFIG_FILE = "/etc/qos/qos.cfg"
 DEFAULT_ROOT = "/tmp"
 DEFAULT_ZXTM_ROOT = "/var/log/zxtm"
 
 DEFAULT_TARGET_TIME = 0.5
 DEFAULT_TARGET_PC = 90
 
+DEFAULT_FOLLOW_FLUSH_INTERVAL = 300 # in seconds
+DEFAULT_FOLLOW_POLL_INTERVAL = 5 # in seconds
+
+DEFAULT_ROLLUP = True
+DEFAULT_HOURLY_RETENTION_DAYS = 0 # 0: keep hourly worksets forever
+DEFAULT_URL_INDEX = True
+DEFAULT_SERIES = True
+DEFAULT_SYNC_JOBS = 1 # processes reading the logfiles
+DEFAULT_CHECKPOINT_MB = 64 # sync saves its work every 64 MB of logs read, 0: only at the end
+
 class ConfigurationException(Exception):
     """ Configuration error
     """
@@ -37,6 +49,7 @@ class QosServiceConfig:
         self.ignore_re = None
         self.keep_params_re = None
         self.munin_apps = []
+        self.shape_spec = None # default QosShape
     
     def parse_file(self, file_name, parser=None):
         logging.debug("QosServiceConfig: Reading configuration file [%s]", file_name)
@@ -76,10 +89,35 @@ class QosServiceConfig:
             raise ConfigurationException("QosServiceConfig: %s.zxtm_host_re [%s] is invalid" % (section, regex))
         
         self.apps_re = re.compile("^/("+'|'.join(self.apps)+")")
+
+        self.shape_spec = self.parse_shape_spec(parser, section)
+
+    def parse_shape_spec(self, parser, section):
+        """ shape = linear (shape_resolution, shape_max_time) or
+            hdr (shape_min_time, shape_max_time, shape_precision)
+        """
+        kind = parser.get_def(section, "shape", None)
+        if kind is None:
+            return None
+        kind = str(kind)
+        if kind == workset.QOS_SHAPE_LINEAR:
+            spec = (kind, parser.getfloat_def(section, "shape_resolution", workset.QOS_SHAPE_RESOLUTION),
+                    parser.getfloat_def(section, "shape_max_time", workset.QOS_SHAPE_MAX_TIME))
+            valid = 0 < spec[1] < spec[2]
+        elif kind == workset.QOS_SHAPE_HDR:
+            spec = (kind, parser.getfloat_def(section, "shape_min_time", workset.QOS_SHAPE_HDR_MIN_TIME),
+                    parser.getfloat_def(section, "shape_max_time", workset.QOS_SHAPE_HDR_MAX_TIME),
+                    parser.getfloat_def(section, "shape_precision", workset.QOS_SHAPE_HDR_PRECISION))
+            valid = 0 < spec[1] < spec[2] and 0 < spec[3] < 1
+        else:
+            raise ConfigurationException("QosServiceConfig: %s.shape [%s] is invalid" % (section, kind))
+        if not valid:
+            raise ConfigurationException("QosServiceConfig: %s shape parameters %s are invalid" % (section, spec[1:]))
+        return spec
         
     def __repr__(self):
         result = ["QosServiceConfig"]
-        attributes = [ 'svc_id', 'name', 'apps', 'ignore_re', 'keep_params_re', 'target_time', 'target_pc', 'zxtm_vservers', 'zxtm_host_re' ]
+        attributes = [ 'svc_id', 'name', 'apps', 'ignore_re', 'keep_params_re', 'target_time', 'target_pc', 'zxtm_vservers', 'zxtm_host_re', 'shape_spec' ]
         for attr in attributes:
             result.append('\n  ')
             result.append(attr)
@@ -96,6 +134,16 @@ class QosEngineConfig:
         self.services = {}
         self.zxtm_root = DEFAULT_ZXTM_ROOT
         self.zxtm_vservers = []
+        self.follow_flush_interval = DEFAULT_FOLLOW_FLUSH_INTERVAL
+        self.follow_poll_interval = DEFAULT_FOLLOW_POLL_INTERVAL
+        self.rollup = DEFAULT_ROLLUP
+        self.hourly_retention_days = DEFAULT_HOURLY_RETENTION_DAYS
+        self.url_index = DEFAULT_URL_INDEX
+        self.series = DEFAULT_SERIES
+        self.checkpoint_mb = DEFAULT_CHECKPOINT_MB
+        self.sync_jobs = DEFAULT_SYNC_JOBS
+        # bumped on every parse, lets users of the config notice changes
+        self.generation = 0
     
     def parse_file(self, file_name, parser=None):
         logging.debug("QosEngineConfig: Reading configuration file [%s]", file_name)
@@ -109,6 +157,15 @@ class QosEngineConfig:
         if not os.path.isdir(self.root):
             os.makedirs(self.root)
 
+        self.follow_flush_interval = parser.getfloat_def(section, "follow_flush_interval", DEFAULT_FOLLOW_FLUSH_INTERVAL)
+        self.follow_poll_interval = parser.getfloat_def(section, "follow_poll_interval", DEFAULT_FOLLOW_POLL_INTERVAL)
+        self.rollup = parser.getboolean_def(section, "rollup", DEFAULT_ROLLUP)
+        self.hourly_retention_days = parser.getint_def(section, "hourly_retention_days", DEFAULT_HOURLY_RETENTION_DAYS)
+        self.url_index = parser.getboolean_def(section, "url_index", DEFAULT_URL_INDEX)
+        self.series = parser.getboolean_def(section, "series", DEFAULT_SERIES)
+        self.checkpoint_mb = parser.getint_def(section, "checkpoint_mb", DEFAULT_CHECKPOINT_MB)
+        self.sync_jobs = parser.getint_def(section, "sync_jobs", DEFAULT_SYNC_JOBS)
+
         for svcid in parser.get_list(section, "services").get_values():
             svc = QosServiceConfig(svcid)
             svc.parse_file(file_name, parser)
@@ -117,10 +174,11 @@ class QosEngineConfig:
         section = "zxtm"
         self.zxtm_root = parser.get_def(section, "root", DEFAULT_ZXTM_ROOT)
         self.zxtm_vservers = parser.get_list(section, "vservers").get_values()
+        self.generation += 1
 
     def __repr__(self):
         result = ["QosEngineConfig"]
-        attributes = [ 'root', 'zxtm_root', 'zxtm_vservers' ]
+        attributes = [ 'root', 'zxtm_root', 'zxtm_vservers', 'follow_flush_interval', 'follow_poll_interval', 'rollup', 'hourly_retention_days', 'url_index', 'series', 'checkpoint_mb', 'sync_jobs' ]
         for attr in attributes:
             result.append('\n  ')
             result.append(attr)
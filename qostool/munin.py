@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+munin: fixed size summaries of the munin worksets, so that a munin poll
+never loads the pages of a workset
+
+a summary is written next to its workset, as FILE.sum (little-endian):
+    header      magic, version, shape kind, bucket count, target time,
+                total hits, total errors, 5xx hits, shape hits, hits above target,
+                shape spec parameters
+    buckets     uint64 per shape bucket
+"""
+
+import os
+import struct
+
+import util
+import workset
+
+SUMMARY_SUFFIX = ".sum"
+
+MAGIC = "QOSMUNIN"
+VERSION = 1
+
+HEADER = struct.Struct("<8sHHId5Q3d")
+
+SHAPE_KINDS = [workset.QOS_SHAPE_LINEAR, workset.QOS_SHAPE_HDR]
+
+
+class MuninSummary:
+    def __init__(self):
+        self.target_time = 0.0
+        self.total_hits = 0
+        self.total_errors = 0
+        self.http_5xx = 0
+        self.hits_above = 0
+        self.shape = workset.create_shape()
+
+    def get_qos(self, target_time):
+        """ % of the hits faster than target_time, as computed on the workset
+        """
+        if target_time == self.target_time:
+            return 100 - float(self.hits_above) / self.shape.total_hits * 100
+        return 100 - self.shape.get_hits_pc_above(target_time)
+
+
+def create_summary(wkset, target_time):
+    summary = MuninSummary()
+    summary.target_time = target_time
+    summary.total_hits = wkset.total_hits
+    summary.total_errors = wkset.total_errors
+    summary.http_5xx = sum([ count for code, count in wkset.http_codes.items() if 500 <= code < 600 ])
+    summary.shape = wkset.shape.copy()
+    summary.hits_above = summary.shape.get_hits_above(target_time)
+    return summary
+
+def write_summary(summary, filename):
+    spec = summary.shape.get_spec()
+    parameters = list(spec[1:]) + [0.0] * (4 - len(spec))
+    dist = summary.shape.dist
+    data = HEADER.pack(MAGIC, VERSION, SHAPE_KINDS.index(spec[0]), len(dist), summary.target_time,
+                       summary.total_hits, summary.total_errors, summary.http_5xx, summary.shape.total_hits,
+                       summary.hits_above, *parameters)
+    data += struct.pack("<%dQ" % (len(dist)), *dist)
+
+    util.makedirs_for_file(filename)
+    tmp_filename = filename + ".tmp"
+    outfile = open(tmp_filename, "wb")
+    try:
+        outfile.write(data)
+    finally:
+        outfile.close()
+    os.rename(tmp_filename, filename)
+
+def read_summary(filename):
+    """ raises IOError when there is no summary
+    """
+    infile = open(filename, "rb")
+    try:
+        data = infile.read()
+    finally:
+        infile.close()
+    if len(data) < HEADER.size:
+        raise ValueError("[%s] is not a munin summary" % (filename))
+    fields = HEADER.unpack_from(data)
+    magic, version, kind, bucket_count = fields[0:4]
+    if magic != MAGIC:
+        raise ValueError("[%s] is not a munin summary" % (filename))
+    if version > VERSION:
+        raise ValueError("[%s] uses unsupported munin summary version %d" % (filename, version))
+
+    summary = MuninSummary()
+    summary.target_time = fields[4]
+    summary.total_hits, summary.total_errors, summary.http_5xx, shape_hits, summary.hits_above = fields[5:10]
+    spec = (SHAPE_KINDS[kind],) + fields[10:]
+    if spec[0] == workset.QOS_SHAPE_LINEAR:
+        spec = spec[:3]
+    summary.shape = workset.create_shape(spec)
+    summary.shape.dist = list(struct.unpack_from("<%dQ" % (bucket_count), data, HEADER.size))
+    summary.shape.total_hits = shape_hits
+    return summary
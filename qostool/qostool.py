@@ -8,28 +8,46 @@ import sys
 import re
 import os
 import logging
+import json
+import itertools
+import multiprocessing
 
 import config
+import aggregation
+import compare
+import munin
+import series
+import stats
+import urlindex
 import util
 import workset
 import zxtm
 import sync
+import server
 from sheet import Sheet
 
+TOP_PERCENTILES = (50, 90, 99)
+
+# creates the WorkSetManager of the commands, the query server replaces it
+workset_manager_factory = workset.WorkSetManager
+
 class DefaultEngine:
 
     def __init__(self):
         self.config = config.QosEngineConfig()
-        self.workset_manager = workset.WorkSetManager()
+        self.workset_manager = workset_manager_factory()
     
     def configure(self):
-        self.config.parse_file("/etc/qos/qos.cfg")
+        self.config.parse_file(config.DEFAULT_CONFIG_FILE)
 
 def sync_cmd(args):
-    del args
     logging.debug("Running command sync")
     sync_engine = sync.SyncEngine()
-    sync_engine.sync()
+    sync_engine.config.sync_jobs = pop_jobs_option(args, sync_engine.config.sync_jobs)
+    if '--follow' in args:
+        sync_engine.follow()
+    else:
+        sync_engine.sync()
 
 def summary_cmd(args):
     if len(args) < 1:
@@ -37,7 +55,7 @@ def summary_cmd(args):
     
     engine = DefaultEngine()
     for filename in args:
-        wkset = engine.workset_manager.load(filename)
+        wkset = engine.workset_manager.load_lazy(filename)
         wkset.summary()
 
 def dump_cmd(args):
@@ -75,23 +93,39 @@ def re_match_matcher(regex, page, options):
     else:
         return result
 
-def display_slow_sorted(wkset, parent_workset, duration=0.5, sort_field_index=2, limit=None):
-    result_sheet = Sheet()
-    result_sheet.header("URL", "%Hits", "%Slow")
-    
-    for p in wkset.pages.values():
-        hits_pc = float(p.hits) / parent_workset.total_hits * 100
-        slow_pc = float(p.shape.get_hits_above(duration)) / parent_workset.shape.get_hits_above(duration) * 100
-        result_sheet.line(p.url, hits_pc, slow_pc)
+def percentile_columns(shape, percentiles):
+    values = shape.get_percentiles(percentiles)
+    return [ value is None and '-' or value for value in values ]
 
-    hits_pc = float(wkset.shape.total_hits) / parent_workset.total_hits * 100
-    slow_pc = float(wkset.shape.get_hits_above(duration)) / parent_workset.shape.get_hits_above(duration) * 100
-    result_sheet.end_line("Total", hits_pc, slow_pc)
+def get_ratio(count, total):
+    if total == 0:
+        return 0.0
+    return float(count) / total * 100
 
-    result_sheet.sort(sort_field_index)
-    
+def display_slow_sorted(wkset, parent_workset, duration=0.5, sort_field_index=2, limit=None, percentiles=()):
+    result_sheet = Sheet()
+    result_sheet.header("URL", "%Hits", "%Slow", *[ "p%g" % (pc) for pc in percentiles ])
     if limit is not None:
-        result_sheet.limit(limit)
+        result_sheet.top(sort_field_index, limit)
+
+    # percentages of the parent totals, a zero total gives 0%
+    hits_scale = get_ratio(1, parent_workset.total_hits)
+    slow_scale = get_ratio(1, parent_workset.shape.get_hits_above(duration))
+    accepts = result_sheet.accepts
+    for p, slow_hits in wkset.iter_hits_above(duration):
+        hits_pc = p.hits * hits_scale
+        slow_pc = slow_hits * slow_scale
+        fields = (p.url, hits_pc, slow_pc)
+        # the percentiles are only computed for the lines that are kept
+        if sort_field_index >= len(fields) or accepts(fields[sort_field_index]):
+            result_sheet.line(*(fields + tuple(percentile_columns(p.shape, percentiles))))
+
+    hits_pc = wkset.shape.total_hits * hits_scale
+    slow_pc = wkset.shape.get_hits_above(duration) * slow_scale
+    result_sheet.end_line("Total", hits_pc, slow_pc, *percentile_columns(wkset.shape, percentiles))
+
+    if limit is None:
+        result_sheet.sort(sort_field_index)
 
     result_sheet.show()
 
@@ -101,9 +135,33 @@ class MatcherOptions:
         self.invert_match = False
         self.is_regex = False
 
+def pop_jobs_option(args, default=None):
+    """ removes "-j N" from args and returns N
+    """
+    if '-j' not in args:
+        return default
+    index = args.index('-j')
+    try:
+        jobs = int(args[index + 1])
+    except (IndexError, ValueError):
+        usage()
+    del args[index:index + 2]
+    return jobs
+
+def get_url_query(matcher, pattern, options):
+    """ returns the urlindex.UrlQuery narrowing down the urls matcher may
+        accept, or None
+    """
+    if options.invert_match:
+        return None
+    if matcher is grep_matcher and not options.is_regex:
+        return urlindex.substring_query(pattern)
+    return urlindex.regex_query(pattern, matcher is re_match_matcher)
+
 def generic_search(matcher, args):
 
     options = MatcherOptions()
+    jobs = pop_jobs_option(args)
     
     if '-i' in args:
         options.case_insensitive = True
@@ -125,8 +183,10 @@ def generic_search(matcher, args):
         
     engine = DefaultEngine()
 
-    dest_ws = workset.WorkSet()
-    source_ws = create_aggregate_workset(engine, args)
+    dest_ws = engine.workset_manager.new_workset()
+    # only the matching pages are loaded, source_ws still has the totals of every file
+    url_filter = aggregation.PageFilter(matcher, pattern, options, get_url_query(matcher, pattern, options))
+    source_ws = create_aggregate_workset(engine, args, url_filter, jobs)
     
     dest_ws.filter_aggregate(source_ws, matcher, pattern, options)
 
@@ -151,15 +211,16 @@ def match_cmd(args):
     generic_search(re_match_matcher, args)
 
 def top_cmd(args):
+    jobs = pop_jobs_option(args)
     if len(args) < 1:
         usage()
 
     engine = DefaultEngine()
 
-    source_ws = create_aggregate_workset(engine, args)
+    source_ws = create_aggregate_workset(engine, args, jobs=jobs)
     
     print "\nTop slow pages:\n"
-    display_slow_sorted(source_ws, source_ws, limit=20)
+    display_slow_sorted(source_ws, source_ws, limit=20, percentiles=TOP_PERCENTILES)
 
 def status_top_cmd(args):
     if len(args) < 2:
@@ -179,6 +240,7 @@ def status_top_cmd(args):
     
     result_sheet = Sheet()
     result_sheet.header("URL", "Hits", "Ratio")
+    result_sheet.top(2, 20)
 
     total_code_hits = wkset.http_codes.get(http_code, None)
     if total_code_hits is None:
@@ -202,9 +264,6 @@ def status_top_cmd(args):
     result_sheet.end_line("Total", total_code_hits_check, total_pc_check)
     result_sheet.end_line("Check", total_code_hits, 100)
 
-    result_sheet.sort(2)
-    result_sheet.limit(20)
-
     print "\nHTTP status code %d breakdown:\n" % (http_code)
     result_sheet.show()
 
@@ -230,26 +289,128 @@ def munin_cmd(args):
             ws_filename = engine.config.root + '/munin/' + sync.generate_munin_workset_file_name(service.svc_id, app)
             logging.debug("munin: looking at svc:%s app:%s in file %s", service.svc_id, app, ws_filename)
             try:
-                wkset = engine.workset_manager.load(ws_filename)
-                print "%s_%s.value %.2f" % (service.svc_id, app, 100 - wkset.shape.get_hits_pc_above(service.target_time))
+                try:
+                    qos = munin.read_summary(ws_filename + munin.SUMMARY_SUFFIX).get_qos(service.target_time)
+                except (IOError, ValueError), error:
+                    # saved before the summaries were written, or a summary
+                    # of another version
+                    logging.debug("munin: no usable summary for svc:%s app:%s (%s), loading the workset", service.svc_id, app, error)
+                    wkset = engine.workset_manager.load_lazy(ws_filename)
+                    qos = 100 - wkset.shape.get_hits_pc_above(service.target_time)
+                print "%s_%s.value %.2f" % (service.svc_id, app, qos)
                 rf = open(ws_filename + ".read", "w")
                 print >> rf, "OK"
                 rf.close()
             except:
-                pass
+                logging.exception("munin: no value for svc:%s app:%s", service.svc_id, app)
 
 def qos_cmd(args):
+    show_percentiles = False
+    if '-p' in args:
+        show_percentiles = True
+        args.remove('-p')
+
     if len(args) < 1:
         usage()
     
     time = float(args[0])
     engine = DefaultEngine()
     for filename in args[1:]:
-        wkset = engine.workset_manager.load(filename)
-        print filename, 100 - wkset.shape.get_hits_pc_above(time)
+        wkset = engine.workset_manager.load_lazy(filename)
+        if show_percentiles:
+            print filename, 100 - wkset.shape.get_hits_pc_above(time), workset.format_percentiles(wkset.shape)
+        else:
+            print filename, 100 - wkset.shape.get_hits_pc_above(time)
+
+def series_cmd(args):
+    step = 1
+    try:
+        if '-s' in args:
+            index = args.index('-s')
+            step = int(args[index + 1])
+            del args[index:index + 2]
+    except (IndexError, ValueError):
+        usage()
+    if len(args) not in (3, 4) or step < 1:
+        usage()
+
+    service, app = args[0], args[1]
+    try:
+        start, end = series.parse_period(args[2])
+        if len(args) > 3:
+            end = series.parse_period(args[3])[1]
+    except ValueError:
+        usage()
+
+    engine = DefaultEngine()
+    engine.configure()
+
+    result_sheet = Sheet()
+    result_sheet.header("Minute", "Hits", "Ignored", "Errors", "5xx", "Above", "QoS")
+    total = series.MinuteRecord(start, 0)
+    for record in series.scan(engine.config.root + "/series", service, app, start, end, step):
+        result_sheet.line(*get_series_fields(series.format_minute(record.minute), record))
+        total.aggregate(record)
+    result_sheet.end_line(*get_series_fields("Total", total))
+    result_sheet.show()
+
+def get_series_fields(name, record):
+    counters = record.counters
+    qos = record.get_qos()
+    if qos is None:
+        qos = "-"
+    return (name, counters[series.HITS], counters[series.IGNORED], counters[series.ERRORS],
+            counters[series.HTTP_5XX], counters[series.HITS_ABOVE], qos)
+
+def get_source_parts(filename):
+    """ returns the (filename, start, end) parts of a source parsed apart: the
+        byte ranges of zxtm.LOG_SHARD_SIZE of a plain logfile, else the
+        whole source. the parts don't depend on the job count.
+    """
+    if not zxtm.is_plain_logfile(filename) or os.path.getsize(filename) <= zxtm.LOG_SHARD_SIZE:
+        return [ (filename, 0, None) ]
+    mmap_file = util.open_mmap(filename)
+    try:
+        return [ (filename, start, end) for start, end in util.split_ranges(mmap_file, 0, len(mmap_file), zxtm.LOG_SHARD_SIZE) ]
+    finally:
+        mmap_file.close()
+
+def parse_source_part(part):
+    return parse_source_file(*part)
+
+def parse_source_file(filename, start=0, end=None):
+    """ parses one zxtm logfile, or its lines in [start, end[, into a new
+        WorkSet (runs in the parse -j workers)
+    """
+    wkset = workset.WorkSet()
+    hit = wkset.hit
+    normalizer = workset.get_url_normalizer()
+    bad_lines = 0
+
+    mmap_file = None
+    if zxtm.is_plain_logfile(filename):
+        mmap_file = util.open_mmap(filename)
+        batches = zxtm.iter_zxtm_batches(mmap_file, start, end)
+    else:
+        batches = zxtm.iter_zxtm_stream_batches(filename)
+    for batch in batches:
+        clean_urls = normalizer.clean_batch(batch.urls)
+        for duration, url, node_name, http_code in itertools.izip(batch.durations, clean_urls, batch.node_names, batch.http_codes):
+            hit(url, duration, node_name, http_code)
+        bad_lines += batch.bad_lines
+    if mmap_file is not None:
+        mmap_file.close()
+
+    if bad_lines > 0:
+        logging.warning("parse: skipped %d malformed lines in [%s]", bad_lines, filename)
+    logging.debug("parse: url cache for [%s]: %s", filename, normalizer.stats())
+    return wkset
 
 def parse_cmd(args):
     logging.debug("Running command parse")
+
+    jobs = pop_jobs_option(args, 1)
+
     if len(args) < 1:
         usage()
 
@@ -265,38 +426,92 @@ def parse_cmd(args):
     dest_workset.metadata["parse"] = "parse"
     dest_workset.metadata["file_name"] = dest_filename
     dest_workset.metadata["parse_source_files"] = sources
-    
-    for i in sources:
-        mmap_file = util.open_mmap(i)
-        while 1:
-            line = mmap_file.readline()
-            if not line:
-                break
-            duration, host, url, node_name, http_code = zxtm.parse_zxtm_log_line(line)
-            dest_workset.hit(workset.cleanup_url(url), duration, node_name, http_code)
+
+    # every part of the sources (see get_source_parts) is parsed into its own
+    # partial workset and the partials are merged in order, so the result
+    # doesn't depend on the job count
+    parts = []
+    for filename in sources:
+        parts.extend(get_source_parts(filename))
+    pool = None
+    # the workers can't read our stdin
+    if jobs > 1 and len(parts) > 1 and '-' not in sources:
+        pool = multiprocessing.Pool(min(jobs, len(parts)))
+        partials = pool.imap(parse_source_part, parts)
+    else:
+        partials = itertools.imap(parse_source_part, parts)
+
+    for partial in partials:
+        dest_workset.aggregate(partial)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     engine.workset_manager.save(dest_workset, dest_filename)
 
 def aggregate_cmd(args):
     logging.debug("Running command aggregate")
+    jobs = pop_jobs_option(args)
     if len(args) < 3:
         usage()
     
     dest_filename = args[-1]
     sources = args[:-1]
     engine = DefaultEngine()
-    dest_workset = create_aggregate_workset(engine, sources)
+    dest_workset = create_aggregate_workset(engine, sources, jobs=jobs)
     dest_workset.metadata["file_name"] = dest_filename
     engine.workset_manager.save(dest_workset, dest_filename)
 
 
-def create_aggregate_workset(engine, sources):
-    dest_workset = workset.WorkSet()
-    dest_workset.metadata["creator"] = "aggregate"
-    dest_workset.metadata["aggregate_source_files"] = sources
-    
-    for i in list(set(sources)):
-        dest_workset.aggregate(engine.workset_manager.load(i))
+def stats_cmd(args):
+    logging.debug("Running command stats")
+    if len(args) > 0:
+        usage()
+
+    sync_engine = sync.SyncEngine()
+    sync_engine.load_state()
+    for report in sync_engine.state.stats_history:
+        print json.dumps(report, sort_keys=True)
+
+def backfill_cmd(args):
+    logging.debug("Running command backfill")
+    if len(args) < 1:
+        usage()
+
+    sync_engine = sync.SyncEngine(state_name=sync.BACKFILL_STATE)
+    sync_engine.backfill(args)
+
+def rollup_cmd(args):
+    logging.debug("Running command rollup")
+    if len(args) > 0:
+        usage()
+
+    sync_engine = sync.SyncEngine()
+    sync_engine.lock()
+    try:
+        sync_engine.load_state()
+        sync_engine.rollup(everything=True)
+        sync_engine.save_state()
+    finally:
+        sync_engine.unlock()
+
+def compact_cmd(args):
+    logging.debug("Running command compact")
+    if len(args) < 1:
+        usage()
+
+    engine = DefaultEngine()
+    for filename in args:
+        engine.workset_manager.compact(filename)
+
+
+def create_aggregate_workset(engine, sources, url_filter=None, jobs=None):
+    """ jobs defaults to the number of cpus
+    """
+    aggregation_engine = aggregation.AggregationEngine(engine.workset_manager, jobs)
+    dest_workset = aggregation_engine.aggregate(sources, url_filter)
+    dest_workset.metadata = { "creator": "aggregate", "aggregate_source_files": sources }
     return dest_workset
 
 def export_cmd(args):
@@ -312,6 +527,24 @@ def export_cmd(args):
 def compare_cmd(args):
     logging.debug("Running command compare")
 
+    target_time = compare.DEFAULT_TARGET_TIME
+    limit = None
+    tsv = False
+    try:
+        if '-t' in args:
+            index = args.index('-t')
+            target_time = float(args[index + 1])
+            del args[index:index + 2]
+        if '-n' in args:
+            index = args.index('-n')
+            limit = int(args[index + 1])
+            del args[index:index + 2]
+    except (IndexError, ValueError):
+        usage()
+    if '--tsv' in args:
+        tsv = True
+        args.remove('--tsv')
+
     if len(args) != 2:
         usage()
     
@@ -319,7 +552,13 @@ def compare_cmd(args):
     wkset1 = engine.workset_manager.load(args[0])
     wkset2 = engine.workset_manager.load(args[1])
     
+    comparison = compare.Comparison(wkset1, wkset2, target_time)
+    if tsv:
+        comparison.write_tsv(limit)
+        return
     wkset1.compare(wkset2)
+    print "\nPages by impact on the hits above %gs:\n" % (target_time)
+    comparison.show(limit or compare.DEFAULT_LIMIT)
 
 def check_cmd(args):
     logging.debug("Running command check")
@@ -329,7 +568,7 @@ def check_cmd(args):
     
     engine = DefaultEngine()
     for i in args:
-        if engine.workset_manager.load(i).is_valid():
+        if engine.workset_manager.load_lazy(i).is_valid():
             print i, "OK"
         else:
             print i, "Invalid"
@@ -342,7 +581,7 @@ def report_cmd(args):
     
     engine = DefaultEngine()
     for filename in args:
-        wkset = engine.workset_manager.load(filename)
+        wkset = engine.workset_manager.load_lazy(filename)
         # total actual hits
         total = wkset.total_hits + wkset.total_ignored
         # total errors + http 5xx codes
@@ -380,32 +619,84 @@ def report_cmd(args):
     
 
 
+def serve_cmd(args):
+    logging.debug("Running command serve")
+    global workset_manager_factory
+
+    socket_path = None
+    cache_mb = server.DEFAULT_CACHE_MB
+    try:
+        if '-s' in args:
+            index = args.index('-s')
+            socket_path = args[index + 1]
+            del args[index:index + 2]
+        if '-m' in args:
+            index = args.index('-m')
+            cache_mb = int(args[index + 1])
+            del args[index:index + 2]
+    except (IndexError, ValueError):
+        usage()
+    if len(args) > 0:
+        usage()
+
+    commands = dict([ (name, COMMANDS[name]) for name in SERVED_COMMANDS ])
+    # munin reads the configuration and marks the files it read
+    query_server = server.QueryServer(commands, socket_path, cache_mb, volatile_commands=['munin'])
+    workset_manager_factory = lambda: query_server.workset_manager
+    query_server.serve_forever()
+
+
 def usage():
-    print >> sys.stderr, """usage: qos.py command
+    print >> sys.stderr, """usage: qos.py [--profile[=FILE]] [--stats[=FILE]] command
+
+\t --profile runs the command under cProfile, printing its most expensive functions (or saving them to FILE)
+\t --stats writes the run statistics (time per stage, counters) as JSON to stderr (or to FILE)
 
 Workset creation commands:
 
-\t sync                                          get latest data from zxtm (normally called by a cron job)
-\t parse ZXTMFILE1 [...]  DESTINATION            parse zxtm file(s) and save worksets files
+\t sync [-j N]                                   get latest data from zxtm (normally called by a cron job), the
+\t                                               logfiles are read by N processes (sync_jobs in the config)
+\t sync [-j N] --follow                          keep running, reading zxtm logs as they grow
+\t parse [-j N] ZXTMFILE1 [...]  DESTINATION     parse zxtm file(s) and save worksets files, using N processes
+\t backfill ZXTMFILE1 [...]                      add past zxtm file(s) (named VSERVER.*.YYYYMMDD.HH.log) to the
+\t                                               worksets of their hour as sync would, each file is only read once
+
+\t a ZXTMFILE can be gzip, bzip2 or xz compressed (.gz, .bz2, .xz), or - for stdin with parse
+
 \t check WORKSETFILE1 [...]                      runs a self check on workset file(s)
-\t aggregate WORKSETFILE1 [...] DESTINATION      creates a new workset containing all the given worksets
+\t aggregate [-j N] WORKSETFILE1 [...] DESTINATION  creates a new workset containing all the given worksets
+\t compact WORKSETFILE1 [...]                    folds workset delta segments into their workset file
+\t rollup                                        builds the day, week and month worksets of past periods (also done by sync)
 
 Workset analysis commands:
 
 \t summary  WORKSETFILE1 [...]                   print workset file(s) summaries
-\t qos TIME WORKSETFILE1 [...]                   print % hits < time
-\t grep [-i] [-v] [-e] expression WORKSETFILE1 [...]       shows pages counters matching the given expression or regexp
-\t search [-v] expression WORKSETFILE1 [...]          shows pages counters matching the given regexp
-\t match [-v] expression WORKSETFILE1 [...]           shows pages counters exactly matching the given regexp
-\t top  WORKSETFILE1 [...]                       print slow pages top
+\t qos [-p] TIME WORKSETFILE1 [...]              print % hits < time, and the p50/p90/p99/p99.9 times with -p
+\t grep [-i] [-v] [-e] [-j N] expression WORKSETFILE1 [...]  shows pages counters matching the given expression or regexp
+\t search [-v] [-j N] expression WORKSETFILE1 [...]     shows pages counters matching the given regexp
+\t match [-v] [-j N] expression WORKSETFILE1 [...]      shows pages counters exactly matching the given regexp
+\t top [-j N] WORKSETFILE1 [...]                 print slow pages top
+\t compare [-t TIME] [-n LINES] [--tsv] OLDFILE NEWFILE
+\t                                               ranks the page changes by their impact on the hits above TIME
+\t                                               (default 0.5), all pages as tab separated values with --tsv
+
+\t the -j N option sets the number of processes used to load and merge the worksets (default: one per cpu)
 \t status-top httpcode WORKSETFILE1 [...]        print http status code page breakdown
 
+\t series [-s MINUTES] SERVICE APP FROM [TO]     print the per minute counters of an app kept by sync, from the
+\t                                               FROM period to the TO one (YYYYMMDD[.HH[MM]]), MINUTES at a time
+\t stats                                         print the statistics of the last sync flushes, one JSON line each
+
 Integration commands:
 \t munin                                         show current qos for each service/app in a format usable by munin
+\t serve [-s SOCKET] [-m CACHE_MB]               answer the analysis and munin commands from a workset cache kept in memory
+
+\t when a server is listening on $QOSTOOL_SOCKET (default: $XDG_RUNTIME_DIR/qostool.sock, or
+\t /tmp/qostool-UID/qostool.sock), the analysis and munin commands are sent to it, unless the socket or its
+\t folder belong to another user. set QOSTOOL_NO_SERVER to always run them here.
 
 Unfinished commands:
 
-\t compare WORKSETFILE1 WORKSETFILE2             compares two workset files
 \t dump WORKSETFILE1 [...]                       dump workset file(s) contents
 \t report WORKSETFILE1 [...]
 
@@ -413,12 +704,53 @@ Unfinished commands:
     sys.exit(1)    
 
 
+COMMANDS = {
+    'parse'      :        parse_cmd,
+    'summary'    :      summary_cmd,
+    'sync'       :         sync_cmd,
+    'backfill'   :     backfill_cmd,
+    'qos'        :          qos_cmd,
+    'aggregate'  :    aggregate_cmd,
+    'compact'    :      compact_cmd,
+    'rollup'     :       rollup_cmd,
+    'compare'    :      compare_cmd,
+    'check'      :        check_cmd,
+    'grep'       :         grep_cmd,
+    'search'     :       search_cmd,
+    'match'      :        match_cmd,
+    'export'     :       export_cmd,
+    'top'        :          top_cmd,
+    'dump'       :         dump_cmd,
+    'status-top' :   status_top_cmd,
+    'munin'      :        munin_cmd,
+    'series'     :       series_cmd,
+    'report'     :       report_cmd,
+    'serve'      :        serve_cmd,
+    'stats'      :        stats_cmd,
+}
+
+# the read only commands, that a running query server answers
+SERVED_COMMANDS = ['summary', 'qos', 'compare', 'check', 'grep', 'search', 'match', 'export', 'top', 'dump',
+                   'status-top', 'munin', 'report']
+
 def main():
 
 
-    if len(sys.argv) < 2:
+    options = {}
+    argv = sys.argv[1:]
+    while len(argv) > 0 and argv[0].split('=')[0] in ('--profile', '--stats'):
+        name, dummy, value = argv.pop(0).partition('=')
+        options[name] = value or None
+
+    if len(argv) < 1:
         usage()
 
+    command = argv[0]
+    if command in SERVED_COMMANDS and len(options) == 0:
+        status = server.query(argv)
+        if status is not None:
+            sys.exit(status)
+
     try:
         import psyco
         psyco.full()
@@ -426,31 +758,31 @@ def main():
     except ImportError:
         logging.debug("Psyco optimizations not available")
 
-    command_map = {
-        'parse'      :        parse_cmd,
-        'summary'    :      summary_cmd,
-        'sync'       :         sync_cmd,
-        'qos'        :          qos_cmd,
-        'aggregate'  :    aggregate_cmd,
-        'compare'    :      compare_cmd,
-        'check'      :        check_cmd,
-        'grep'       :         grep_cmd,
-        'search'     :       search_cmd,
-        'match'      :        match_cmd,
-        'export'     :       export_cmd,
-        'top'        :          top_cmd,
-        'dump'       :         dump_cmd,
-        'status-top' :   status_top_cmd,
-        'munin'      :        munin_cmd,
-        'report'     :       report_cmd
-    }
-    
-    command = sys.argv[1]
+    if not COMMANDS.has_key(command):
+        usage()
+
     try:
-        command_map[command](sys.argv[2:])
-    except:
-        logging.exception("Error running command [%s]", command)
-        sys.exit(1)
+        try:
+            if options.has_key('--profile'):
+                stats.run_profiled(COMMANDS[command], argv[1:], options['--profile'])
+            else:
+                COMMANDS[command](argv[1:])
+        except:
+            logging.exception("Error running command [%s]", command)
+            sys.exit(1)
+    finally:
+        if options.has_key('--stats'):
+            write_stats(options['--stats'])
+
+def write_stats(filename=None):
+    if filename is None:
+        stats.dump()
+        return
+    outfile = open(filename, "w")
+    try:
+        stats.dump(outfile)
+    finally:
+        outfile.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+rollup: day, ISO week and month worksets built from the hourly ones
+"""
+
+import os, os.path
+import re
+import calendar
+import datetime
+import logging
+
+import workset
+
+HOURLY_FILE_RE = re.compile(r"^(?P<app>.+)\.(?P<day>\d{8})\.(?P<hour>\d\d)\.ws$")
+
+def generate_day_workset_file_name(day, service, app):
+    # 20070222 -> 2007/02/22
+    return service + '/' + day[0:4] + '/' + day[4:6] + '/' + day[6:8] + '/' + app + '.' + day + ".ws"
+
+def generate_week_workset_file_name(week, service, app):
+    # 2007w08 -> 2007/w08
+    return service + '/' + week[0:4] + '/' + week[4:] + '/' + app + '.' + week + ".ws"
+
+def generate_month_workset_file_name(month, service, app):
+    # 200702 -> 2007/02
+    return service + '/' + month[0:4] + '/' + month[4:6] + '/' + app + '.' + month + ".ws"
+
+def day_to_date(day):
+    return datetime.date(int(day[0:4]), int(day[4:6]), int(day[6:8]))
+
+def day_to_week(day):
+    iso_year, iso_week, dummy = day_to_date(day).isocalendar()
+    return "%04dw%02d" % (iso_year, iso_week)
+
+def week_days(week):
+    # the ISO week 1 is the one holding January 4th
+    jan4 = datetime.date(int(week[0:4]), 1, 4)
+    monday = jan4 - datetime.timedelta(days=jan4.isoweekday() - 1) + datetime.timedelta(weeks=int(week[5:]) - 1)
+    return [ (monday + datetime.timedelta(days=i)).strftime("%Y%m%d") for i in range(7) ]
+
+def month_days(month):
+    year = int(month[0:4])
+    month_num = int(month[4:6])
+    return [ "%04d%02d%02d" % (year, month_num, i) for i in range(1, calendar.monthrange(year, month_num)[1] + 1) ]
+
+def shift_day(day, days):
+    return (day_to_date(day) + datetime.timedelta(days=days)).strftime("%Y%m%d")
+
+
+class RollupEngine:
+    """ builds the day worksets from the hourly ones, and the week and month
+        worksets from the day ones, once their period is over. a rollup is only
+        rebuilt when one of its sources is newer, so running it again is
+        harmless. with retention_days > 0, hourly files older than that are
+        removed once they are part of an up to date day rollup.
+    """
+
+    def __init__(self, data_root, workset_manager, retention_days=0):
+        self.data_root = data_root
+        self.workset_manager = workset_manager
+        self.retention_days = retention_days
+
+    def find_hourly_worksets(self, days=None):
+        """ returns {(service, app, day): [hourly workset file names]}
+        """
+        result = {}
+        if not os.path.isdir(self.data_root):
+            return result
+        for service in os.listdir(self.data_root):
+            for folder, dummy, file_names in os.walk(os.path.join(self.data_root, service)):
+                for file_name in file_names:
+                    m = HOURLY_FILE_RE.match(file_name)
+                    if m is None:
+                        continue
+                    day = m.group("day")
+                    if days is not None and day not in days:
+                        continue
+                    result.setdefault((service, m.group("app"), day), []).append(os.path.join(folder, file_name))
+        for sources in result.values():
+            sources.sort()
+        return result
+
+    def get_mtime(self, filename):
+        mtime = os.path.getmtime(filename)
+        for dummy, delta_filename in self.workset_manager.get_deltas(filename):
+            mtime = max(mtime, os.path.getmtime(delta_filename))
+        return mtime
+
+    def is_stale(self, dest, sources):
+        if not os.path.isfile(dest):
+            return True
+        dest_mtime = os.path.getmtime(dest)
+        for source in sources:
+            if self.get_mtime(source) > dest_mtime:
+                return True
+        return False
+
+    def build(self, dest, sources, period):
+        if len(sources) == 0 or not self.is_stale(dest, sources):
+            return False
+        logging.debug("RollupEngine: building %s from %d worksets", dest, len(sources))
+        wkset = self.workset_manager.new_workset()
+        wkset.metadata["creator"] = "rollup"
+        wkset.metadata["rollup_period"] = period
+        wkset.metadata["rollup_sources"] = [ os.path.basename(source) for source in sources ]
+        wkset.metadata["file_name"] = dest[len(self.data_root) + 1:]
+        for source in sources:
+            wkset.aggregate(self.workset_manager.load(source))
+        self.workset_manager.save(wkset, dest)
+        return True
+
+    def existing_day_rollups(self, service, app, days):
+        sources = []
+        for day in days:
+            fname = os.path.join(self.data_root, generate_day_workset_file_name(day, service, app))
+            if os.path.isfile(fname):
+                sources.append(fname)
+        return sources
+
+    def run(self, today, days=None, open_days=()):
+        """ rolls up every day before today (or only the given days), except
+            open_days which still have data coming
+        """
+        hourly_worksets = self.find_hourly_worksets(days)
+        closed_weeks = set()
+        closed_months = set()
+        built = 0
+
+        for (service, app, day), sources in hourly_worksets.items():
+            if day >= today or day in open_days:
+                continue
+            dest = os.path.join(self.data_root, generate_day_workset_file_name(day, service, app))
+            if self.build(dest, sources, day):
+                built += 1
+
+            week = day_to_week(day)
+            if week_days(week)[-1] < today:
+                closed_weeks.add((service, app, week))
+            month = day[0:6]
+            if month < today[0:6]:
+                closed_months.add((service, app, month))
+
+        for service, app, week in closed_weeks:
+            dest = os.path.join(self.data_root, generate_week_workset_file_name(week, service, app))
+            if self.build(dest, self.existing_day_rollups(service, app, week_days(week)), week):
+                built += 1
+
+        for service, app, month in closed_months:
+            dest = os.path.join(self.data_root, generate_month_workset_file_name(month, service, app))
+            if self.build(dest, self.existing_day_rollups(service, app, month_days(month)), month):
+                built += 1
+
+        logging.debug("RollupEngine: %d rollup worksets built", built)
+
+        if self.retention_days > 0:
+            self.prune(hourly_worksets, shift_day(today, -self.retention_days))
+
+    def prune(self, hourly_worksets, before_day):
+        """ removes the hourly worksets of the days before before_day that are
+            covered by an up to date day rollup
+        """
+        for (service, app, day), sources in hourly_worksets.items():
+            if day >= before_day:
+                continue
+            dest = os.path.join(self.data_root, generate_day_workset_file_name(day, service, app))
+            if self.is_stale(dest, sources):
+                continue
+            for source in sources:
+                logging.debug("RollupEngine: removing hourly workset %s", source)
+                for dummy, delta_filename in self.workset_manager.get_deltas(source):
+                    os.unlink(delta_filename)
+                os.unlink(source)
+                try:
+                    os.rmdir(os.path.dirname(source))
+                except OSError:
+                    pass
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+series: per minute qos counters of each service/app, fed by sync
+
+one append-only file per service, app and (local) day, made of a header
+then fixed size records (little-endian):
+    header      magic, version, bucket count, bucket bounds (doubles)
+    record      minute (since the epoch), target time, hits, ignored hits,
+                errors, 5xx hits, hits above the target time, then the hits
+                of each duration bucket
+a minute can have several records, one per sync run that saw it: readers
+add them up. a partial record left by a crash is cut before appending.
+"""
+
+import os, os.path
+import time
+import bisect
+import struct
+import calendar
+import logging
+
+import util
+
+MAGIC = "QOSSERIE"
+VERSION = 1
+
+HEADER = struct.Struct("<8sHH")
+
+# hits are counted in the duration buckets [0, 0.1[, [0.1, 0.2[, ... [10, inf[
+BUCKET_BOUNDS = (0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+HITS, IGNORED, ERRORS, HTTP_5XX, HITS_ABOVE = range(5)
+COUNTER_COUNT = 5
+
+MINUTE_CACHE_SIZE = 10000
+
+MONTHS = dict([ (name, i + 1) for i, name in enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                                                        "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]) ])
+
+def get_record_struct(bucket_count):
+    return struct.Struct("<If%dI" % (COUNTER_COUNT + bucket_count))
+
+def generate_series_file_name(day, service, app):
+    # 20070222 -> 2007/02
+    return service + '/' + day[0:4] + '/' + day[4:6] + '/' + app + '.' + day + ".series"
+
+def parse_log_minute(timestamp):
+    """ "[21/Nov/2007:15:00:22 +0100]" -> minutes since the epoch
+    """
+    day, month, year = timestamp[1:12].split('/')
+    seconds = calendar.timegm((int(year), MONTHS[month], int(day), int(timestamp[13:15]), int(timestamp[16:18]), 0))
+    offset = (int(timestamp[23:25]) * 60 + int(timestamp[25:27])) * 60
+    if timestamp[22] == '-':
+        offset = -offset
+    return (seconds - offset) // 60
+
+def minute_to_day(minute):
+    return time.strftime("%Y%m%d", time.localtime(minute * 60))
+
+def format_minute(minute):
+    return time.strftime("%Y%m%d.%H%M", time.localtime(minute * 60))
+
+def parse_period(period):
+    """ "YYYYMMDD", "YYYYMMDD.HH" or "YYYYMMDD.HHMM" (local time) -> (first
+        minute, minute after the last one)
+    """
+    lengths = { 8: 1440, 11: 60, 13: 1 }
+    if period[8:9] not in ('', '.') or not lengths.has_key(len(period)) or not period.replace('.', '').isdigit():
+        raise ValueError("bad period [%s]" % (period))
+    fields = (int(period[0:4]), int(period[4:6]), int(period[6:8]), int(period[9:11] or 0), int(period[11:13] or 0))
+    start = int(time.mktime(fields + (0, 0, 0, -1))) // 60
+    return start, start + lengths[len(period)]
+
+
+class MinuteRecord:
+    def __init__(self, minute, target_time, bucket_count=len(BUCKET_BOUNDS) + 1):
+        self.minute = minute
+        self.target_time = target_time
+        self.counters = [0] * COUNTER_COUNT
+        self.buckets = [0] * bucket_count
+
+    def aggregate(self, other):
+        self.target_time = other.target_time
+        counters = self.counters
+        for i, count in enumerate(other.counters):
+            counters[i] += count
+        buckets = self.buckets
+        for i, count in enumerate(other.buckets):
+            buckets[i] += count
+
+    def get_qos(self):
+        """ % of the timed hits under the target time, as the qos command
+            computes it, or None without timed hits
+        """
+        timed_hits = self.counters[HITS] - self.counters[ERRORS]
+        if timed_hits <= 0:
+            return None
+        return 100 - float(self.counters[HITS_ABOVE]) / timed_hits * 100
+
+
+class SeriesCollector:
+    """ per minute counters of the hits sync reads, until a sync checkpoint
+        takes them (see take_appends) for the series files under root
+    """
+    def __init__(self, root):
+        self.root = root
+        self.records = {} # (service, app, minute) -> MinuteRecord
+        self.minutes = {} # log timestamp minus its seconds -> minute
+        self.bounds = list(BUCKET_BOUNDS)
+
+    def get_minute(self, timestamp):
+        """ None for a timestamp that can't be read
+        """
+        key = timestamp[:18] + timestamp[21:]
+        try:
+            return self.minutes[key]
+        except KeyError:
+            pass
+        try:
+            minute = parse_log_minute(timestamp)
+        except (ValueError, KeyError, IndexError):
+            minute = None
+        if len(self.minutes) >= MINUTE_CACHE_SIZE:
+            self.minutes.clear()
+        self.minutes[key] = minute
+        return minute
+
+    def get_record(self, svc, app, timestamp):
+        minute = self.get_minute(timestamp)
+        if minute is None:
+            return None
+        key = (svc.svc_id, app, minute)
+        record = self.records.get(key, None)
+        if record is None:
+            record = MinuteRecord(minute, svc.target_time)
+            self.records[key] = record
+        return record
+
+    def hit(self, svc, app, timestamp, duration, http_code):
+        """ the counting rules of WorkSet.hit
+        """
+        record = self.get_record(svc, app, timestamp)
+        if record is None:
+            return
+        counters = record.counters
+        counters[HITS] += 1
+        if duration == 0 and http_code == 0:
+            counters[ERRORS] += 1
+            return
+        if 500 <= http_code < 600:
+            counters[HTTP_5XX] += 1
+        if duration >= record.target_time:
+            counters[HITS_ABOVE] += 1
+        record.buckets[bisect.bisect_right(self.bounds, duration)] += 1
+
+    def ignore_hit(self, svc, app, timestamp):
+        record = self.get_record(svc, app, timestamp)
+        if record is not None:
+            record.counters[IGNORED] += 1
+
+    def take_appends(self):
+        """ returns the (file name, packed records) to append to the series
+            files, and forgets the records
+        """
+        files = {}
+        for (svc_id, app, minute), record in self.records.iteritems():
+            files.setdefault(generate_series_file_name(minute_to_day(minute), svc_id, app), []).append(record)
+        self.records = {}
+        appends = []
+        for filename, records in files.iteritems():
+            records.sort(key=lambda record: record.minute)
+            appends.append((os.path.join(self.root, filename), pack_records(records)))
+        return appends
+
+
+def pack_records(records):
+    record_struct = get_record_struct(len(BUCKET_BOUNDS) + 1)
+    return ''.join([ record_struct.pack(record.minute, record.target_time, *(record.counters + record.buckets))
+                     for record in records ])
+
+def get_append_offset(filename):
+    """ where the next records of a series file go: after its last whole
+        record, 0 for a new file
+    """
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        return 0
+    header_size = HEADER.size + 8 * len(BUCKET_BOUNDS)
+    if size < header_size:
+        return 0
+    return size - (size - header_size) % get_record_struct(len(BUCKET_BOUNDS) + 1).size
+
+def append_data(filename, data, offset=None):
+    """ appends packed records to a series file. with an offset (see
+        get_append_offset), the file is first cut back to it, so that
+        appending again the same data at the same offset is harmless.
+    """
+    replay = offset is not None
+    if not replay:
+        offset = get_append_offset(filename)
+    util.makedirs_for_file(filename)
+    created = not os.path.exists(filename)
+    if not created:
+        outfile = open(filename, "r+b")
+    else:
+        outfile = open(filename, "wb")
+    try:
+        outfile.seek(0, os.SEEK_END)
+        size = outfile.tell()
+        if size > offset:
+            if not replay:
+                logging.warning("series: dropping a partial record at the end of [%s]", filename)
+            outfile.truncate(offset)
+        outfile.seek(offset)
+        if offset == 0:
+            outfile.write(HEADER.pack(MAGIC, VERSION, len(BUCKET_BOUNDS) + 1))
+            outfile.write(struct.pack("<%dd" % (len(BUCKET_BOUNDS)), *BUCKET_BOUNDS))
+        outfile.write(data)
+        # the state saved after a checkpoint no longer lists the append
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+    if created:
+        util.fsync_dir(os.path.dirname(filename))
+
+def read_records(filename, start=None, end=None):
+    """ returns the records of a series file, of the minutes in [start, end[
+        when given, in file order. a missing file has no records.
+    """
+    try:
+        infile = open(filename, "rb")
+    except IOError:
+        return []
+    try:
+        data = infile.read()
+    finally:
+        infile.close()
+    if len(data) < HEADER.size:
+        return []
+    magic, version, bucket_count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("[%s] is not a series file" % (filename))
+    if version > VERSION:
+        raise ValueError("[%s] uses unsupported series version %d" % (filename, version))
+
+    record_struct = get_record_struct(bucket_count)
+    records = []
+    for offset in xrange(HEADER.size + 8 * (bucket_count - 1), len(data) - record_struct.size + 1, record_struct.size):
+        fields = record_struct.unpack_from(data, offset)
+        minute = fields[0]
+        if (start is not None and minute < start) or (end is not None and minute >= end):
+            continue
+        record = MinuteRecord(minute, fields[1], bucket_count)
+        record.counters = list(fields[2:2 + COUNTER_COUNT])
+        record.buckets = list(fields[2 + COUNTER_COUNT:])
+        records.append(record)
+    return records
+
+def scan(root, service, app, start, end, step=1):
+    """ returns the MinuteRecords of service/app for the minutes in
+        [start, end[, adding up the minutes of each step (from start), by
+        minute
+    """
+    merged = {}
+    day_start = start
+    days = []
+    while day_start < end:
+        day = minute_to_day(day_start)
+        if day not in days:
+            days.append(day)
+        day_start += 60
+    day = minute_to_day(end - 1)
+    if day not in days:
+        days.append(day)
+
+    for day in days:
+        for record in read_records(os.path.join(root, generate_series_file_name(day, service, app)), start, end):
+            minute = start + (record.minute - start) // step * step
+            merged_record = merged.get(minute, None)
+            if merged_record is None:
+                merged_record = MinuteRecord(minute, record.target_time, len(record.buckets))
+                merged[minute] = merged_record
+            merged_record.aggregate(record)
+    return [ merged[minute] for minute in sorted(merged.keys()) ]
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+server: local query server keeping the loaded worksets in memory
+
+the server listens on a unix socket and runs the analysis commands of the
+cli with a WorkSetManager answering loads from an LRU cache. a request is
+one JSON line: {"argv": [command, args...], "cwd": directory}. the answer
+is a JSON line {"status": exit status, "stdout": length, "stderr": length}
+followed by the stdout then stderr bytes of the command.
+"""
+
+import os, os.path
+import sys
+import json
+import errno
+import signal
+import socket
+import logging
+import tempfile
+import collections
+
+import workset
+
+SOCKET_ENV = "QOSTOOL_SOCKET"
+NO_SERVER_ENV = "QOSTOOL_NO_SERVER"
+
+DEFAULT_CACHE_MB = 1024
+CONNECT_TIMEOUT = 1.0 # in seconds
+REQUEST_TIMEOUT = 10.0 # in seconds, to receive a request or send its answer
+
+RESPONSE_CACHE_SIZE = 256 # answers kept
+RESPONSE_MAX_SIZE = 1 << 20 # bigger outputs are not kept
+
+# rough memory cost of the python objects behind a page
+URL_OVERHEAD = 120 # url string + url_ids entry + urls slot
+NODE_SLOT_OVERHEAD = 80 # node_slots entry
+OBJECT_PAGE_SIZE = 10000 # Page with its shape, http codes and nodes
+
+def get_socket_dir():
+    """ a folder only we can use: $XDG_RUNTIME_DIR, or qostool-UID in the
+        temporary folder, created by the server
+    """
+    path = os.environ.get("XDG_RUNTIME_DIR", None)
+    if path:
+        return path
+    return os.path.join(tempfile.gettempdir(), "qostool-%d" % (os.getuid()))
+
+def get_socket_path():
+    path = os.environ.get(SOCKET_ENV, None)
+    if path:
+        return path
+    return os.path.join(get_socket_dir(), "qostool.sock")
+
+def is_trusted(socket_path):
+    """ whether socket_path and its folder are ours: another user could
+        otherwise read our requests and answer them
+    """
+    uid = os.getuid()
+    for path in (socket_path, os.path.dirname(os.path.abspath(socket_path))):
+        try:
+            if os.stat(path).st_uid != uid:
+                return False
+        except OSError:
+            return False
+    return True
+
+def get_workset_size(wkset):
+    """ estimated memory used by a workset, in bytes
+    """
+    if not isinstance(wkset, workset.ArrayWorkSet):
+        return len(wkset.pages) * OBJECT_PAGE_SIZE
+    size = 0
+    # the rows of removed pages are not counted, see ArrayWorkSet.compact_rows
+    for columns, rows in ((wkset.page_columns, len(wkset.url_ids)), (wkset.node_columns, len(wkset.node_slots))):
+        if columns.count == 0:
+            continue
+        for column in [ columns.hits, columns.errors, columns.min_times, columns.max_times,
+                        columns.total_times, columns.shape_hits, columns.shape ] + columns.codes.values():
+            size += len(column) // columns.count * rows * column.itemsize
+    for url in wkset.url_ids:
+        size += len(url) + URL_OVERHEAD
+    return size + len(wkset.node_slots) * NODE_SLOT_OVERHEAD
+
+
+class WorkSetCache:
+    """ LRU cache of loaded worksets, by file name. an entry is only used
+        while the file and its delta segments are unchanged. the least
+        recently used worksets are dropped to stay under budget bytes.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = collections.OrderedDict() # file name -> (version, workset, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, version):
+        entry = self.entries.pop(filename, None)
+        if entry is None:
+            return None
+        if entry[0] != version:
+            self.size -= entry[2]
+            return None
+        self.entries[filename] = entry
+        return entry[1]
+
+    def put(self, filename, version, wkset):
+        self.remove(filename)
+        size = get_workset_size(wkset)
+        self.entries[filename] = (version, wkset, size)
+        self.size += size
+        while self.size > self.budget and len(self.entries) > 1:
+            dropped, (dummy, dummy, dropped_size) = self.entries.popitem(last=False)
+            logging.debug("WorkSetCache: dropping %s (%d bytes)", dropped, dropped_size)
+            self.size -= dropped_size
+
+    def remove(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def stats(self):
+        return "%d worksets, %d MB, %d hits, %d misses" % (len(self.entries), self.size >> 20, self.hits, self.misses)
+
+
+class CachingWorkSetManager(workset.WorkSetManager):
+    """ WorkSetManager answering load() from a WorkSetCache. the cached
+        worksets are shared: callers aggregate them into new worksets and
+        never change them, and a filtered load returns a new workset.
+    """
+    # the cache lives in this process, aggregations must not fork workers
+    parallel = False
+
+    def __init__(self, cache, storage=workset.STORAGE_ARRAYS):
+        workset.WorkSetManager.__init__(self, storage=storage)
+        self.cache = cache
+        # (file name, version) of the worksets loaded since the last reset
+        self.loaded = []
+
+    def get_version(self, filename):
+        """ what identifies the current content of a workset file and its
+            delta segments
+        """
+        version = []
+        for name in [filename] + [ delta_filename for dummy, delta_filename in self.get_deltas(filename) ]:
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            version.append((name, st.st_ino, st.st_size, st.st_mtime))
+        return tuple(version)
+
+    def load(self, worksetfilename, url_filter=None):
+        filename = os.path.abspath(worksetfilename)
+        version = self.get_version(filename)
+        self.loaded.append((filename, version))
+        wkset = self.cache.get(filename, version)
+        if wkset is None:
+            self.cache.misses += 1
+            if url_filter is not None and getattr(url_filter, 'query', None) is not None:
+                # an indexed file is quicker to search than to load whole
+                return workset.WorkSetManager.load(self, filename, url_filter)
+            wkset = workset.WorkSetManager.load(self, filename)
+            self.cache.put(filename, version, wkset)
+        else:
+            self.cache.hits += 1
+        if url_filter is None:
+            return wkset
+        return self.filter_workset(wkset, url_filter)
+
+    def load_lazy(self, worksetfilename):
+        """ a loaded workset is better than a header
+        """
+        filename = os.path.abspath(worksetfilename)
+        version = self.get_version(filename)
+        self.loaded.append((filename, version))
+        wkset = self.cache.get(filename, version)
+        if wkset is None:
+            return workset.WorkSetManager.load_lazy(self, filename)
+        self.cache.hits += 1
+        return wkset
+
+    def filter_workset(self, wkset, url_filter):
+        """ returns a new workset with the totals of wkset and the pages
+            whose url url_filter accepts
+        """
+        filtered = self.new_workset()
+        convert = filtered.adopt_shape_spec(wkset)
+        filtered.aggregate_totals(wkset)
+        filtered.metadata = dict(wkset.metadata)
+        if isinstance(wkset, workset.ArrayWorkSet) and isinstance(filtered, workset.ArrayWorkSet):
+            page_ids = [ page_id for url, page_id in wkset.url_ids.iteritems() if url_filter(url) ]
+            page_ids.sort()
+            filtered.merge_rows(wkset, page_ids)
+        else:
+            for page in wkset.pages.itervalues():
+                if url_filter(page.url):
+                    filtered.merge_page(page, convert)
+        return filtered
+
+
+class QueryServer:
+    """ runs the given commands (name -> function of the arguments) one
+        request at a time. the command output goes to temporary files
+        through the stdout and stderr file descriptors, so everything the
+        command prints is sent back. the answers are kept, and given again
+        while the worksets the command loaded are unchanged, except for the
+        volatile commands, which depend on more than their worksets.
+    """
+    request_timeout = REQUEST_TIMEOUT
+
+    def __init__(self, commands, socket_path=None, cache_mb=DEFAULT_CACHE_MB, volatile_commands=()):
+        self.commands = commands
+        self.volatile_commands = volatile_commands
+        self.socket_path = socket_path or get_socket_path()
+        self.cache = WorkSetCache(cache_mb << 20)
+        self.workset_manager = CachingWorkSetManager(self.cache)
+        self.responses = collections.OrderedDict() # (argv, cwd) -> (loaded worksets, answer)
+        self.stopping = False
+        self.sock = None
+
+    def bind(self):
+        folder = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder, 0700)
+        if os.stat(folder).st_uid != os.getuid():
+            raise Exception("[%s] belongs to another user, cannot listen there" % (folder))
+        if os.path.exists(self.socket_path):
+            if not is_trusted(self.socket_path):
+                raise Exception("[%s] belongs to another user, cannot listen there" % (self.socket_path))
+            if is_server_running(self.socket_path):
+                raise Exception("a server is already listening on [%s]" % (self.socket_path))
+            os.unlink(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        self.sock.listen(16)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def serve_forever(self):
+        self.bind()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logging.debug("QueryServer: listening on %s", self.socket_path)
+        try:
+            while not self.stopping:
+                try:
+                    conn, dummy = self.sock.accept()
+                except socket.error, error:
+                    if error.errno == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    self.handle(conn)
+                except Exception:
+                    logging.exception("QueryServer: error handling a request")
+                conn.close()
+        finally:
+            self.sock.close()
+            os.unlink(self.socket_path)
+
+    def handle(self, conn):
+        # a client that never sends its request must not hold the others
+        conn.settimeout(self.request_timeout)
+        infile = conn.makefile("rb")
+        try:
+            line = infile.readline()
+        except socket.timeout:
+            logging.warning("QueryServer: no request after %.1fs, dropping the connection", self.request_timeout)
+            return
+        finally:
+            infile.close()
+        if not line:
+            # a connection test
+            return
+        request = json.loads(line)
+        argv = [ arg.encode('utf-8') for arg in request["argv"] ]
+        status, output, errors = self.answer(argv, request.get("cwd", "/"))
+        header = json.dumps({ "status": status, "stdout": len(output), "stderr": len(errors) })
+        try:
+            conn.sendall(header + "\n" + output + errors)
+        except socket.timeout:
+            logging.warning("QueryServer: answer not read after %.1fs, dropping the connection", self.request_timeout)
+
+    def answer(self, argv, cwd):
+        """ returns the kept answer of the command if still valid, or runs it
+        """
+        key = (tuple(argv), cwd)
+        response = self.responses.pop(key, None)
+        if response is not None:
+            loaded, result = response
+            if all([ self.workset_manager.get_version(filename) == version for filename, version in loaded ]):
+                logging.debug("QueryServer: answering %s again", argv)
+                self.responses[key] = response
+                return result
+
+        self.workset_manager.loaded = []
+        result = self.run_command(argv, cwd)
+        status, output, errors = result
+        if status == 0 and len(self.workset_manager.loaded) > 0 and argv[0] not in self.volatile_commands \
+                and len(output) + len(errors) <= RESPONSE_MAX_SIZE:
+            self.responses[key] = (self.workset_manager.loaded, result)
+            while len(self.responses) > RESPONSE_CACHE_SIZE:
+                self.responses.popitem(last=False)
+        return result
+
+    def run_command(self, argv, cwd):
+        """ returns (exit status, stdout, stderr) of the command
+        """
+        if len(argv) == 0 or not self.commands.has_key(argv[0]):
+            return 1, "", "unknown command %r\n" % (argv[:1])
+        logging.debug("QueryServer: running %s", argv)
+
+        outputs = [ tempfile.TemporaryFile(), tempfile.TemporaryFile() ]
+        saved_fds = [ os.dup(1), os.dup(2) ]
+        saved_cwd = os.getcwd()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(outputs[0].fileno(), 1)
+        os.dup2(outputs[1].fileno(), 2)
+        status = 0
+        try:
+            try:
+                os.chdir(cwd)
+                self.commands[argv[0]](argv[1:])
+            except SystemExit, exit:
+                status = exit.code or 0
+                if not isinstance(status, int):
+                    status = 1
+            except Exception:
+                logging.exception("Error running command [%s]", argv[0])
+                status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd in (1, 2):
+                os.dup2(saved_fds[fd - 1], fd)
+                os.close(saved_fds[fd - 1])
+            os.chdir(saved_cwd)
+
+        results = []
+        for output in outputs:
+            output.seek(0)
+            results.append(output.read())
+            output.close()
+        logging.debug("QueryServer: cache %s", self.cache.stats())
+        return status, results[0], results[1]
+
+
+def connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+def is_server_running(socket_path):
+    sock = connect(socket_path)
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+def query(argv, socket_path=None, out=None, err=None):
+    """ runs a command on the server, returns its exit status or None when
+        no server is running
+    """
+    if os.environ.get(NO_SERVER_ENV, None):
+        return None
+    socket_path = socket_path or get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    if not is_trusted(socket_path):
+        logging.warning("[%s] belongs to another user, running the command here", socket_path)
+        return None
+    try:
+        request = json.dumps({ "argv": argv, "cwd": os.getcwd() }) + "\n"
+    except UnicodeDecodeError:
+        return None
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+    try:
+        sock.sendall(request)
+        infile = sock.makefile("rb")
+        header = infile.readline()
+        if not header:
+            return None
+        header = json.loads(header)
+        (out or sys.stdout).write(infile.read(header["stdout"]))
+        (err or sys.stderr).write(infile.read(header["stderr"]))
+        infile.close()
+        return header["status"]
+    finally:
+        sock.close()
@@ -5,6 +5,8 @@ sheet
 """
 
 import os, sys
+import heapq
+import operator
 
 
 class Sheet:
@@ -17,6 +19,9 @@ class Sheet:
         self.sort_field_num = 0
         self.end_lines = []
         self.repr_end_lines = []
+        self.top_count = None
+        self.top_heap = []
+        self.line_seq = 0
 
 
     def header(self, *field_names):
@@ -26,21 +31,47 @@ class Sheet:
     def line(self, *fields):
         if len(fields) != self.column_count:
             raise Exception("Bad column count")
-        self.lines.append(fields)
+        if self.top_count is None:
+            self.lines.append(fields)
+            return
+        # the sequence number keeps the order of equal lines of a stable sort
+        entry = (fields[self.sort_field_num], self.line_seq, fields)
+        self.line_seq += 1
+        if len(self.top_heap) < self.top_count:
+            heapq.heappush(self.top_heap, entry)
+        elif self.top_count > 0:
+            heapq.heappushpop(self.top_heap, entry)
+
+    def top(self, field_num, num_lines):
+        """ streaming sort(field_num) then limit(num_lines): from now on only
+            the num_lines lines with the highest field_num value are kept,
+            in a heap
+        """
+        self.sort(field_num)
+        self.top_count = num_lines
+        self.top_heap = []
+        for fields in self.lines:
+            self.line(*fields)
+        self.lines = []
+
+    def accepts(self, value):
+        """ tells whether a line whose sort field is value would be kept
+        """
+        if self.top_count is None or len(self.top_heap) < self.top_count:
+            return True
+        return self.top_count > 0 and value >= self.top_heap[0][0]
+
+    def get_lines(self):
+        if self.top_count is None:
+            return self.lines
+        self.top_heap.sort()
+        return [ fields for value, seq, fields in self.top_heap ]
 
     def end_line(self, *fields):
         if len(fields) != self.column_count:
             raise Exception("Bad column count")
         self.end_lines.append(fields)
 
-        
-    def sort_cmp(self, line1, line2):
-        if line1[self.sort_field_num] < line2[self.sort_field_num]:
-            return -1
-        elif line1[self.sort_field_num] > line2[self.sort_field_num]:
-            return 1
-        else:
-            return 0
     
     def limit(self, num_lines, order_desc=False):
         if order_desc:
@@ -52,7 +83,7 @@ class Sheet:
     
     def sort(self, field_num):
         self.sort_field_num = field_num
-        self.lines.sort(self.sort_cmp)
+        self.lines.sort(key=operator.itemgetter(field_num))
     
     def format(self, obj):
         if type(obj) == float:
@@ -64,7 +95,7 @@ class Sheet:
     
     def create_repr(self):
         self.repr_lines = []
-        for line in self.lines:
+        for line in self.get_lines():
             self.repr_lines.append([ self.format(x) for x in line ])
         self.repr_end_lines = []
         for line in self.end_lines:
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+stats: run statistics, time spent per stage and counters
+
+the stages are timed once per block or per file, never per log line, so
+the statistics are always kept. a finer view of a run comes from running
+it under the profiler (qostool --profile COMMAND ...).
+
+    started = stats.start()
+    ...
+    stats.stop("sync.save", started)
+    stats.count("worksets_saved")
+"""
+
+import sys
+import time
+import json
+import pstats
+import cProfile
+
+PROFILE_LINES = 40 # functions shown by print_profile
+
+
+class Stats:
+    def __init__(self):
+        self.started = time.time()
+        self.times = {} # stage -> seconds
+        self.counts = {} # counter -> value
+
+    def stop(self, name, started):
+        self.times[name] = self.times.get(name, 0.0) + (time.time() - started)
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def merge(self, report):
+        """ adds the times and counts of a report (of a worker process)
+        """
+        for name, value in report["times"].iteritems():
+            self.times[name] = self.times.get(name, 0.0) + value
+        for name, value in report["counts"].iteritems():
+            self.count(name, value)
+
+    def snapshot(self):
+        return { "time": time.time(), "times": dict(self.times), "counts": dict(self.counts) }
+
+    def get_report(self, since=None):
+        """ the statistics as a JSON-able dict, only what happened after the
+            since snapshot when given
+        """
+        report = self.snapshot()
+        if since is None:
+            report["seconds"] = report["time"] - self.started
+            return report
+        report["seconds"] = report["time"] - since["time"]
+        for key in ("times", "counts"):
+            values = report[key]
+            for name, value in since[key].items():
+                values[name] = values.get(name, 0) - value
+                if values[name] == 0:
+                    del values[name]
+        return report
+
+
+# the statistics of this process
+current = Stats()
+
+def start():
+    return time.time()
+
+def stop(name, started):
+    current.stop(name, started)
+
+def count(name, value=1):
+    current.count(name, value)
+
+def merge(report):
+    current.merge(report)
+
+def snapshot():
+    return current.snapshot()
+
+def get_report(since=None):
+    return current.get_report(since)
+
+def dump(out=sys.stderr):
+    """ writes the statistics of the process as one JSON line
+    """
+    print >> out, json.dumps(get_report(), sort_keys=True)
+
+
+def run_profiled(function, args, filename=None, out=sys.stderr):
+    """ runs function(args) under cProfile, the profile is saved to filename
+        (for pstats) or its most expensive functions are printed to out
+    """
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(function, args)
+    finally:
+        if filename is not None:
+            profile.dump_stats(filename)
+        else:
+            print_profile(profile, out)
+
+def print_profile(profile, out=sys.stderr):
+    profile_stats = pstats.Stats(profile, stream=out)
+    profile_stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+    profile_stats.sort_stats("time").print_stats(PROFILE_LINES)
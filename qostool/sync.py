@@ -5,15 +5,27 @@ qos: module for utility classes and methods
 """
 
 import os, os.path
+import re
+import time
+import fcntl
+import signal
 import dircache
 import cPickle
 import stat
+import copy
 import logging
+import itertools
+import traceback
+import multiprocessing
 
 import config
+import munin
 import util
 import workset
 import zxtm
+import rollup
+import series
+import stats
 
 class SyncLogFile:
     def __init__(self, filename, time_period):
@@ -23,14 +35,184 @@ class SyncLogFile:
         self.size = 0
         self.closable = False
 
+class SyncCommit:
+    """ the files of a checkpoint, written aside until the state listing
+        them is saved
+    """
+    def __init__(self):
+        self.renames = [] # (written file name, final file name)
+        self.series_appends = [] # (series file name, offset, packed records)
+
 class SyncEngineState:
     def __init__(self):
         self.current_logfiles = {}
+        # workset file name -> time period, for worksets with delta segments
+        self.pending_deltas = {}
+        self.last_rollup_day = None
+        # statistics of the last flushes, see SyncEngine.record_stats
+        self.stats_history = []
+        # the SyncCommit of the last checkpoint, until it is applied
+        self.pending_commit = None
+        # absolute file name -> (offset read, whether done), for backfill
+        self.backfilled_logfiles = {}
 
     def __repr__(self):
         return "<SyncEngineState current_logfiles:%s>" % (repr(self.current_logfiles))
 
 
+class PollingWatcher:
+    """ waits for changes in the zxtm log folder by looking at the sizes of
+        its files every step seconds, waking up at least every interval
+        seconds
+    """
+    step = 1.0
+
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.sizes = self.get_sizes()
+
+    def get_sizes(self):
+        sizes = {}
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return sizes
+        for name in names:
+            try:
+                sizes[name] = os.stat(os.path.join(self.root, name))[stat.ST_SIZE]
+            except OSError:
+                pass
+        return sizes
+
+    def wait(self):
+        deadline = time.time() + self.interval
+        while True:
+            time.sleep(max(0, min(self.step, deadline - time.time())))
+            sizes = self.get_sizes()
+            if sizes != self.sizes or time.time() >= deadline:
+                self.sizes = sizes
+                return
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """ waits for changes in the zxtm log folder with inotify (needs pyinotify),
+        waking up at least every interval seconds
+    """
+    def __init__(self, root, interval):
+        import pyinotify
+        self.interval = interval
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager, pyinotify.ProcessEvent())
+        self.watch_manager.add_watch(root, pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO)
+
+    def wait(self):
+        if self.notifier.check_events(int(self.interval * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def close(self):
+        self.notifier.stop()
+
+def create_watcher(root, interval):
+    try:
+        watcher = InotifyWatcher(root, interval)
+        logging.debug("SyncEngine: watching [%s] with inotify", root)
+        return watcher
+    except ImportError:
+        logging.debug("SyncEngine: pyinotify not available, polling [%s] every %.1fs", root, interval)
+        return PollingWatcher(root, interval)
+
+
+SYNC_STATE = "sync"
+BACKFILL_STATE = "backfill"
+STATE_NAMES = (SYNC_STATE, BACKFILL_STATE)
+
+LOCK_FILE = "state/sync.lock" # under the root folder
+
+COMMIT_SUFFIX = ".commit"
+
+SHARD_MIN_SIZE = 16 << 20 # bytes of an unread tail read by one sync worker, at least
+
+STATS_HISTORY_SIZE = 1000 # flushes whose statistics are kept in the state
+
+ROUTING_HOST_CACHE_SIZE = 10000
+ROUTING_APP_CACHE_SIZE = 100000
+
+TIME_PERIOD_RE = re.compile(r"^\d{8}\.\d\d$")
+
+REGEX_SPECIAL_CHARS_RE = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+class ServiceRoute:
+    """ what a log line needs from a service once its host matched: app
+        lookup, ignore check and url cleanup
+    """
+    def __init__(self, svc):
+        self.svc = svc
+        self.svc_id = svc.svc_id
+        self.munin_apps = set(svc.munin_apps)
+        self.normalizer = workset.get_url_normalizer(svc.keep_params_re)
+        self.clean_url = self.normalizer.clean
+        if svc.ignore_re.pattern == "^$":
+            # default: only an empty url is ignored
+            self.is_ignored = self.is_empty
+        else:
+            self.is_ignored = svc.ignore_re.search
+
+        # apps_re is "^/(app1|app2|...)": when the apps are plain strings the
+        # app only depends on the first 1+len(longest app) chars of the url
+        self.app_cache = {}
+        self.app_key_len = None
+        if len(svc.apps) > 0 and not [ a for a in svc.apps if REGEX_SPECIAL_CHARS_RE.search(a) ]:
+            self.app_key_len = 1 + max([ len(a) for a in svc.apps ])
+
+    def is_empty(self, url):
+        return len(url) == 0
+
+    def find_app_uncached(self, url):
+        m = self.svc.apps_re.search(url)
+        if m is not None:
+            return m.group(1)
+        return "other"
+
+    def find_app(self, url):
+        if self.app_key_len is None:
+            return self.find_app_uncached(url)
+        key = url[:self.app_key_len]
+        app = self.app_cache.get(key, None)
+        if app is None:
+            if len(self.app_cache) >= ROUTING_APP_CACHE_SIZE:
+                self.app_cache.clear()
+            app = self.find_app_uncached(key)
+            self.app_cache[key] = app
+        return app
+
+class RoutingPlan:
+    """ host -> service routing for one vserver, memoized per host
+    """
+    def __init__(self, services):
+        self.services = services
+        self.routes = dict([ (svc.svc_id, ServiceRoute(svc)) for svc in services ])
+        self.host_cache = {}
+
+    def route_host(self, host):
+        try:
+            return self.host_cache[host]
+        except KeyError:
+            pass
+        route = None
+        for svc in self.services:
+            if svc.zxtm_host_re.search(host):
+                route = self.routes[svc.svc_id]
+                break
+        if len(self.host_cache) >= ROUTING_HOST_CACHE_SIZE:
+            self.host_cache.clear()
+        self.host_cache[host] = route
+        return route
+
+
 def generate_workset_file_name(time_period, service, app):
     # 20070222.17 -> 2007/02/22/17
     return service + '/' + time_period[0:4] + '/' + time_period[4:6] + '/' + time_period[6:8] + '/' + time_period[9:] + '/' + app + '.' + time_period + ".ws"
@@ -40,16 +222,141 @@ def generate_munin_workset_file_name(service, app):
     return service + '/' + app + '.ws'
 
 
+# the SyncEngine of a sync worker process, by configuration file and its
+# modification time
+worker_engines = {}
+
+def read_logfile_part(task):
+    """ reads the lines of a logfile from logfile.size to end (runs in the
+        sync workers). returns what SyncEngine.merge_logfile_part takes, or
+        the error traceback.
+    """
+    config_file, current_time_period, logfile, logfilename, end = task
+    try:
+        # a changed configuration file is read again, as sync --follow does
+        # on SIGHUP
+        key = (config_file, os.stat(config_file).st_mtime)
+        engine = worker_engines.get(key, None)
+        if engine is None:
+            engine = SyncEngine(config_file)
+            engine.load_munin_worksets = False
+            engine.config.checkpoint_mb = 0
+            worker_engines.clear()
+            worker_engines[key] = engine
+        engine.current_time_period = current_time_period
+        since = stats.snapshot()
+        engine.update_current_logfile(logfile, logfilename, end)
+
+        munin_worksets = []
+        for svc in engine.config.services.values():
+            for app in svc.munin_apps:
+                wset = engine.opened_munin_worksets.get(svc.svc_id + '-' + app, None)
+                if wset is not None:
+                    munin_worksets.append((svc.svc_id, app, wset))
+        result = (logfile, engine.opened_worksets, munin_worksets, engine.series.records, stats.get_report(since))
+        engine.opened_worksets = {}
+        engine.opened_munin_worksets = {}
+        engine.series.records = {}
+        engine.unsaved_bytes = 0
+        return result
+    except:
+        return traceback.format_exc()
+
+
+def read_state(state_file_name):
+    infile = open(state_file_name, "rb")
+    try:
+        state = cPickle.load(infile)
+    finally:
+        infile.close()
+    if not hasattr(state, "pending_deltas"):
+        state.pending_deltas = {}
+    if not hasattr(state, "last_rollup_day"):
+        state.last_rollup_day = None
+    if not hasattr(state, "stats_history"):
+        state.stats_history = []
+    if not hasattr(state, "pending_commit"):
+        state.pending_commit = None
+    if not hasattr(state, "backfilled_logfiles"):
+        state.backfilled_logfiles = {}
+    return state
+
+def write_state(state, state_file_name):
+    util.makedirs_for_file(state_file_name)
+    # the state is replaced at once, it commits the checkpoints
+    outfile = open(state_file_name + ".tmp", "wb")
+    try:
+        cPickle.dump(state, outfile, cPickle.HIGHEST_PROTOCOL)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    finally:
+        outfile.close()
+    os.rename(state_file_name + ".tmp", state_file_name)
+    util.fsync_dir(os.path.dirname(state_file_name))
+
+def apply_commit(commit):
+    """ puts the files of a checkpoint in place, doing it again is harmless
+        until other files are written. they are on disk when it returns.
+    """
+    folders = set()
+    for commit_filename, filename in commit.renames:
+        if os.path.exists(commit_filename):
+            os.rename(commit_filename, filename)
+            folders.add(os.path.dirname(filename))
+    for folder in folders:
+        util.fsync_dir(folder)
+    for filename, offset, data in commit.series_appends:
+        series.append_data(filename, data, offset)
+
+def remove_commit_files(list_file_name):
+    """ removes the checkpoint files listed in list_file_name that were
+        not put in place: their run stopped before saving its state
+    """
+    try:
+        infile = open(list_file_name, "rb")
+    except IOError:
+        return
+    try:
+        commit_filenames = cPickle.load(infile)
+    finally:
+        infile.close()
+    for commit_filename in commit_filenames:
+        if os.path.exists(commit_filename):
+            logging.warning("SyncEngine: removing [%s], left by an interrupted checkpoint", commit_filename)
+            os.unlink(commit_filename)
+
 class SyncEngine:
+    # bytes of log parsed at once, checkpoints happen between blocks
+    block_size = zxtm.ZXTM_BLOCK_SIZE
+    # the sync workers only collect the new munin hits
+    load_munin_worksets = True
 
-    def __init__(self):
+    def __init__(self, config_file=config.DEFAULT_CONFIG_FILE, state_name=SYNC_STATE):
         self.workset_manager = workset.WorkSetManager()
+        self.config_file = config_file
+        # backfill keeps its own state, it can run along sync: they write
+        # the files they share under a lock, see lock()
+        self.state_name = state_name
         self.config = config.QosEngineConfig()
-        self.config.parse_file("/etc/qos/qos.cfg")
+        self.config.parse_file(self.config_file)
+        self.workset_manager.url_index = self.config.url_index
+        self.routing_plans = {}
+        self.routing_config = None
         self.state = None
         self.opened_worksets = {}
         self.opened_munin_worksets = {}
+        self.series = series.SeriesCollector(self.config.root + "/series")
         self.current_time_period = zxtm.get_actual_time_period()
+        self.stopping = False
+        self.compacted_days = set()
+        self.last_stats = stats.snapshot()
+        # bytes of log read since the last checkpoint
+        self.unsaved_bytes = 0
+        self.lock_file = None
+        self.lock_depth = 0
+        # the sync workers of a run, see start_pool
+        self.pool = None
+        self.pool_jobs = 0
         
 
     def handle_new_logfiles(self):
@@ -61,20 +368,80 @@ class SyncEngine:
     
     def create_initial_state(self):
         self.state = SyncEngineState()
-        self.handle_new_logfiles()
+        if self.state_name == SYNC_STATE:
+            self.handle_new_logfiles()
         logging.debug("SyncEngine: initial state created: %s", repr(self.state))
         
+    def get_state_file_name(self, state_name):
+        return self.config.root + "/state/" + state_name + ".state"
+
     def load_state(self):
-        state_file_name = self.config.root + "/state/sync.state"
-        if not os.path.isfile(state_file_name):
-            self.create_initial_state()
-        else:
-            infile = open(state_file_name, "rb")
-            self.state = cPickle.load(infile)
-            infile.close()
+        self.lock()
+        try:
+            state_file_name = self.get_state_file_name(self.state_name)
+            if not os.path.isfile(state_file_name):
+                self.create_initial_state()
+            else:
+                self.state = read_state(state_file_name)
+                # the last checkpoint may have been interrupted
+                self.apply_commit()
+            remove_commit_files(self.get_commit_list_file_name(self.state_name))
+        finally:
+            self.unlock()
+
+    def get_commit_list_file_name(self, state_name):
+        """ the checkpoint files being written, see save_checkpoint
+        """
+        return self.config.root + "/state/" + state_name + ".commits"
+
+    def lock(self):
+        """ takes the lock sync and backfill hold while they write the files
+            they share: the delta segments of the hourly worksets, the series
+            files, the compactions and the rollups. it can be taken again by
+            the process holding it, see unlock.
+        """
+        if self.lock_depth == 0:
+            lock_file_name = self.config.root + "/" + LOCK_FILE
+            util.makedirs_for_file(lock_file_name)
+            self.lock_file = open(lock_file_name, "a")
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self.apply_other_commits()
+            except:
+                self.lock_file.close()
+                self.lock_file = None
+                raise
+        self.lock_depth += 1
+
+    def unlock(self):
+        self.lock_depth -= 1
+        if self.lock_depth == 0:
+            # closing the file releases the lock
+            self.lock_file.close()
+            self.lock_file = None
+
+    def apply_other_commits(self):
+        """ puts in place the last checkpoint of the other states, which an
+            interrupted run may have left: its series appends must be done
+            before ours
+        """
+        for state_name in STATE_NAMES:
+            state_file_name = self.get_state_file_name(state_name)
+            if state_name == self.state_name or not os.path.isfile(state_file_name):
+                continue
+            state = read_state(state_file_name)
+            if state.pending_commit is not None:
+                logging.debug("SyncEngine: applying the last checkpoint of the %s state", state_name)
+                apply_commit(state.pending_commit)
+                state.pending_commit = None
+                write_state(state, state_file_name)
+            remove_commit_files(self.get_commit_list_file_name(state_name))
 
 
     def get_workset(self, time_period, svc_id, app):
+        """ returns the workset collecting this run's hits, it is saved as a
+            delta segment of the hourly workset file
+        """
         wset_key = time_period + '-' + svc_id + '-' + app
         wset = self.opened_worksets.get(wset_key, None)
         if wset is not None:
@@ -82,14 +449,10 @@ class SyncEngine:
             
         ws_filename = generate_workset_file_name(time_period, svc_id, app)            
 
-        try:
-            wset = self.workset_manager.load(self.config.root + "/data/" + ws_filename)
-            logging.debug("Loaded existing workset %s", ws_filename)
-        except:
-            logging.debug("Creating new workset")
-            wset = workset.WorkSet()
-            wset.metadata["creator"] = "qostool"
-            wset.metadata["file_name"] = ws_filename
+        wset = workset.WorkSet(self.config.services[svc_id].shape_spec)
+        wset.metadata["creator"] = "qostool"
+        wset.metadata["file_name"] = ws_filename
+        wset.metadata["time_period"] = time_period
 
         self.opened_worksets[wset_key] = wset
         return wset
@@ -102,7 +465,7 @@ class SyncEngine:
             
         ws_filename = generate_munin_workset_file_name(svc_id, app)            
 
-        if not os.path.isfile(self.config.root + "/munin/" + ws_filename + ".read"):
+        if self.load_munin_worksets and not os.path.isfile(self.config.root + "/munin/" + ws_filename + ".read"):
             try:
                 wset = self.workset_manager.load(self.config.root + "/munin/" + ws_filename)
                 logging.debug("Loaded existing munin workset %s", ws_filename)
@@ -112,7 +475,7 @@ class SyncEngine:
                 pass
 
         logging.debug("Creating new munin workset")
-        wset = workset.WorkSet()
+        wset = workset.WorkSet(self.config.services[svc_id].shape_spec)
         wset.metadata["creator"] = "qostool"
         wset.metadata["file_name"] = ws_filename
 
@@ -130,7 +493,48 @@ class SyncEngine:
         return possible_services
     
 
+    def get_routing_plan(self, vserver):
+        """ routing plans are built once per vserver, and again after the
+            configuration changed
+        """
+        if self.routing_config != (self.config, self.config.generation):
+            self.routing_plans = {}
+            self.routing_config = (self.config, self.config.generation)
+        plan = self.routing_plans.get(vserver, None)
+        if plan is None:
+            plan = RoutingPlan(self.get_possible_services(vserver))
+            self.routing_plans[vserver] = plan
+        return plan
+
+    def reload_config(self, signum=None, frame=None):
+        logging.info("SyncEngine: reloading configuration [%s]", self.config_file)
+        try:
+            new_config = config.QosEngineConfig()
+            new_config.parse_file(self.config_file)
+            self.config = new_config
+        except:
+            logging.exception("SyncEngine: could not reload configuration, keeping the current one")
+
+    def start_pool(self):
+        """ starts the sync_jobs worker processes of a sync or follow run,
+            when more than one. they are forked without the lock held, so
+            they don't keep it.
+        """
+        if self.config.sync_jobs > 1:
+            self.pool = multiprocessing.Pool(self.config.sync_jobs)
+            self.pool_jobs = self.config.sync_jobs
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def update_current_logfiles(self):
+        # a single logfile can be read in parallel too, see split_unread_lines
+        if self.pool is not None and len(self.state.current_logfiles) > 0:
+            self.update_current_logfiles_parallel(self.pool, self.pool_jobs)
+            return
         for logfilename in self.state.current_logfiles.keys():
             try:
                 logfile = self.state.current_logfiles[logfilename]            
@@ -139,73 +543,306 @@ class SyncEngine:
                 logging.exception("update_current_logfiles: error processing current logfile [%s], dropping it", logfilename)
                 logfile.closable = True
 
-
-                        
-    def update_current_logfile(self, logfile, logfilename):
+    def update_current_logfiles_parallel(self, pool, jobs):
+        """ the logfiles are read by the jobs worker processes of pool,
+            checkpoint_mb each at a time. a logfile with a long unread tail
+            is read by several workers, in byte ranges (see
+            split_unread_lines). the hits come back as partial worksets and
+            series, merged here in logfile and range order, so the
+            checkpoints work as in a sequential sync.
+        """
+        logging.debug("SyncEngine: reading %d logfiles with %d jobs", len(self.state.current_logfiles), jobs)
+        max_bytes = self.config.checkpoint_mb << 20
+        pending = sorted(self.state.current_logfiles.keys())
+        while len(pending) > 0:
+            ends = {}
+            for logfilename in pending:
+                try:
+                    ends[logfilename] = self.get_unread_end(self.state.current_logfiles[logfilename], logfilename)
+                except:
+                    logging.exception("update_current_logfiles: error processing current logfile [%s], dropping it", logfilename)
+                    self.state.current_logfiles[logfilename].closable = True
+            pending = [ logfilename for logfilename in pending
+                        if ends.get(logfilename, 0) > self.state.current_logfiles[logfilename].size ]
+
+            tasks = []
+            for logfilename in pending:
+                logfile = self.state.current_logfiles[logfilename]
+                ranges = self.split_unread_lines(logfile, logfilename, ends[logfilename], max_bytes, max(1, jobs // len(pending)))
+                for start, end in ranges:
+                    part = copy.copy(logfile)
+                    part.size = start
+                    tasks.append((self.config_file, self.current_time_period, part, logfilename, end))
+
+            failed = set()
+            for task, result in itertools.izip(tasks, pool.imap(read_logfile_part, tasks)):
+                logfilename = task[3]
+                if logfilename in failed:
+                    continue
+                if isinstance(result, basestring):
+                    logging.error("update_current_logfiles: error processing current logfile [%s], dropping it\n%s", logfilename, result)
+                    self.state.current_logfiles[logfilename].closable = True
+                    failed.add(logfilename)
+                    continue
+                self.merge_logfile_part(logfilename, result)
+
+            pending = [ logfilename for logfilename in pending
+                        if logfilename not in failed and self.state.current_logfiles[logfilename].size < ends[logfilename] ]
+            if len(pending) > 0 and self.needs_checkpoint():
+                self.timed_checkpoint()
+
+    def split_unread_lines(self, logfile, logfilename, end, max_bytes, count):
+        """ returns the byte ranges of the next lines to read of logfile, up
+            to end, or about max_bytes of them when not 0. these are split in
+            count ranges at most, of SHARD_MIN_SIZE bytes or more.
+        """
+        mmap_file = util.open_mmap(self.config.zxtm_root + '/' + logfilename)
+        try:
+            if max_bytes > 0:
+                end = util.split_ranges(mmap_file, logfile.size, end, max_bytes)[0][1]
+            size = max(SHARD_MIN_SIZE, (end - logfile.size + count - 1) // count)
+            return util.split_ranges(mmap_file, logfile.size, end, size)
+        finally:
+            mmap_file.close()
+
+    def merge_logfile_part(self, logfilename, result):
+        """ adds what a worker read to ours
+        """
+        logfile, worksets, munin_worksets, series_records, report = result
+        started = stats.start()
+        self.unsaved_bytes += logfile.size - self.state.current_logfiles[logfilename].size
+        self.state.current_logfiles[logfilename] = logfile
+        for wset_key, wset in worksets.iteritems():
+            opened_wset = self.opened_worksets.get(wset_key, None)
+            if opened_wset is None:
+                self.opened_worksets[wset_key] = wset
+            else:
+                opened_wset.aggregate(wset)
+        for svc_id, app, wset in munin_worksets:
+            self.get_munin_workset(svc_id, app).aggregate(wset)
+        for key, record in series_records.iteritems():
+            opened_record = self.series.records.get(key, None)
+            if opened_record is None:
+                self.series.records[key] = record
+            else:
+                opened_record.aggregate(record)
+        stats.merge(report)
+        stats.stop("sync.merge", started)
+
+    def get_unread_end(self, logfile, logfilename):
+        """ returns where the whole new lines of logfile end, logfile.size
+            when there are none. a logfile without new data after its hour
+            is marked closable.
+        """
         new_size = os.stat(self.config.zxtm_root + '/' + logfilename)[stat.ST_SIZE]
-        prev_size = logfile.size
-        if (new_size == 0) or (new_size == prev_size):
+        if (new_size == 0) or (new_size == logfile.size):
             logging.debug("SyncEngine: no new data in current logfile [%s]", logfilename)
             
             if logfile.time_period < self.current_time_period:
                 logging.debug("SyncEngine: logfile [%s] is done, marking as closable", logfilename)
                 logfile.closable = True
-            return
+            return logfile.size
 
-        logging.debug("SyncEngine: current logfile [%s] has new data, skipping %d", logfilename, prev_size)
-
-        
         mmap_file = util.open_mmap(self.config.zxtm_root + '/' + logfilename)
-        mmap_file.seek(prev_size)
+        try:
+            # a line still being written is left for the next run, unless the
+            # logfile is over
+            end = mmap_file.rfind('\n', logfile.size, new_size) + 1
+        finally:
+            mmap_file.close()
+        if end == 0:
+            if logfile.time_period >= self.current_time_period:
+                logging.debug("SyncEngine: no whole new line in current logfile [%s]", logfilename)
+                return logfile.size
+            end = new_size
+        return end
+
+    def update_current_logfile(self, logfile, logfilename, end=None):
+        """ reads the new lines of logfile, up to end when given
+        """
+        if end is None:
+            end = self.get_unread_end(logfile, logfilename)
+        prev_size = logfile.size
+        if end <= prev_size:
+            return
 
-        # look for possible services for this vserver
-        possible_services = self.get_possible_services(logfile.zxtm_vserver)
+        mmap_file = util.open_mmap(self.config.zxtm_root + '/' + logfilename)
 
-        while 1:
-            line = mmap_file.readline()
-            if not line:
-                break
+        logging.debug("SyncEngine: current logfile [%s] has new data, skipping %d", logfilename, prev_size)
 
-            duration, host, url, node_name, http_code = zxtm.parse_zxtm_log_line(line)
-            svc = self.find_svc_for_host(possible_services, host)
-            if svc is None:
+        plan = self.get_routing_plan(logfile.zxtm_vserver)
+        bad_lines = 0
+        for batch in zxtm.iter_zxtm_batches(mmap_file, prev_size, end, self.block_size):
+            bad_lines += batch.bad_lines
+            self.hit_batch(batch, plan, logfile.time_period)
+            if self.needs_checkpoint() and batch.end < end:
+                logfile.size = batch.end
+                self.timed_checkpoint()
+        mmap_file.close()
+        stats.count("logfiles_read")
+
+        if bad_lines > 0:
+            logging.warning("SyncEngine: skipped %d malformed lines in [%s]", bad_lines, logfilename)
+
+        logfile.size = end
+
+    def hit_batch(self, batch, plan, time_period, live=True):
+        """ adds the hits of batch to the worksets and series. live hits
+            also go to the munin worksets.
+        """
+        started = stats.start()
+        route_host = plan.route_host
+        get_workset = self.get_workset
+        series_collector = self.config.series and self.series or None
+
+        for timestamp, duration, host, url, node_name, http_code in itertools.izip(batch.timestamps, batch.durations, batch.hosts, batch.urls, batch.node_names, batch.http_codes):
+            route = route_host(host)
+            if route is None:
                 continue
 
-            app = self.find_app_for_url(svc, url)
-            ws = self.get_workset(logfile.time_period, svc.svc_id, app)
+            app = route.find_app(url)
+            ws = get_workset(time_period, route.svc_id, app)
 
             # should we ignore this hit ?
-            if svc.ignore_re.search(url) is not None:
+            if route.is_ignored(url):
                 ws.ignore_hit(url, duration, node_name, http_code)
+                if series_collector is not None:
+                    series_collector.ignore_hit(route.svc, app, timestamp)
             else:
-                clean_url = workset.cleanup_url(url, svc.keep_params_re)
+                clean_url = route.clean_url(url)
                 ws.hit(clean_url, duration, node_name, http_code)
-                if (app in svc.munin_apps):
-                    self.get_munin_workset(svc.svc_id, app).hit(clean_url, duration, node_name, http_code)
-
-        logfile.size = new_size
-
-    def find_svc_for_host(self, possible_services, host):
-        for svc in possible_services:
-            if svc.zxtm_host_re.search(host):
-                return svc
+                if series_collector is not None:
+                    series_collector.hit(route.svc, app, timestamp, duration, http_code)
+                if live and app in route.munin_apps:
+                    self.get_munin_workset(route.svc_id, app).hit(clean_url, duration, node_name, http_code)
+        stats.stop("sync.hit", started)
+        self.unsaved_bytes += batch.end - batch.start
+
+    def needs_checkpoint(self):
+        return self.config.checkpoint_mb > 0 and self.unsaved_bytes >= self.config.checkpoint_mb << 20
+
+    def timed_checkpoint(self):
+        started = stats.start()
+        self.checkpoint()
+        stats.stop("sync.checkpoint", started)
+
+    def backfill(self, filenames):
+        """ reads past logfiles (possibly compressed, see zxtm.open_log)
+            into the worksets of their hour. the progress is kept in its
+            own state: a file is read once, and an interrupted backfill
+            goes on from its last checkpoint.
+        """
+        self.load_state()
+        for filename in filenames:
+            self.backfill_logfile(filename)
+        # the munin worksets are sync's
+        self.flush(munin=False)
+
+    def backfill_logfile(self, filename):
+        key = os.path.abspath(filename)
+        offset, done = self.state.backfilled_logfiles.get(key, (0, False))
+        if done:
+            logging.warning("SyncEngine: [%s] is already backfilled, skipping it", filename)
+            return
 
-    def find_app_for_url(self, svc, url):
-        m = svc.apps_re.search(url)
-        if m is not None:
-            return m.group(1)    
-        return "other"
-                
-    def save_opened_worksets(self):
+        logfilename = os.path.basename(filename)
+        time_period = zxtm.logfilename_to_timeperiod(logfilename)
+        if TIME_PERIOD_RE.match(time_period) is None:
+            logging.error("SyncEngine: no hour in the name of [%s], skipping it", filename)
+            return
+        logging.debug("SyncEngine: backfilling [%s] from %d", filename, offset)
+
+        plan = self.get_routing_plan(zxtm.logfilename_to_vserver(logfilename))
+        bad_lines = 0
+        for batch in zxtm.iter_zxtm_stream_batches(filename, offset, self.block_size):
+            bad_lines += batch.bad_lines
+            self.hit_batch(batch, plan, time_period, live=False)
+            offset = batch.end
+            if self.needs_checkpoint():
+                self.state.backfilled_logfiles[key] = (offset, False)
+                self.timed_checkpoint()
+        stats.count("logfiles_read")
+
+        if bad_lines > 0:
+            logging.warning("SyncEngine: skipped %d malformed lines in [%s]", bad_lines, filename)
+
+        self.state.backfilled_logfiles[key] = (offset, True)
+
+    def checkpoint(self):
+        """ saves the worksets and series of the hits read so far together
+            with the logfile offsets: their files are written aside, then
+            the state listing them is saved, then they are put in place. a
+            crash never leaves hits both saved and still to be read.
+        """
+        self.lock()
+        try:
+            self.save_checkpoint()
+        finally:
+            self.unlock()
+        self.unsaved_bytes = 0
+
+    def save_checkpoint(self):
+        logging.debug("SyncEngine: checkpoint after %d bytes", self.unsaved_bytes)
+        commit = SyncCommit()
+        saves = []
         for ws in self.opened_worksets.values():
             fname = self.config.root + "/data/" + ws.metadata["file_name"]
-            self.workset_manager.save(ws, fname)
+            delta_filename = self.workset_manager.get_next_delta_filename(fname)
+            commit.renames.append((delta_filename + COMMIT_SUFFIX, delta_filename))
+            saves.append((ws, fname, delta_filename + COMMIT_SUFFIX))
+        if len(saves) > 0:
+            # listed first, so that an interrupted checkpoint leaves no file
+            # behind, see remove_commit_files
+            write_state([ commit_filename for ws, fname, commit_filename in saves ],
+                        self.get_commit_list_file_name(self.state_name))
+        # the segments are on disk before the state listing them
+        for ws, fname, commit_filename in saves:
+            stats.count("pages_saved", len(ws.pages))
+            self.workset_manager.save(ws, commit_filename, durable=True)
+            self.state.pending_deltas[fname] = ws.metadata["time_period"]
         self.opened_worksets = {}
+        for filename, data in self.series.take_appends():
+            commit.series_appends.append((filename, series.get_append_offset(filename), data))
+
+        self.state.pending_commit = commit
+        self.save_state()
+        self.apply_commit()
+
+    def apply_commit(self):
+        """ puts the files of the last checkpoint in place
+        """
+        if self.state.pending_commit is None:
+            return
+        apply_commit(self.state.pending_commit)
+        self.state.pending_commit = None
+
+    def compact_closed_worksets(self):
+        """ folds the delta segments of the worksets whose hour is over and
+            whose logfiles are all closed
+        """
+        open_time_periods = set([ logfile.time_period for logfile in self.state.current_logfiles.values() ])
+        for fname, time_period in self.state.pending_deltas.items():
+            if time_period >= self.current_time_period or time_period in open_time_periods:
+                continue
+            try:
+                self.workset_manager.compact(fname)
+                del self.state.pending_deltas[fname]
+                self.compacted_days.add(time_period[0:8])
+            except:
+                logging.exception("SyncEngine: could not compact workset [%s]", fname)
 
     def save_or_reset_munin_worksets(self):
-        for ws in self.opened_munin_worksets.values():
+        target_times = {}
+        for service in self.config.services.values():
+            for app in service.munin_apps:
+                target_times[service.svc_id + '-' + app] = service.target_time
+
+        for wset_key, ws in self.opened_munin_worksets.items():
             fname = self.config.root + "/munin/" + ws.metadata["file_name"]
             self.workset_manager.save(ws, fname)
+            # what munin reads, see munin_cmd
+            summary = munin.create_summary(ws, target_times.get(wset_key, config.DEFAULT_TARGET_TIME))
+            munin.write_summary(summary, fname + munin.SUMMARY_SUFFIX)
             try:
                 os.unlink(fname + ".read")
             except:
@@ -219,6 +856,7 @@ class SyncEngine:
                     try:
                         os.unlink(fname)
                         os.unlink(fname + ".read")
+                        os.unlink(fname + munin.SUMMARY_SUFFIX)
                     except:
                         pass
 
@@ -226,12 +864,9 @@ class SyncEngine:
 
 
     def save_state(self):
-        state_file_name = self.config.root + "/state/sync.state"
+        state_file_name = self.get_state_file_name(self.state_name)
         logging.debug("Saving state in %s", state_file_name)
-        util.makedirs_for_file(state_file_name)
-        outfile = open(state_file_name, "wb")
-        cPickle.dump(self.state, outfile)
-        outfile.close()        
+        write_state(self.state, state_file_name)
 
     def close_logfiles(self):
         new_current_logfiles = {}
@@ -244,12 +879,125 @@ class SyncEngine:
         self.state.current_logfiles = new_current_logfiles
             
 
+    def log_url_cache_stats(self):
+        for key, normalizer in workset.url_normalizers.items():
+            logging.debug("SyncEngine: url cache [%s]: %s", key, normalizer.stats())
+
+    def rollup(self, everything=False):
+        """ builds the rollup worksets once a day, or as soon as late data for
+            a past day has been compacted
+        """
+        today = self.current_time_period[0:8]
+        if everything or self.state.last_rollup_day != today:
+            days = None
+        else:
+            days = set([ day for day in self.compacted_days if day < today ])
+            if len(days) == 0:
+                return
+
+        open_days = set([ time_period[0:8] for time_period in self.state.pending_deltas.values() ])
+        for logfile in self.state.current_logfiles.values():
+            open_days.add(logfile.time_period[0:8])
+
+        rollup_engine = rollup.RollupEngine(self.config.root + "/data", self.workset_manager, self.config.hourly_retention_days)
+        rollup_engine.run(today, days, open_days)
+        self.state.last_rollup_day = today
+        self.compacted_days = set()
+
+    def record_stats(self):
+        """ keeps the statistics since the previous flush in the state
+        """
+        report = stats.get_report(self.last_stats)
+        self.last_stats = stats.snapshot()
+        self.state.stats_history.append(report)
+        del self.state.stats_history[:-STATS_HISTORY_SIZE]
+        logging.debug("SyncEngine: stats %s", report)
+
+    def flush(self, munin=True):
+        """ saves what was read, then the munin worksets unless munin is
+            False, compacts the closed worksets and runs the rollups
+        """
+        steps = [ ("sync.checkpoint", self.checkpoint) ]
+        if munin:
+            steps.append(("sync.munin", self.save_or_reset_munin_worksets))
+        steps.append(("sync.compact", self.compact_closed_worksets))
+        self.lock()
+        try:
+            for name, function in steps:
+                started = stats.start()
+                function()
+                stats.stop(name, started)
+            if self.config.rollup:
+                started = stats.start()
+                try:
+                    self.rollup()
+                except:
+                    logging.exception("SyncEngine: rollup failed")
+                stats.stop("sync.rollup", started)
+            self.record_stats()
+            self.save_state()
+        finally:
+            self.unlock()
+
+    def stop(self, signum=None, frame=None):
+        logging.info("SyncEngine: stopping (signal %s)", signum)
+        self.stopping = True
+
+    def follow(self, watcher=None):
+        """ resident sync: keeps the state in memory, reads new log lines as
+            they come and saves them every follow_flush_interval seconds, on
+            hour rollover and on SIGTERM. SIGHUP reloads the configuration.
+            the watcher waits for the logs to change, see create_watcher.
+        """
+        self.stopping = False
+        handlers = {}
+        for signum, handler in ((signal.SIGTERM, self.stop), (signal.SIGINT, self.stop), (signal.SIGHUP, self.reload_config)):
+            handlers[signum] = signal.signal(signum, handler)
+
+        # the workers get our signal handlers, the follow process stops them
+        self.start_pool()
+        try:
+            self.load_state()
+            if watcher is None:
+                watcher = create_watcher(self.config.zxtm_root, self.config.follow_poll_interval)
+            last_flush = time.time()
+            try:
+                while not self.stopping:
+                    time_period = zxtm.get_actual_time_period()
+                    if time_period != self.current_time_period:
+                        logging.info("SyncEngine: time period rollover %s -> %s", self.current_time_period, time_period)
+                        self.flush()
+                        last_flush = time.time()
+                        self.current_time_period = time_period
+
+                    self.handle_new_logfiles()
+                    self.update_current_logfiles()
+                    self.close_logfiles()
+
+                    if time.time() - last_flush >= self.config.follow_flush_interval:
+                        self.flush()
+                        self.log_url_cache_stats()
+                        last_flush = time.time()
+
+                    if not self.stopping:
+                        watcher.wait()
+            finally:
+                watcher.close()
+                self.flush()
+        finally:
+            self.stop_pool()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
     def sync(self):
-        self.load_state()
-        self.handle_new_logfiles()
-        self.update_current_logfiles()
-        self.close_logfiles()
-        self.save_opened_worksets()
-        self.save_or_reset_munin_worksets()
-        self.save_state()
+        self.start_pool()
+        try:
+            self.load_state()
+            self.handle_new_logfiles()
+            self.update_current_logfiles()
+            self.log_url_cache_stats()
+            self.close_logfiles()
+            self.flush()
+        finally:
+            self.stop_pool()
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+urlindex: trigram index of the workset file urls, and the url queries that
+can be answered from it
+
+the index maps every trigram of the lowercased urls to the sorted ids of
+the pages holding it. a UrlQuery only narrows the pages down to candidates,
+which are then checked with the real matcher, so lowercasing and skipping
+what can't be indexed never lose a match.
+"""
+
+import sre_parse
+import sre_constants
+
+def trigram_key(trigram):
+    return (ord(trigram[0]) << 16) | (ord(trigram[1]) << 8) | ord(trigram[2])
+
+def get_trigrams(text):
+    text = text.lower()
+    return set([ text[i:i + 3] for i in xrange(len(text) - 2) ])
+
+def build_index(urls):
+    """ returns (keys, offsets, page_ids) for the given urls (page i is
+        urls[i]): sorted trigram keys, and for key i, page_ids[offsets[i]:offsets[i+1]]
+    """
+    postings = {}
+    for page_id in xrange(len(urls)):
+        for trigram in get_trigrams(urls[page_id]):
+            page_ids = postings.get(trigram, None)
+            if page_ids is None:
+                postings[trigram] = [page_id]
+            else:
+                page_ids.append(page_id)
+
+    keys = []
+    offsets = [0]
+    page_ids = []
+    for key, trigram in sorted([ (trigram_key(trigram), trigram) for trigram in postings ]):
+        keys.append(key)
+        page_ids.extend(postings[trigram])
+        offsets.append(len(page_ids))
+    return keys, offsets, page_ids
+
+
+class UrlQuery:
+    """ what a matching url must have: a case sensitive prefix (or None) and
+        literals it contains, in any case
+    """
+    def __init__(self, prefix=None, literals=()):
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode('utf-8')
+        self.prefix = prefix or None
+        self.literals = []
+        for literal in literals:
+            if isinstance(literal, unicode):
+                literal = literal.encode('utf-8')
+            self.literals.append(literal)
+
+    def get_trigrams(self):
+        trigrams = set()
+        for literal in self.literals:
+            trigrams.update(get_trigrams(literal))
+        return trigrams
+
+    def is_selective(self):
+        return self.prefix is not None or len(self.get_trigrams()) > 0
+
+    def __repr__(self):
+        return "UrlQuery(prefix=%r, literals=%r)" % (self.prefix, self.literals)
+
+
+def substring_query(text):
+    return UrlQuery(literals=[text])
+
+def regex_query(regex, anchored=False):
+    """ query for regex.search(url), or regex.match(url) when anchored. only
+        the literal runs of the top level sequence are used: a branch, class
+        or repeat just ends the current run.
+    """
+    try:
+        items = list(sre_parse.parse(regex.pattern, regex.flags))
+    except (sre_constants.error, TypeError):
+        return UrlQuery()
+    if len(items) > 0 and items[0] == (sre_constants.AT, sre_constants.AT_BEGINNING):
+        anchored = True
+        items = items[1:]
+    to_char = isinstance(regex.pattern, unicode) and unichr or chr
+
+    literals = []
+    run = []
+    for op, value in items:
+        if op == sre_constants.LITERAL:
+            run.append(to_char(value))
+        elif len(run) > 0:
+            literals.append(''.join(run))
+            run = []
+        else:
+            # an empty run: the next one can't be the url start anymore
+            literals.append('')
+    if len(run) > 0:
+        literals.append(''.join(run))
+
+    prefix = None
+    if anchored and len(literals) > 0 and not regex.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        prefix = literals[0]
+    return UrlQuery(prefix, [ literal for literal in literals if literal ])
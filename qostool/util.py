@@ -16,6 +16,15 @@ def makedirs_for_file(filename):
     if len(folder) > 0 and not os.path.isdir(folder):
         os.makedirs(folder)
 
+def fsync_dir(folder):
+    """ makes the names created, renamed or removed in folder durable
+    """
+    fd = os.open(folder or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def importer(name):
     """ dynamic import helper
     """
@@ -157,6 +166,20 @@ class ConfigParserDef(ConfigParser.SafeConfigParser):
         vlist.set_values([ unicode(v.strip()) for v in values ])
         return vlist
         
+def split_ranges(buf, start, end, size):
+    """ splits buf[start:end] (a string or mmap) into ranges of size bytes or
+        a bit more, each one ending after a newline but the last one
+    """
+    ranges = []
+    while end - start > size:
+        range_end = buf.find('\n', start + size - 1, end) + 1
+        if range_end == 0 or range_end == end:
+            break
+        ranges.append((start, range_end))
+        start = range_end
+    ranges.append((start, end))
+    return ranges
+
 def open_mmap(filename):
     logging.debug("Openning mmap for file [%s]", filename)
     fp = open(filename, "rb")
@@ -4,57 +4,159 @@
 qos: module for utility classes and methods
 """
 
-import sys, cPickle, gzip
+import os, sys, cPickle, gzip
+import math
+import array
 import logging
 
+import stats
 import util
+import wsfile
+
+FORMAT_PICKLE = "pickle"
+FORMAT_COLUMNAR = "columnar"
+
+DELTA_SUFFIX = ".d"
 
 QOS_SHAPE_RESOLUTION = 0.1 # in seconds
 QOS_SHAPE_MAX_TIME = 5 # in seconds
 QOS_SHAPE_HIST_WIDTH = 20
 QOS_SHAPE_MAX_INDEX = int(QOS_SHAPE_MAX_TIME/QOS_SHAPE_RESOLUTION)
 
-MODE_URI, MODE_SEMICOL, MODE_QUERY, MODE_QVALUE, MODE_KEPTQVALUE = range(5)
+QOS_SHAPE_LINEAR = "linear"
+QOS_SHAPE_HDR = "hdr"
+QOS_SHAPE_HDR_MIN_TIME = 0.001 # in seconds
+QOS_SHAPE_HDR_MAX_TIME = 60 # in seconds
+QOS_SHAPE_HDR_PRECISION = 0.05
+QOS_SHAPE_PERCENTILES = (50, 90, 99, 99.9)
+
+STORAGE_OBJECTS = "objects"
+STORAGE_ARRAYS = "arrays"
+
+COUNT_TYPECODE = 'l'
+TIME_TYPECODE = 'd'
+NODE_ID_BITS = 16 # page node keys are page_id << NODE_ID_BITS | node_id
+
+URL_CACHE_SIZE = 100000
 
 def cleanup_url(url, keep_params_re=None):
-    mode = MODE_URI
-    result = ""
-    start = 0
-    index = 0
-    for c in url:
-        if mode == MODE_URI:
-            if c == ';':
-                result += url[start:index]
-                mode = MODE_SEMICOL
-            elif c == '?':
-                result += url[start:index]
-                mode = MODE_QUERY
-                start = index
-        elif mode == MODE_SEMICOL:
-            if c == '?':
-                mode = MODE_QUERY
-                start = index
-        elif mode == MODE_QUERY:
-            if c == '=':
-                param_name = url[start:index]
-                if keep_params_re is not None and keep_params_re.match(param_name[1:]) is not None:
-                    mode = MODE_KEPTQVALUE
-                else:
-                    mode = MODE_QVALUE
-                    result += param_name
-        elif mode == MODE_KEPTQVALUE:
-            if c == '&':
-                result += url[start:index]
-                mode = MODE_QUERY
-                start = index
-        elif mode == MODE_QVALUE:
-            if c == '&':
-                mode = MODE_QUERY
-                start = index
-        index += 1
-    if mode == MODE_URI or mode == MODE_QUERY or mode == MODE_KEPTQVALUE:
-        result += url[start:index]
-    return result
+    """ drops path parameters (;...) and query parameter values, except the
+        values of the parameters whose name matches keep_params_re
+    """
+    query = url.find('?')
+    semicol = url.find(';')
+    if semicol != -1 and (query == -1 or semicol < query):
+        path_end = semicol
+    elif query != -1:
+        path_end = query
+    else:
+        return url
+    if query == -1:
+        return url[:path_end]
+
+    result = [url[:path_end]]
+    # start points to the '?' or '&' in front of the current parameter name
+    start = query
+    while 1:
+        equal = url.find('=', start)
+        if equal == -1:
+            result.append(url[start:])
+            break
+        param_name = url[start:equal]
+        amp = url.find('&', equal)
+        if keep_params_re is not None and keep_params_re.match(param_name[1:]) is not None:
+            if amp == -1:
+                result.append(url[start:])
+                break
+            result.append(url[start:amp])
+        else:
+            result.append(param_name)
+            if amp == -1:
+                break
+        start = amp
+    return ''.join(result)
+
+class UrlNormalizer:
+    """ cleanup_url for one keep_params_re, with a bounded cache of raw url ->
+        cleaned url. the cache is split in two generations: lookups promote
+        entries from the old generation to the recent one, and when the recent
+        generation is full the old one is dropped. that is close enough to LRU
+        while staying at plain dict speed.
+    """
+    def __init__(self, keep_params_re=None, cache_size=URL_CACHE_SIZE):
+        self.keep_params_re = keep_params_re
+        self.generation_size = max(1, cache_size / 2)
+        self.recent = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clean(self, url):
+        clean_url = self.recent.get(url)
+        if clean_url is not None:
+            self.hits += 1
+            return clean_url
+
+        clean_url = self.old.pop(url, None)
+        if clean_url is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            clean_url = cleanup_url(url, self.keep_params_re)
+
+        if len(self.recent) >= self.generation_size:
+            self.evictions += len(self.old)
+            self.old = self.recent
+            self.recent = {}
+        self.recent[url] = clean_url
+        return clean_url
+
+    def clean_batch(self, urls):
+        recent_get = self.recent.get
+        clean = self.clean
+        result = []
+        add = result.append
+        hits = 0
+        for url in urls:
+            clean_url = recent_get(url)
+            if clean_url is None:
+                clean_url = clean(url)
+                # clean() may have started a new generation
+                recent_get = self.recent.get
+            else:
+                hits += 1
+            add(clean_url)
+        self.hits += hits
+        return result
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups > 0:
+            hit_rate = float(self.hits) / lookups * 100
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.recent) + len(self.old),
+            'hit_rate': hit_rate,
+        }
+
+url_normalizers = {}
+
+def get_url_normalizer(keep_params_re=None):
+    """ returns the shared UrlNormalizer for the given keep_params_re
+    """
+    if keep_params_re is None:
+        key = None
+    else:
+        key = (keep_params_re.pattern, keep_params_re.flags)
+    normalizer = url_normalizers.get(key, None)
+    if normalizer is None:
+        normalizer = UrlNormalizer(keep_params_re)
+        url_normalizers[key] = normalizer
+    return normalizer
 
 def aggregate_http_codes(obj, other_obj):
     try:        
@@ -69,69 +171,209 @@ def aggregate_http_codes(obj, other_obj):
 def aggregate_nodes(obj, other_obj):
     try:        
         for n in other_obj.nodes.keys():
-            if not obj.nodes.has_key(n):
-                obj.nodes[n] = other_obj.nodes[n]
+            # older worksets kept the line terminator in the node key
+            key = n.rstrip('\r\n')
+            if not obj.nodes.has_key(key):
+                obj.nodes[key] = other_obj.nodes[n].copy()
             else:
-                obj.nodes[n].aggregate(other_obj.nodes[n])
+                obj.nodes[key].aggregate(other_obj.nodes[n])
     except AttributeError:
         pass
 
+def create_shape(spec=None):
+    """ spec: None for the default QosShape, (QOS_SHAPE_LINEAR, resolution,
+        max_time) or (QOS_SHAPE_HDR, min_time, max_time, precision)
+    """
+    if spec is None:
+        return QosShape()
+    if spec[0] == QOS_SHAPE_LINEAR:
+        return QosShape(*spec[1:])
+    if spec[0] == QOS_SHAPE_HDR:
+        return HdrQosShape(*spec[1:])
+    raise ValueError("unknown shape kind [%s]" % (spec[0]))
+
+def format_percentiles(shape, percentiles=QOS_SHAPE_PERCENTILES):
+    result = []
+    for pc, value in zip(percentiles, shape.get_percentiles(percentiles)):
+        if value is None:
+            result.append("p%g: -" % (pc))
+        else:
+            result.append("p%g: %.3f" % (pc, value))
+    return ' '.join(result)
+
 class QosShape:
-    def __init__(self):
-        self.shape = [0]*QOS_SHAPE_MAX_INDEX
+    """ latency distribution: dist[i] holds the hits that took between
+        i*resolution and (i+1)*resolution seconds (the last bucket also holds
+        everything slower). the cumulative "hits above" view is derived lazily
+        and cached until the next update.
+    """
+    def __init__(self, resolution=QOS_SHAPE_RESOLUTION, max_time=QOS_SHAPE_MAX_TIME):
+        self.dist = [0]*int(round(max_time/float(resolution)))
         self.total_hits = 0
-        self.resolution = QOS_SHAPE_RESOLUTION
-        self.max_time = QOS_SHAPE_MAX_TIME
-    
-    def compare(self, other_qos_shape, out=sys.stdout):
-        if self.resolution != other_qos_shape.resolution:
-            logging.error("Cannot compare QosShape with different resolution !")
+        self.resolution = resolution
+        self.max_time = max_time
+        self.above = None
 
-        if len(self.shape) != len(other_qos_shape.shape):
-            logging.warning("When comparing two QosShape with different max_times, we will pick the smallest one")
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['above'] = None
+        return state
 
-        logging.debug("QosShape.compare: not implemented !")
-        print >> out, "QosShape.compare: Not implemented !"
+    def __setstate__(self, state):
+        if state.has_key('shape'):
+            # legacy layout: shape[i] is the number of hits above i*resolution
+            above = state.pop('shape')
+            dist = [0]*len(above)
+            for i in range(len(above) - 1):
+                dist[i] = above[i] - above[i+1]
+            if len(above) > 0:
+                dist[-1] = above[-1]
+            state['dist'] = dist
+        if not state.has_key('min_time'):
+            state.setdefault('resolution', QOS_SHAPE_RESOLUTION)
+            state.setdefault('max_time', QOS_SHAPE_MAX_TIME)
+        state['above'] = None
+        self.__dict__.update(state)
 
-    def aggregate(self, other_qos_shape):
-        if self.resolution != other_qos_shape.resolution:
-            logging.error("Cannot aggregate QosShape with different resolution !")
+    def get_spec(self):
+        return (QOS_SHAPE_LINEAR, self.resolution, self.max_time)
+
+    def new_shape(self):
+        return QosShape(self.resolution, self.max_time)
+
+    def copy(self):
+        shape = self.new_shape()
+        shape.dist = list(self.dist)
+        shape.total_hits = self.total_hits
+        return shape
+
+    def index(self, time):
+        i = int(time/self.resolution)
+        if i >= len(self.dist):
+            return len(self.dist) - 1
+        elif i < 0:
+            return 0
+        return i
+
+    def bucket_start(self, i):
+        return i * self.resolution
+
+    def bucket_end(self, i):
+        """ None for the last bucket, which has no upper bound
+        """
+        if i >= len(self.dist) - 1:
+            return None
+        return (i + 1) * self.resolution
 
-        if len(self.shape) != len(other_qos_shape.shape):
-            logging.warning("When aggregating two QosShape with different max_times, we will pick the smallest one")
+    def bucket_middle(self, i):
+        """ the start of the last bucket
+        """
+        end = self.bucket_end(i)
+        if end is None:
+            return self.bucket_start(i)
+        return (self.bucket_start(i) + end) / 2.0
 
+    def compare(self, other_qos_shape, percentiles=QOS_SHAPE_PERCENTILES, out=sys.stdout):
+        """ prints the change of the hits and of the percentiles from this
+            shape to the other one, whatever their bucket layouts
+        """
+        if self.total_hits != other_qos_shape.total_hits:
+            print >> out, "shape_hits_diff: ", other_qos_shape.total_hits - self.total_hits
+        values = self.get_percentiles(percentiles)
+        other_values = other_qos_shape.get_percentiles(percentiles)
+        for pc, value, other_value in zip(percentiles, values, other_values):
+            if value is None or other_value is None:
+                continue
+            if value != other_value:
+                print >> out, "p%g_diff: %+.3f (%.3f -> %.3f)" % (pc, other_value - value, value, other_value)
+
+    def aggregate(self, other_qos_shape):
         self.total_hits += other_qos_shape.total_hits
-        
-        i = 0
-        minlen = min(len(self.shape), len(other_qos_shape.shape))
-        while i < minlen:
-            self.shape[i] += other_qos_shape.shape[i]
-            i += 1
-    
+        self.above = None
+
+        dist = self.dist
+        other_dist = other_qos_shape.dist
+        if len(dist) == len(other_dist) and self.get_spec() == other_qos_shape.get_spec():
+            for i in range(len(dist)):
+                dist[i] += other_dist[i]
+            return
+
+        # different bucket layouts: every bucket of the other shape is counted
+        # at its middle
+        for i in range(len(other_dist)):
+            if other_dist[i] == 0:
+                continue
+            dist[self.index(other_qos_shape.bucket_middle(i))] += other_dist[i]
+
     def hit(self, time):
         self.total_hits += 1
-        
-        i = int(time/QOS_SHAPE_RESOLUTION)
-        if i >= QOS_SHAPE_MAX_INDEX:
-            i = QOS_SHAPE_MAX_INDEX-1
 
-        while i >= 0:
-            self.shape[i] += 1
-            i -= 1
+        i = int(time/self.resolution)
+        if i >= len(self.dist):
+            i = len(self.dist)-1
+        elif i < 0:
+            return
+
+        self.dist[i] += 1
+        self.above = None
+
+    def get_cumulative(self):
+        """ returns the "hits above" view: element i is the number of hits
+            in bucket i or above
+        """
+        if self.above is None:
+            above = [0]*len(self.dist)
+            acc = 0
+            for i in range(len(self.dist) - 1, -1, -1):
+                acc += self.dist[i]
+                above[i] = acc
+            self.above = above
+        return self.above
 
     def get_hits_above(self, time):
-        return self.shape[int(time/QOS_SHAPE_RESOLUTION)]
+        """ hits of the bucket holding time and above, times past the last
+            bucket start give the hits of the last bucket
+        """
+        return self.get_cumulative()[self.index(time)]
         
     def get_hits_pc_above(self, time):
         return (float(self.get_hits_above(time)) / self.total_hits * 100)
 
+    def get_percentiles(self, percentiles):
+        """ returns the time under which each of the given percentages of the
+            hits fall, as the end of the bucket reaching it (the start of the
+            last bucket), or None for an empty shape. one pass on the buckets.
+        """
+        dist = self.dist
+        count = sum(dist)
+        results = [None] * len(percentiles)
+        if count == 0:
+            return results
+        ranks = []
+        for n in range(len(percentiles)):
+            rank = int(math.ceil(percentiles[n] / 100.0 * count))
+            ranks.append((max(rank, 1), n))
+        ranks.sort()
+
+        acc = 0
+        r = 0
+        for i in range(len(dist)):
+            acc += dist[i]
+            while r < len(ranks) and ranks[r][0] <= acc:
+                end = self.bucket_end(i)
+                if end is None:
+                    end = self.bucket_start(i)
+                results[ranks[r][1]] = end
+                r += 1
+            if r == len(ranks):
+                break
+        return results
+
+    def get_percentile(self, percentile):
+        return self.get_percentiles([percentile])[0]
+
     def get_dist(self):
-        dist = [0]*len(self.shape)
-        prev = 0
-        for i in range(len(self.shape) - 1, -1, -1):
-            dist[i] = self.shape[i] - prev
-            prev = self.shape[i]
-        return dist
+        return list(self.dist)
     
     def invert(self, values):
         res = [0] * len(values)
@@ -142,7 +384,7 @@ class QosShape:
     
     def show_histogram(self, aggregated=False, inverted=False, out=sys.stdout):
         if aggregated:
-            dist = self.shape
+            dist = self.get_cumulative()
         else:
             dist = self.get_dist()
         if inverted:
@@ -160,7 +402,7 @@ class QosShape:
                         print >> out,"  ...   |          |          |"
                     continue
                 else:
-                    print >> out,"% 5.2f   |          |          |     " % (i*QOS_SHAPE_RESOLUTION)
+                    print >> out,"% 5.2f   |          |          |     " % (self.bucket_start(i))
             else:
                 zero_count = 0
                 f = (float(dist[i]) / m) * QOS_SHAPE_HIST_WIDTH
@@ -169,19 +411,116 @@ class QosShape:
                     r = '-'
                 else:
                     r = ''
-                print >> out, "% 5.2f   |% 8d  | % 8.2f | %s" % (i * QOS_SHAPE_RESOLUTION, dist[i], float(dist[i]) / self.total_hits * 100, '#' * int(f) + r)
+                print >> out, "% 5.2f   |% 8d  | % 8.2f | %s" % (self.bucket_start(i), dist[i], float(dist[i]) / self.total_hits * 100, '#' * int(f) + r)
+
+class HdrQosShape(QosShape):
+    """ log-bucketed latency distribution: bucket 0 holds the hits faster
+        than min_time, bucket i the ones between min_time*base**(i-1) and
+        min_time*base**i with base = 1 + precision, the last bucket everything
+        from max_time on. any time in range is known within precision.
+    """
+    def __init__(self, min_time=QOS_SHAPE_HDR_MIN_TIME, max_time=QOS_SHAPE_HDR_MAX_TIME, precision=QOS_SHAPE_HDR_PRECISION):
+        self.min_time = min_time
+        self.max_time = max_time
+        self.precision = precision
+        self.inv_log_base = 1.0 / math.log(1.0 + precision)
+        self.last = 1 + int(math.ceil(math.log(float(max_time) / min_time) * self.inv_log_base))
+        self.dist = [0]*(self.last + 1)
+        self.total_hits = 0
+        self.above = None
+
+    def get_spec(self):
+        return (QOS_SHAPE_HDR, self.min_time, self.max_time, self.precision)
+
+    def new_shape(self):
+        return HdrQosShape(self.min_time, self.max_time, self.precision)
+
+    def index(self, time):
+        if time < self.min_time:
+            return 0
+        if time >= self.max_time:
+            return self.last
+        return min(1 + int(math.log(time / self.min_time) * self.inv_log_base), self.last - 1)
+
+    def bucket_start(self, i):
+        if i == 0:
+            return 0.0
+        if i >= self.last:
+            return self.max_time
+        return self.min_time * (1.0 + self.precision) ** (i - 1)
+
+    def bucket_end(self, i):
+        if i >= self.last:
+            return None
+        return min(self.min_time * (1.0 + self.precision) ** i, self.max_time)
+
+    def hit(self, time):
+        self.total_hits += 1
+        if time < 0:
+            return
+        self.dist[self.index(time)] += 1
+        self.above = None
+
 
 class WorkSet:
+    """ aggregate() and filter_aggregate() don't copy the pages they take from
+        the other workset: the urls of those shared pages are kept in borrowed,
+        and a shared page is only copied when it has to be modified.
+    """
     
-    def __init__(self):
+    def __init__(self, shape_spec=None):
         self.pages = {}
         self.nodes = {}
         self.total_hits = 0
         self.total_errors = 0
         self.total_ignored = 0
-        self.shape = QosShape()
+        self.shape_spec = shape_spec
+        self.shape = create_shape(shape_spec)
         self.metadata = {}
         self.http_codes = {}
+        self.borrowed = set()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('borrowed', None)
+        return state
+
+    def __getattr__(self, name):
+        # worksets pickled before copy-on-write
+        if name == 'borrowed':
+            self.borrowed = set()
+            return self.borrowed
+        if name == 'shape_spec':
+            return None
+        raise AttributeError(name)
+
+    def get_own_page(self, url):
+        """ returns the page of url, copied first if it is shared with another workset
+        """
+        page = self.pages[url]
+        if url in self.borrowed:
+            page = page.copy()
+            self.pages[url] = page
+            self.borrowed.discard(url)
+        return page
+
+    def merge_page(self, page, convert=False):
+        """ with convert, the page shape layout differs from ours: the page is
+            merged into one of our own pages instead of being shared
+        """
+        own_page = self.pages.get(page.url, None)
+        if own_page is None:
+            if convert:
+                own_page = Page(page.url, self.shape_spec)
+                self.pages[page.url] = own_page
+                own_page.aggregate(page)
+            else:
+                self.pages[page.url] = page
+                self.borrowed.add(page.url)
+        else:
+            if page.url in self.borrowed:
+                own_page = self.get_own_page(page.url)
+            own_page.aggregate(page)
 
     def hit(self, url, time, node_name=None, http_code=None):
         self.total_hits += 1
@@ -191,8 +530,10 @@ class WorkSet:
 
         page = self.pages.get(url, None)
         if page is None:
-            page = Page(url)
+            page = Page(url, self.shape_spec)
             self.pages[url] = page
+        elif self.borrowed and url in self.borrowed:
+            page = self.get_own_page(url)
 
         page.hit(time, node_name, http_code)
 
@@ -202,7 +543,7 @@ class WorkSet:
             if node_name is not None:
                 node = self.nodes.get(node_name, None)
                 if node is None:
-                    node = Node(node_name)
+                    node = Node(node_name, self.shape_spec)
                     self.nodes[node_name] = node
                 node.hit(time, http_code)
 
@@ -215,24 +556,40 @@ class WorkSet:
         self.total_ignored += 1
     
     def compare(self, other_workset, out=sys.stdout):
+        """ prints the change of the totals and of the global shape, the
+            page changes are ranked by compare.Comparison
+        """
         if self.total_hits != other_workset.total_hits:
             print >> out, "total_hits_diff: ", other_workset.total_hits - self.total_hits
         if self.total_errors != other_workset.total_errors:
             print >> out, "total_errors_diff: ", other_workset.total_errors - self.total_errors
 
-        self.shape.compare(other_workset.shape, out)
-        
-        for p in self.pages.keys():
-            if not other_workset.pages.has_key(p):
-                print >> out, "-" , p
-            else:
-                self.pages[p].compare(other_workset.pages[p], out)
-
-        for p in other_workset.pages.keys():
-            if not self.pages.has_key(p):
-                print >> out, "+", p, "hits:", other_workset.pages[p].hits
+        self.shape.compare(other_workset.shape, out=out)
     
+    def adopt_shape_spec(self, other_workset):
+        """ an empty workset takes the shape layout of the first workset
+            aggregated into it. returns True when the other workset pages
+            have to be converted to our layout.
+        """
+        spec = other_workset.shape.get_spec()
+        if spec == self.shape.get_spec():
+            return False
+        if self.total_hits == 0 and len(self.pages) == 0 and len(self.nodes) == 0:
+            self.shape_spec = spec
+            self.shape = create_shape(spec)
+            return False
+        return True
+
     def aggregate(self, other_workset):
+        # pages of an ArrayWorkSet are views on its columns, they are never shared
+        convert = self.adopt_shape_spec(other_workset) or isinstance(other_workset, ArrayWorkSet)
+        self.aggregate_totals(other_workset)
+
+        merge_page = self.merge_page
+        for page in other_workset.pages.itervalues():
+            merge_page(page, convert)
+
+    def aggregate_totals(self, other_workset):
         self.total_hits += other_workset.total_hits
         self.total_errors += other_workset.total_errors
         self.shape.aggregate(other_workset.shape)
@@ -245,14 +602,9 @@ class WorkSet:
         aggregate_nodes(self, other_workset)
         aggregate_http_codes(self, other_workset)
 
-        for p in other_workset.pages.keys():
-            if not self.pages.has_key(p):
-                self.pages[p] = other_workset.pages[p]
-            else:
-                self.pages[p].aggregate(other_workset.pages[p])
-
     # FIXME ? missing total_errors, http_codes aggregation ?
     def filter_aggregate(self, other_workset, filter_function, filter_arg, filter_options):
+        convert = self.adopt_shape_spec(other_workset) or isinstance(other_workset, ArrayWorkSet)
         for page in other_workset.pages.values():
             if not filter_function(filter_arg, page, filter_options):
                 continue
@@ -260,10 +612,13 @@ class WorkSet:
             self.total_hits += page.hits
             self.shape.aggregate(page.shape)
 
-            if not self.pages.has_key(page.url):
-                self.pages[page.url] = other_workset.pages[page.url]
-            else:
-                self.pages[page.url].aggregate(other_workset.pages[page.url])
+            self.merge_page(page, convert)
+
+    def iter_hits_above(self, time):
+        """ yields (page, hits of the page shape bucket holding time and above)
+        """
+        for page in self.pages.itervalues():
+            yield page, page.shape.get_hits_above(time)
 
     def summary(self, out=sys.stdout):
         print >> out, "WorkSet Summary"
@@ -273,9 +628,10 @@ class WorkSet:
             print >> out, "\tTotal ignored hits: %d" % (self.total_ignored)
         except:
             pass
-        print >> out, "\tDistinct pages:", len(self.pages.keys())
+        print >> out, "\tDistinct pages:", self.get_page_count()
         print >> out, "\tAbove 0.5:", self.shape.get_hits_above(0.5)
         print >> out, "\tAbove 1.5:", self.shape.get_hits_above(1.5)
+        print >> out, "\tPercentiles:", format_percentiles(self.shape)
         print >> out, "\n\tPer-Node\t\thits\t0.5\t1.5"
         for i in self.nodes.values():
             print >> out, "\t%s\t%d\t%d\t%d" % (i.name, i.hits, i.shape.get_hits_above(0.5),  i.shape.get_hits_above(1.5))
@@ -291,10 +647,7 @@ class WorkSet:
         if self.total_errors > self.total_hits:
             logging.warn("is_valid: total_errors is greater than total_hits")
             return False
-        pages_total_hits = 0
-        for p in self.pages.values():
-            pages_total_hits += p.hits
-        if pages_total_hits != self.total_hits:
+        if self.get_pages_total_hits() != self.total_hits:
             logging.warn("is_valid: total_hits and pages total hits differ")
         return True
 
@@ -302,12 +655,164 @@ class WorkSet:
         for p in self.pages.values():
             p.summary(out)
 
+    def get_page_count(self):
+        return len(self.pages)
+
+    def get_pages_total_hits(self):
+        pages_total_hits = 0
+        for p in self.pages.itervalues():
+            pages_total_hits += p.hits
+        return pages_total_hits
+
+
+class LazyWorkSet(WorkSet):
+    """ a workset of which only the file headers were read (see
+        WorkSetManager.load_lazy): totals, global shape, nodes, http codes
+        and metadata. the pages are loaded when first used.
+    """
+    def __init__(self, workset_manager, filename, segments):
+        WorkSet.__init__(self)
+        del self.pages
+        self.workset_manager = workset_manager
+        self.filename = filename
+        # (file name, page count) of the files whose headers were read
+        self.segments = segments
+
+    def __getattr__(self, name):
+        if name == 'pages':
+            logging.debug("LazyWorkSet: loading the pages of %s", self.filename)
+            self.pages = self.workset_manager.load(self.filename).pages
+            return self.pages
+        return WorkSet.__getattr__(self, name)
+
+    def is_loaded(self):
+        return self.__dict__.has_key('pages')
+
+    def get_page_count(self):
+        # the pages of several segments may share urls
+        if self.is_loaded() or len(self.segments) != 1:
+            return WorkSet.get_page_count(self)
+        return self.segments[0][1]
+
+    def get_pages_total_hits(self):
+        if self.is_loaded():
+            return WorkSet.get_pages_total_hits(self)
+        pages_total_hits = 0
+        for filename, dummy in self.segments:
+            column_file = wsfile.WorkSetFile(filename)
+            try:
+                pages_total_hits += sum(column_file.get_column('hits'))
+            finally:
+                column_file.close()
+        return pages_total_hits
+
     
 class WorkSetManager:
-    def __init__(self):
-        pass
+    """ loads and saves workset files. a workset file can be followed by delta
+        segments (FILE.d1, FILE.d2, ...) that load() merges transparently;
+        compact() folds them into the base file. the base metadata keeps the
+        last folded delta number so leftover segments are never counted twice.
+        with STORAGE_ARRAYS, columnar files are loaded as ArrayWorkSet.
+        columnar files are saved with a url index unless url_index is False.
+    """
+    # whether aggregations may load files in worker processes
+    parallel = True
+
+    def __init__(self, save_format=FORMAT_COLUMNAR, storage=STORAGE_ARRAYS, url_index=True):
+        self.save_format = save_format
+        self.storage = storage
+        self.url_index = url_index
+
+    def new_workset(self, shape_spec=None):
+        """ returns an empty workset using our storage, for aggregations
+        """
+        if self.storage == STORAGE_ARRAYS:
+            return ArrayWorkSet(shape_spec)
+        return WorkSet(shape_spec)
     
-    def load(self, worksetfilename):
+    def load(self, worksetfilename, url_filter=None):
+        """ with url_filter, a function of the page url, only the accepted
+            pages are loaded (the workset totals are still complete)
+        """
+        deltas = self.get_deltas(worksetfilename)
+        if len(deltas) == 0:
+            return self.load_file(worksetfilename, url_filter)
+
+        try:
+            wkset = self.load_file(worksetfilename, url_filter)
+        except IOError:
+            wkset = None
+
+        folded_seq = 0
+        if wkset is not None:
+            folded_seq = wkset.metadata.get("delta_seq", 0)
+        for seq, delta_filename in deltas:
+            if seq <= folded_seq:
+                continue
+            delta = self.load_file(delta_filename, url_filter)
+            if wkset is None:
+                wkset = delta
+            else:
+                wkset.aggregate(delta)
+        return wkset
+
+    def load_lazy(self, worksetfilename):
+        """ returns a LazyWorkSet, reading only the headers of the workset
+            file and of its delta segments. a file in the pickle format has
+            no separate header, it is loaded whole.
+        """
+        # (delta number, file name), 0 for the base file
+        files = self.get_deltas(worksetfilename)
+        if len(files) == 0 or os.path.isfile(worksetfilename):
+            files.insert(0, (0, worksetfilename))
+        for seq, filename in files:
+            if not wsfile.is_workset_file(filename):
+                return self.load(worksetfilename)
+
+        started = stats.start()
+        wkset = LazyWorkSet(self, worksetfilename, [])
+        try:
+            folded_seq = 0
+            for seq, filename in files:
+                if seq > 0 and seq <= folded_seq:
+                    continue
+                header_file = wsfile.WorkSetFile(filename)
+                try:
+                    if len(wkset.segments) == 0:
+                        header_file.fill_header(wkset)
+                        folded_seq = wkset.metadata.get("delta_seq", 0)
+                    else:
+                        segment = WorkSet()
+                        header_file.fill_header(segment)
+                        # see adopt_shape_spec, a file without hits has no pages
+                        if wkset.total_hits == 0 and len(wkset.nodes) == 0:
+                            wkset.shape_spec = segment.shape.get_spec()
+                            wkset.shape = create_shape(wkset.shape_spec)
+                        wkset.aggregate_totals(segment)
+                    wkset.segments.append((filename, header_file.page_count))
+                finally:
+                    header_file.close()
+            stats.count("headers_loaded", len(wkset.segments))
+        finally:
+            stats.stop("workset.load_header", started)
+        return wkset
+
+    def load_file(self, worksetfilename, url_filter=None):
+        started = stats.start()
+        stats.count("worksets_loaded")
+        try:
+            if wsfile.is_workset_file(worksetfilename):
+                return wsfile.read_workset(worksetfilename, url_filter, self.storage == STORAGE_ARRAYS)
+            wkset = self.load_pickle(worksetfilename)
+            if url_filter is not None:
+                for url in wkset.pages.keys():
+                    if not url_filter(url):
+                        del wkset.pages[url]
+            return wkset
+        finally:
+            stats.stop("workset.load", started)
+
+    def load_pickle(self, worksetfilename):
         try:
             try:
                 infile = gzip.open(worksetfilename, "rb")
@@ -323,26 +828,108 @@ class WorkSetManager:
         except cPickle.UnpicklingError, unpe:
             logging.warn("Could not load file [%s] (cPickle error)" % (worksetfilename))
             raise unpe
+
+    def load_metadata(self, worksetfilename):
+        if wsfile.is_workset_file(worksetfilename):
+            header_file = wsfile.WorkSetFile(worksetfilename)
+            try:
+                return header_file.get_header()['metadata']
+            finally:
+                header_file.close()
+        return self.load_file(worksetfilename).metadata
+
+    def get_deltas(self, worksetfilename):
+        """ returns the (number, file name) of the delta segments of a workset file
+        """
+        folder, base_name = os.path.split(worksetfilename)
+        prefix = base_name + DELTA_SUFFIX
+        try:
+            names = os.listdir(folder or '.')
+        except OSError:
+            return []
+        deltas = []
+        for name in names:
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                deltas.append((int(name[len(prefix):]), os.path.join(folder, name)))
+        deltas.sort()
+        return deltas
+
+    def get_next_delta_filename(self, filename):
+        """ returns the file name of the next delta segment of the workset
+            file filename
+        """
+        seq = 0
+        deltas = self.get_deltas(filename)
+        if len(deltas) > 0:
+            seq = deltas[-1][0]
+        if os.path.isfile(filename):
+            seq = max(seq, self.load_metadata(filename).get("delta_seq", 0))
+        return filename + DELTA_SUFFIX + str(seq + 1)
+
+    def save_delta(self, workset, filename):
+        """ saves workset as a new delta segment of the workset file filename
+        """
+        self.save(workset, self.get_next_delta_filename(filename))
+
+    def compact(self, filename):
+        """ folds the delta segments of filename into it
+        """
+        deltas = self.get_deltas(filename)
+        if len(deltas) == 0:
+            return
+        logging.debug("WorkSetManager: compacting %s (%d deltas)" % (filename, len(deltas)))
+        wkset = self.load(filename)
+        wkset.metadata["delta_seq"] = max(wkset.metadata.get("delta_seq", 0), deltas[-1][0])
+        # the deltas go once the folded file is on disk
+        self.save(wkset, filename, durable=True)
+        for seq, delta_filename in deltas:
+            os.unlink(delta_filename)
+
+    def open(self, worksetfilename):
+        """ opens a columnar workset file for direct (mmap) access
+        """
+        return wsfile.WorkSetFile(worksetfilename)
     
-    def save(self, workset, filename):
+    def save(self, workset, filename, durable=False):
+        """ with durable, the file and its name are on disk when save
+            returns
+        """
         logging.debug("WorkSetManager: saving %s" % (filename))
         
         util.makedirs_for_file(filename)
 
-        outfile = gzip.GzipFile(filename, "wb+", 5)
-        cPickle.dump(workset, outfile)
-        outfile.close()        
+        started = stats.start()
+        stats.count("worksets_saved")
+        try:
+            if self.save_format == FORMAT_COLUMNAR:
+                wsfile.write_workset(workset, filename, self.url_index, durable)
+                return
+
+            rawfile = open(filename, "wb+")
+            try:
+                outfile = gzip.GzipFile(filename, "wb+", 5, rawfile)
+                cPickle.dump(workset, outfile)
+                outfile.close()
+                if durable:
+                    rawfile.flush()
+                    os.fsync(rawfile.fileno())
+            finally:
+                rawfile.close()
+            if durable:
+                util.fsync_dir(os.path.dirname(filename))
+        finally:
+            stats.stop("workset.save", started)
 
 
 class Page:
-    def __init__(self, url):
+    def __init__(self, url, shape_spec=None):
         self.url = url
         self.max_time = 0
         self.min_time = 100000
         self.hits = 0
         self.total_time = 0
         self.errors = 0
-        self.shape = QosShape()
+        self.shape = create_shape(shape_spec)
         self.nodes = {}
         self.http_codes = {}
 
@@ -360,9 +947,21 @@ class Page:
         aggregate_http_codes(self, other_page)        
 
 
-    def compare(self, other_page, out=sys.stdout):
-        if self.hits != other_page.hits:
-            print >> out, "Page", self.url, "hits_diff", other_page.hits-self.hits
+    def copy(self):
+        page = Page(self.url)
+        page.max_time = self.max_time
+        page.min_time = self.min_time
+        page.hits = self.hits
+        page.total_time = self.total_time
+        page.errors = self.errors
+        page.shape = self.shape.copy()
+        try:
+            for name, node in self.nodes.iteritems():
+                page.nodes[name] = node.copy()
+            page.http_codes = self.http_codes.copy()
+        except AttributeError:
+            pass
+        return page
 
     def hit(self, time, node_name=None, http_code=None):
         self.hits += 1
@@ -374,7 +973,7 @@ class Page:
 
         if time > self.max_time:
             self.max_time = time
-        elif time < self.min_time:
+        if time < self.min_time:
             self.min_time = time
 
         self.shape.hit(time)
@@ -383,7 +982,7 @@ class Page:
             if node_name is not None:
                 node = self.nodes.get(node_name, None)
                 if node is None:
-                    node = Node(node_name)
+                    node = Node(node_name, self.shape.get_spec())
                     self.nodes[node_name] = node
                 node.hit(time, http_code)
         except AttributeError:
@@ -406,14 +1005,14 @@ class Page:
         print >> out, "%s hits: %d errors: %d max: %d min: %d above.5: %d %s" % (self.url, self.hits, self.errors, self.max_time, self.min_time, self.shape.get_hits_above(0.5), http_code_summary)
 
 class Node:
-    def __init__(self, node_name):
+    def __init__(self, node_name, shape_spec=None):
         self.name = node_name.strip()
         self.max_time = 0
         self.min_time = 100000
         self.hits = 0
         self.total_time = 0
         self.errors = 0
-        self.shape = QosShape()
+        self.shape = create_shape(shape_spec)
         self.http_codes = {}
 
     def export(self, out=sys.stdout):
@@ -428,10 +1027,20 @@ class Node:
         self.errors += other_node.errors
         aggregate_http_codes(self, other_node)
         
-    def compare(self, other_node, out=sys.stdout):
-        if self.hits != other_node.hits:
-            print >> out, "Node", self.name, "hits_diff", other_node.hits-self.hits
-        
+    def copy(self):
+        node = Node(self.name)
+        node.max_time = self.max_time
+        node.min_time = self.min_time
+        node.hits = self.hits
+        node.total_time = self.total_time
+        node.errors = self.errors
+        node.shape = self.shape.copy()
+        try:
+            node.http_codes = self.http_codes.copy()
+        except AttributeError:
+            pass
+        return node
+
     def hit(self, time, http_code=None):
         self.hits += 1
         
@@ -442,7 +1051,7 @@ class Node:
         self.total_time += time
         if time > self.max_time:
             self.max_time = time
-        elif time < self.min_time:
+        if time < self.min_time:
             self.min_time = time
         
         self.shape.hit(time)
@@ -452,3 +1061,519 @@ class Node:
                 self.http_codes[http_code] = self.http_codes.get(http_code, 0) + 1
         except AttributeError:
             pass
+
+
+class RowColumns:
+    """ struct-of-arrays counters, one row per page (or per page node): hits,
+        errors, min/max/total times, shape total hits, width shape buckets per
+        row laid out like template, and one column per http code seen
+    """
+    def __init__(self, shape_spec=None):
+        self.template = create_shape(shape_spec)
+        self.spec = self.template.get_spec()
+        self.width = len(self.template.dist)
+        self.zero_shape = array.array(COUNT_TYPECODE, [0]) * self.width
+        self.hits = array.array(COUNT_TYPECODE)
+        self.errors = array.array(COUNT_TYPECODE)
+        self.min_times = array.array(TIME_TYPECODE)
+        self.max_times = array.array(TIME_TYPECODE)
+        self.total_times = array.array(TIME_TYPECODE)
+        self.shape_hits = array.array(COUNT_TYPECODE)
+        self.shape = array.array(COUNT_TYPECODE)
+        self.codes = {}
+        self.count = 0
+
+    def add_row(self):
+        self.hits.append(0)
+        self.errors.append(0)
+        self.min_times.append(100000)
+        self.max_times.append(0)
+        self.total_times.append(0)
+        self.shape_hits.append(0)
+        self.shape.extend(self.zero_shape)
+        for column in self.codes.itervalues():
+            column.append(0)
+        self.count += 1
+        return self.count - 1
+
+    def reset_row(self, row):
+        self.hits[row] = 0
+        self.errors[row] = 0
+        self.min_times[row] = 100000
+        self.max_times[row] = 0
+        self.total_times[row] = 0
+        self.shape_hits[row] = 0
+        self.shape[row * self.width:(row + 1) * self.width] = self.zero_shape
+        for column in self.codes.itervalues():
+            column[row] = 0
+
+    def get_code_column(self, code):
+        column = self.codes.get(code, None)
+        if column is None:
+            column = array.array(COUNT_TYPECODE, [0]) * self.count
+            self.codes[code] = column
+        return column
+
+    def hit(self, row, time, http_code=None):
+        self.hits[row] += 1
+        if time == 0:
+            self.errors[row] += 1
+            return
+        self.total_times[row] += time
+        if time > self.max_times[row]:
+            self.max_times[row] = time
+        if time < self.min_times[row]:
+            self.min_times[row] = time
+
+        self.shape_hits[row] += 1
+        if time >= 0:
+            self.shape[row * self.width + self.template.index(time)] += 1
+
+        if http_code is not None:
+            self.get_code_column(http_code)[row] += 1
+
+    def add_shape(self, row, spec, values, other_shape):
+        """ adds the buckets values of other_shape (of layout spec) to row
+        """
+        shape = self.shape
+        base = row * self.width
+        if spec == self.spec:
+            for i in xrange(self.width):
+                if values[i]:
+                    shape[base + i] += values[i]
+            return
+        index = self.template.index
+        for i in xrange(len(values)):
+            if values[i]:
+                shape[base + index(other_shape.bucket_middle(i))] += values[i]
+
+    def merge_row(self, row, other, other_row):
+        """ adds other_row of the other columns to row
+        """
+        self.hits[row] += other.hits[other_row]
+        self.errors[row] += other.errors[other_row]
+        self.total_times[row] += other.total_times[other_row]
+        if other.max_times[other_row] > self.max_times[row]:
+            self.max_times[row] = other.max_times[other_row]
+        if other.min_times[other_row] < self.min_times[row]:
+            self.min_times[row] = other.min_times[other_row]
+        self.shape_hits[row] += other.shape_hits[other_row]
+        start = other_row * other.width
+        self.add_shape(row, other.spec, other.shape[start:start + other.width], other.template)
+        for code, column in other.codes.iteritems():
+            if column[other_row]:
+                self.get_code_column(code)[row] += column[other_row]
+
+    def merge_object(self, row, obj):
+        """ adds the counters of a Page or Node to row
+        """
+        self.hits[row] += obj.hits
+        self.errors[row] += obj.errors
+        self.total_times[row] += obj.total_time
+        if obj.max_time > self.max_times[row]:
+            self.max_times[row] = obj.max_time
+        if obj.min_time < self.min_times[row]:
+            self.min_times[row] = obj.min_time
+        shape = obj.shape
+        self.shape_hits[row] += shape.total_hits
+        self.add_shape(row, shape.get_spec(), shape.dist, shape)
+        try:
+            for code, count in obj.http_codes.iteritems():
+                self.get_code_column(code)[row] += count
+        except AttributeError:
+            pass
+
+    def copy(self):
+        columns = RowColumns(self.spec)
+        for name in ('hits', 'errors', 'min_times', 'max_times', 'total_times', 'shape_hits', 'shape'):
+            setattr(columns, name, getattr(self, name)[:])
+        for code, column in self.codes.iteritems():
+            columns.codes[code] = column[:]
+        columns.count = self.count
+        return columns
+
+    def get_shape(self, row):
+        shape = self.template.new_shape()
+        shape.dist = list(self.shape[row * self.width:(row + 1) * self.width])
+        shape.total_hits = self.shape_hits[row]
+        return shape
+
+    def get_http_codes(self, row):
+        http_codes = {}
+        for code, column in self.codes.iteritems():
+            if column[row]:
+                http_codes[code] = column[row]
+        return http_codes
+
+
+VIEW_COLUMNS = { 'hits': 'hits', 'errors': 'errors', 'min_time': 'min_times', 'max_time': 'max_times', 'total_time': 'total_times' }
+
+class ColumnsView:
+    """ counters read from and written to a row of RowColumns. shape and
+        http_codes are built on each access: update them through hit() and
+        aggregate().
+    """
+    def __getattr__(self, name):
+        columns = self.__dict__['columns']
+        row = self.__dict__['row']
+        column = VIEW_COLUMNS.get(name, None)
+        if column is not None:
+            return getattr(columns, column)[row]
+        if name == 'shape':
+            return columns.get_shape(row)
+        if name == 'http_codes':
+            return columns.get_http_codes(row)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        column = VIEW_COLUMNS.get(name, None)
+        if column is None:
+            raise AttributeError("%s is read only" % (name))
+        getattr(self.columns, column)[self.row] = value
+
+    def copy_counters(self, obj):
+        obj.hits = self.hits
+        obj.errors = self.errors
+        obj.min_time = self.min_time
+        obj.max_time = self.max_time
+        obj.total_time = self.total_time
+        obj.shape = self.shape
+        obj.http_codes = self.http_codes
+        return obj
+
+class PageView(ColumnsView, Page):
+    """ a page of an ArrayWorkSet, copy() returns a standalone Page
+    """
+    def __init__(self, wkset, page_id):
+        self.__dict__['wkset'] = wkset
+        self.__dict__['page_id'] = page_id
+        self.__dict__['columns'] = wkset.page_columns
+        self.__dict__['row'] = page_id
+
+    def __getattr__(self, name):
+        if name == 'url':
+            return self.wkset.urls[self.page_id]
+        if name == 'nodes':
+            return self.wkset.get_page_nodes(self.page_id)
+        return ColumnsView.__getattr__(self, name)
+
+    def hit(self, time, node_name=None, http_code=None):
+        self.wkset.hit_page(self.page_id, time, node_name, http_code)
+
+    def aggregate(self, other_page):
+        self.wkset.merge_page_object(self.page_id, other_page)
+
+    def copy(self):
+        page = self.copy_counters(Page(self.url))
+        for name, node in self.nodes.iteritems():
+            page.nodes[name] = node.copy()
+        return page
+
+class NodeView(ColumnsView, Node):
+    """ the counters of a node for a page of an ArrayWorkSet
+    """
+    def __init__(self, wkset, slot, node_name):
+        self.__dict__['columns'] = wkset.node_columns
+        self.__dict__['row'] = slot
+        self.__dict__['name'] = node_name.strip()
+
+    def hit(self, time, http_code=None):
+        self.columns.hit(self.row, time, http_code)
+
+    def aggregate(self, other_node):
+        self.columns.merge_object(self.row, other_node)
+
+    def copy(self):
+        return self.copy_counters(Node(self.name))
+
+class PageMap:
+    """ dict-like access to the pages of an ArrayWorkSet: url -> PageView
+    """
+    def __init__(self, wkset):
+        self.wkset = wkset
+
+    def __len__(self):
+        return len(self.wkset.url_ids)
+
+    def __contains__(self, url):
+        return url in self.wkset.url_ids
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.wkset.url_ids)
+
+    def keys(self):
+        return self.wkset.url_ids.keys()
+
+    def __getitem__(self, url):
+        return PageView(self.wkset, self.wkset.url_ids[url])
+
+    def get(self, url, default=None):
+        page_id = self.wkset.url_ids.get(url, None)
+        if page_id is None:
+            return default
+        return PageView(self.wkset, page_id)
+
+    def itervalues(self):
+        wkset = self.wkset
+        for page_id in wkset.url_ids.itervalues():
+            yield PageView(wkset, page_id)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        wkset = self.wkset
+        for url, page_id in wkset.url_ids.iteritems():
+            yield url, PageView(wkset, page_id)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __setitem__(self, url, page):
+        self.wkset.set_page(url, page)
+
+    def __delitem__(self, url):
+        self.wkset.remove_page(url)
+
+class ArrayWorkSet(WorkSet):
+    """ WorkSet keeping its pages in columns instead of Page objects: urls
+        are interned to page ids indexing page_columns, the per page node
+        counters are rows of node_columns found through node_slots.
+        pages gives PageView objects built on demand. the workset totals,
+        global shape and nodes are the same as in WorkSet.
+    """
+    def __init__(self, shape_spec=None):
+        WorkSet.__init__(self, shape_spec)
+        self.reset_pages()
+
+    def reset_pages(self):
+        self.urls = []
+        self.url_ids = {}
+        self.page_columns = RowColumns(self.shape_spec)
+        self.node_names = []
+        self.node_ids = {}
+        self.node_slots = {}
+        self.node_columns = RowColumns(self.shape_spec)
+        self.pages = PageMap(self)
+
+    def __getstate__(self):
+        state = WorkSet.__getstate__(self)
+        del state['pages']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pages = PageMap(self)
+
+    def add_page(self, url):
+        page_id = self.page_columns.add_row()
+        self.urls.append(url)
+        self.url_ids[url] = page_id
+        return page_id
+
+    def get_node_slot(self, page_id, node_name):
+        node_id = self.node_ids.get(node_name, None)
+        if node_id is None:
+            node_id = len(self.node_names)
+            self.node_names.append(node_name)
+            self.node_ids[node_name] = node_id
+        key = (page_id << NODE_ID_BITS) | node_id
+        slot = self.node_slots.get(key, None)
+        if slot is None:
+            slot = self.node_columns.add_row()
+            self.node_slots[key] = slot
+        return slot
+
+    def get_page_nodes(self, page_id):
+        nodes = {}
+        base = page_id << NODE_ID_BITS
+        for node_id in range(len(self.node_names)):
+            slot = self.node_slots.get(base | node_id, None)
+            if slot is not None:
+                nodes[self.node_names[node_id]] = NodeView(self, slot, self.node_names[node_id])
+        return nodes
+
+    def get_own_page(self, url):
+        return self.pages[url]
+
+    def get_page_slots(self, page_id):
+        """ returns the (node_slots key, node row) of the nodes of a page
+        """
+        slots = []
+        base = page_id << NODE_ID_BITS
+        for node_id in range(len(self.node_names)):
+            slot = self.node_slots.get(base | node_id, None)
+            if slot is not None:
+                slots.append((base | node_id, slot))
+        return slots
+
+    def set_page(self, url, page):
+        """ replaces the counters of url by those of page, in the rows url
+            already has
+        """
+        page_id = self.url_ids.get(url, None)
+        if page_id is None:
+            self.merge_page_object(self.add_page(url), page)
+            return
+        if isinstance(page, PageView) and page.wkset is self:
+            page = page.copy()
+        self.page_columns.reset_row(page_id)
+        slots = self.get_page_slots(page_id)
+        for key, slot in slots:
+            self.node_columns.reset_row(slot)
+        self.merge_page_object(page_id, page)
+        # the nodes page doesn't have
+        for key, slot in slots:
+            if self.node_columns.hits[slot] == 0:
+                del self.node_slots[key]
+        self.compact_rows(False)
+
+    def remove_page(self, url):
+        page_id = self.url_ids.pop(url)
+        for key, slot in self.get_page_slots(page_id):
+            del self.node_slots[key]
+        self.urls[page_id] = None
+        self.compact_rows(False)
+
+    def get_dead_rows(self):
+        """ the rows of the removed pages and nodes, see compact_rows
+        """
+        return len(self.urls) - len(self.url_ids) + self.node_columns.count - len(self.node_slots)
+
+    def compact_rows(self, always=True):
+        """ drops the rows of the removed pages and nodes, unless they are
+            less than a quarter of the rows in use and always is False
+        """
+        dead_rows = self.get_dead_rows()
+        if dead_rows == 0 or (not always and dead_rows * 4 <= len(self.url_ids) + len(self.node_slots)):
+            return
+        compacted = ArrayWorkSet(self.shape_spec)
+        page_ids = self.url_ids.values()
+        page_ids.sort()
+        compacted.merge_rows(self, page_ids)
+        for name in ('urls', 'url_ids', 'page_columns', 'node_names', 'node_ids', 'node_slots', 'node_columns'):
+            setattr(self, name, getattr(compacted, name))
+
+    def hit(self, url, time, node_name=None, http_code=None):
+        self.total_hits += 1
+        if time == 0 and http_code == 0:
+            self.total_errors += 1
+            return
+
+        page_id = self.url_ids.get(url, None)
+        if page_id is None:
+            page_id = self.add_page(url)
+        self.hit_page(page_id, time, node_name, http_code)
+
+        self.shape.hit(time)
+
+        if node_name is not None:
+            node = self.nodes.get(node_name, None)
+            if node is None:
+                node = Node(node_name, self.shape_spec)
+                self.nodes[node_name] = node
+            node.hit(time, http_code)
+
+        if http_code is not None:
+            self.http_codes[http_code] = self.http_codes.get(http_code, 0) + 1
+
+    def hit_page(self, page_id, time, node_name=None, http_code=None):
+        self.page_columns.hit(page_id, time, http_code)
+        if time != 0 and node_name is not None:
+            self.node_columns.hit(self.get_node_slot(page_id, node_name), time, http_code)
+
+    def merge_page_object(self, page_id, page):
+        self.page_columns.merge_object(page_id, page)
+        try:
+            for node_name, node in page.nodes.iteritems():
+                self.node_columns.merge_object(self.get_node_slot(page_id, node_name.rstrip('\r\n')), node)
+        except AttributeError:
+            pass
+
+    def merge_page(self, page, convert=False):
+        page_id = self.url_ids.get(page.url, None)
+        if page_id is None:
+            page_id = self.add_page(page.url)
+        self.merge_page_object(page_id, page)
+
+    def merge_rows(self, other_workset, page_ids=None):
+        """ merges the given pages (all of them by default) of another ArrayWorkSet
+        """
+        if page_ids is None:
+            if len(self.urls) == 0 and self.page_columns.spec == other_workset.page_columns.spec \
+                    and other_workset.get_dead_rows() == 0:
+                self.copy_rows(other_workset)
+                return
+            page_ids = other_workset.url_ids.itervalues()
+        mapping = array.array(COUNT_TYPECODE, [-1]) * other_workset.page_columns.count
+        merge_row = self.page_columns.merge_row
+        other_columns = other_workset.page_columns
+        for other_id in page_ids:
+            url = other_workset.urls[other_id]
+            page_id = self.url_ids.get(url, None)
+            if page_id is None:
+                page_id = self.add_page(url)
+            merge_row(page_id, other_columns, other_id)
+            mapping[other_id] = page_id
+
+        mask = (1 << NODE_ID_BITS) - 1
+        for key, other_slot in other_workset.node_slots.iteritems():
+            page_id = mapping[key >> NODE_ID_BITS]
+            if page_id < 0:
+                continue
+            slot = self.get_node_slot(page_id, other_workset.node_names[key & mask])
+            self.node_columns.merge_row(slot, other_workset.node_columns, other_slot)
+
+    def copy_rows(self, other_workset):
+        self.urls = list(other_workset.urls)
+        self.url_ids = other_workset.url_ids.copy()
+        self.page_columns = other_workset.page_columns.copy()
+        self.node_names = list(other_workset.node_names)
+        self.node_ids = other_workset.node_ids.copy()
+        self.node_slots = other_workset.node_slots.copy()
+        self.node_columns = other_workset.node_columns.copy()
+
+    def adopt_shape_spec(self, other_workset):
+        WorkSet.adopt_shape_spec(self, other_workset)
+        if self.page_columns.spec != self.shape.get_spec() and len(self.urls) == 0:
+            self.reset_pages()
+        # the columns convert other layouts themselves
+        return False
+
+    def aggregate(self, other_workset):
+        self.adopt_shape_spec(other_workset)
+        self.aggregate_totals(other_workset)
+        if isinstance(other_workset, ArrayWorkSet):
+            self.merge_rows(other_workset)
+        else:
+            merge_page = self.merge_page
+            for page in other_workset.pages.itervalues():
+                merge_page(page)
+
+    def filter_aggregate(self, other_workset, filter_function, filter_arg, filter_options):
+        if not isinstance(other_workset, ArrayWorkSet):
+            return WorkSet.filter_aggregate(self, other_workset, filter_function, filter_arg, filter_options)
+
+        self.adopt_shape_spec(other_workset)
+        page_ids = []
+        for page in other_workset.pages.itervalues():
+            if not filter_function(filter_arg, page, filter_options):
+                continue
+            self.total_hits += page.hits
+            self.shape.aggregate(page.shape)
+            page_ids.append(page.page_id)
+        self.merge_rows(other_workset, page_ids)
+
+    def iter_hits_above(self, time):
+        """ same as WorkSet.iter_hits_above, summing the bucket slices of the
+            shape column instead of building the page shapes
+        """
+        columns = self.page_columns
+        shape = columns.shape
+        width = columns.width
+        start = columns.template.index(time)
+        for page_id in self.url_ids.itervalues():
+            base = page_id * width
+            yield PageView(self, page_id), sum(shape[base + start:base + width])
@@ -0,0 +1,780 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-15 -*-
+"""
+wsfile: columnar, memory-mappable workset file format
+
+layout (all integers little-endian):
+    preamble        magic, version, flags, section count
+    section table   one (name, offset, length) entry per section
+    sections        8-byte aligned
+
+sections:
+    header          pickled dict: totals, http_codes, global shape, nodes, metadata
+    urloff, urls    sorted URL string table (page_count+1 offsets into the url blob)
+    hits, errors    uint64 per page
+    mintime, maxtime, tottime
+                    float64 per page
+    shits, shape    uint64 per page shape total hits, uint64 page_count*shape_width buckets
+                    (the page shapes have the bucket layout of the global shape)
+    pcidx, pccode, pccount
+                    sparse per-page http codes: rows pcidx[i]:pcidx[i+1] belong to page i
+    nkeys           uint64 per page node: page_id << workset.NODE_ID_BITS | node id, sorted
+                    (node ids index the header node_names list)
+    nhits, nerrors, nmintime, nmaxtime, ntottime, nshits, nshape, npcidx, npccode, npccount
+                    the page node counters, laid out like the page ones
+    tgkeys, tgoff, tgpages
+                    optional url trigram index (see urlindex): uint64 sorted trigram keys,
+                    offsets into tgpages, uint32 page ids
+
+version 1 files have a pnodes section instead of the n* ones: pickled
+{page_id: nodes} for the pages that have per-node counters.
+"""
+
+import sys
+import os
+import mmap
+import array
+import struct
+import bisect
+import cPickle
+import itertools
+
+import util
+import urlindex
+import workset
+
+MAGIC = "QOSWSBIN"
+VERSION = 2
+
+PREAMBLE = struct.Struct("<8sHHI")
+SECTION_ENTRY = struct.Struct("<8sQQ")
+ALIGNMENT = 8
+
+# WorkSetFile reads rows one by one when it needs less than 1/ROW_READ_RATIO of them
+ROW_READ_RATIO = 64
+
+U64_FORMAT = "<Q"
+F64_FORMAT = "<d"
+
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+def _native_typecode(kind, size=8):
+    """ returns an array typecode holding size-byte items of the given kind
+        ('u' unsigned, 'i' signed, 'f' float) or None if the platform has none
+    """
+    candidates = { 'u': ('L', 'I'), 'i': ('l', 'i'), 'f': ('d',) }[kind]
+    for typecode in candidates:
+        if array.array(typecode).itemsize == size:
+            return typecode
+    return None
+
+# 'u4' is the 4-byte unsigned kind, for page ids
+TYPECODES = {
+    'u': _native_typecode('u'),
+    'i': _native_typecode('i'),
+    'f': _native_typecode('f'),
+    'u4': _native_typecode('u', 4),
+}
+
+STRUCT_CODES = { 'u': 'Q', 'i': 'q', 'f': 'd', 'u4': 'I' }
+ITEM_SIZES = { 'u': 8, 'i': 8, 'f': 8, 'u4': 4 }
+
+def is_workset_file(filename):
+    try:
+        infile = open(filename, "rb")
+        try:
+            return infile.read(len(MAGIC)) == MAGIC
+        finally:
+            infile.close()
+    except IOError:
+        return False
+
+def pack_column(kind, values):
+    """ packs a sequence of numbers as little-endian items
+    """
+    typecode = TYPECODES[kind]
+    if typecode is not None:
+        column = array.array(typecode, values)
+        if not LITTLE_ENDIAN:
+            column.byteswap()
+        return column.tostring()
+    return struct.pack("<%d%s" % (len(values), STRUCT_CODES[kind]), *values)
+
+def unpack_column(kind, buf, offset, count):
+    """ reads count little-endian items starting at offset
+    """
+    typecode = TYPECODES[kind]
+    if typecode is not None:
+        column = array.array(typecode)
+        column.fromstring(buffer(buf, offset, ITEM_SIZES[kind]*count))
+        if not LITTLE_ENDIAN:
+            column.byteswap()
+        return column
+    return list(struct.unpack_from("<%d%s" % (count, STRUCT_CODES[kind]), buf, offset))
+
+
+class WorkSetFileWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.sections = []
+
+    def add(self, name, data):
+        self.sections.append((name, data))
+
+    def write(self, durable=False):
+        """ with durable, the file is on disk when write returns
+        """
+        util.makedirs_for_file(self.filename)
+        tmp_filename = self.filename + ".tmp"
+        outfile = open(tmp_filename, "wb")
+        try:
+            offset = PREAMBLE.size + SECTION_ENTRY.size * len(self.sections)
+            table = []
+            for name, data in self.sections:
+                offset += (-offset) % ALIGNMENT
+                table.append((name, offset, len(data)))
+                offset += len(data)
+
+            outfile.write(PREAMBLE.pack(MAGIC, VERSION, 0, len(self.sections)))
+            for entry in table:
+                outfile.write(SECTION_ENTRY.pack(*entry))
+            position = PREAMBLE.size + SECTION_ENTRY.size * len(self.sections)
+            for (name, data), (dummy, offset, length) in zip(self.sections, table):
+                outfile.write('\0' * (offset - position))
+                outfile.write(data)
+                position = offset + length
+            if durable:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        finally:
+            outfile.close()
+        os.rename(tmp_filename, self.filename)
+        if durable:
+            util.fsync_dir(os.path.dirname(self.filename))
+
+
+class ColumnBlock:
+    """ counters of a list of pages or page nodes, written as the sections
+        PREFIX+hits, errors, mintime, maxtime, tottime, shits, shape and the
+        sparse http codes pcidx, pccode, pccount
+    """
+    def __init__(self, shape_width):
+        self.shape_width = shape_width
+        self.hits = []
+        self.errors = []
+        self.min_times = []
+        self.max_times = []
+        self.total_times = []
+        self.shape_hits = []
+        self.shape = array.array(workset.COUNT_TYPECODE)
+        self.pc_index = [0]
+        self.pc_codes = []
+        self.pc_counts = []
+
+    def add_object(self, obj, label):
+        """ adds a Page or Node
+        """
+        self.hits.append(obj.hits)
+        self.errors.append(obj.errors)
+        self.min_times.append(obj.min_time)
+        self.max_times.append(obj.max_time)
+        self.total_times.append(obj.total_time)
+        self.shape_hits.append(obj.shape.total_hits)
+        if len(obj.shape.dist) != self.shape_width:
+            raise ValueError("[%s] shape width differs from the workset one" % (label))
+        self.shape.extend(obj.shape.dist)
+
+        http_codes = getattr(obj, 'http_codes', {})
+        codes = http_codes.keys()
+        codes.sort()
+        for code in codes:
+            self.pc_codes.append(code)
+            self.pc_counts.append(http_codes[code])
+        self.pc_index.append(len(self.pc_codes))
+
+    def add_rows(self, source, rows):
+        """ adds the given rows of a workset.RowColumns
+        """
+        width = self.shape_width
+        if source.width != width:
+            raise ValueError("row shape width differs from the workset one")
+        self.hits.extend([ source.hits[i] for i in rows ])
+        self.errors.extend([ source.errors[i] for i in rows ])
+        self.min_times.extend([ source.min_times[i] for i in rows ])
+        self.max_times.extend([ source.max_times[i] for i in rows ])
+        self.total_times.extend([ source.total_times[i] for i in rows ])
+        self.shape_hits.extend([ source.shape_hits[i] for i in rows ])
+        for i in rows:
+            self.shape.extend(source.shape[i * width:(i + 1) * width])
+
+        codes = source.codes.keys()
+        codes.sort()
+        code_columns = [ (code, source.codes[code]) for code in codes ]
+        for i in rows:
+            for code, column in code_columns:
+                if column[i]:
+                    self.pc_codes.append(code)
+                    self.pc_counts.append(column[i])
+            self.pc_index.append(len(self.pc_codes))
+
+    def add_sections(self, writer, prefix):
+        writer.add(prefix + "hits", pack_column('u', self.hits))
+        writer.add(prefix + "errors", pack_column('u', self.errors))
+        writer.add(prefix + "mintime", pack_column('f', self.min_times))
+        writer.add(prefix + "maxtime", pack_column('f', self.max_times))
+        writer.add(prefix + "tottime", pack_column('f', self.total_times))
+        writer.add(prefix + "shits", pack_column('u', self.shape_hits))
+        writer.add(prefix + "shape", pack_column('u', self.shape))
+        writer.add(prefix + "pcidx", pack_column('u', self.pc_index))
+        writer.add(prefix + "pccode", pack_column('i', self.pc_codes))
+        writer.add(prefix + "pccount", pack_column('u', self.pc_counts))
+
+
+class WorkSetColumns:
+    """ the columns of a workset file: urls, page counters and page node
+        counters, pages in url order
+    """
+    def __init__(self, shape_width):
+        self.url_offsets = [0]
+        self.url_blob = []
+        self.position = 0
+        self.pages = ColumnBlock(shape_width)
+        self.nodes = ColumnBlock(shape_width)
+        self.node_keys = []
+        self.node_names = []
+        self.node_ids = {}
+
+    def add_url(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        self.url_blob.append(url)
+        self.position += len(url)
+        self.url_offsets.append(self.position)
+
+    def get_node_id(self, node_name):
+        node_id = self.node_ids.get(node_name, None)
+        if node_id is None:
+            node_id = len(self.node_names)
+            self.node_names.append(node_name)
+            self.node_ids[node_name] = node_id
+        return node_id
+
+    def add_workset(self, workset_obj):
+        urls = workset_obj.pages.keys()
+        urls.sort()
+        for page_id in range(len(urls)):
+            page = workset_obj.pages[urls[page_id]]
+            self.add_url(page.url)
+            self.pages.add_object(page, page.url)
+
+            nodes = {}
+            for node_name, node in getattr(page, 'nodes', {}).iteritems():
+                # older worksets kept the line terminator in the node key
+                node_id = self.get_node_id(node_name.rstrip('\r\n'))
+                if nodes.has_key(node_id):
+                    node = node.copy()
+                    node.aggregate(nodes[node_id])
+                nodes[node_id] = node
+            node_ids = nodes.keys()
+            node_ids.sort()
+            for node_id in node_ids:
+                self.node_keys.append((page_id << workset.NODE_ID_BITS) | node_id)
+                self.nodes.add_object(nodes[node_id], page.url)
+
+    def add_array_workset(self, workset_obj):
+        pairs = workset_obj.url_ids.items()
+        pairs.sort()
+        rows = []
+        positions = {}
+        for url, row in pairs:
+            self.add_url(url)
+            positions[row] = len(rows)
+            rows.append(row)
+        self.pages.add_rows(workset_obj.page_columns, rows)
+
+        mask = (1 << workset.NODE_ID_BITS) - 1
+        slots = []
+        for key, slot in workset_obj.node_slots.iteritems():
+            position = positions.get(key >> workset.NODE_ID_BITS, None)
+            if position is not None:
+                slots.append(((position << workset.NODE_ID_BITS) | (key & mask), slot))
+        slots.sort()
+        self.node_keys = [ key for key, slot in slots ]
+        self.node_names = list(workset_obj.node_names)
+        self.nodes.add_rows(workset_obj.node_columns, [ slot for key, slot in slots ])
+
+
+def write_workset(workset_obj, filename, url_index=True, durable=False):
+    """ saves a WorkSet in the columnar format, pages sorted by url, with
+        the url trigram index unless url_index is False. see
+        WorkSetFileWriter.write for durable.
+    """
+    shape_width = len(workset_obj.shape.dist)
+    columns = WorkSetColumns(shape_width)
+    if isinstance(workset_obj, workset.ArrayWorkSet):
+        columns.add_array_workset(workset_obj)
+    else:
+        columns.add_workset(workset_obj)
+
+    header = {
+        'total_hits': workset_obj.total_hits,
+        'total_errors': workset_obj.total_errors,
+        'total_ignored': getattr(workset_obj, 'total_ignored', 0),
+        'shape': workset_obj.shape,
+        'nodes': getattr(workset_obj, 'nodes', {}),
+        'http_codes': getattr(workset_obj, 'http_codes', {}),
+        'metadata': workset_obj.metadata,
+        'page_count': len(columns.pages.hits),
+        'shape_width': shape_width,
+        'node_names': columns.node_names,
+    }
+
+    writer = WorkSetFileWriter(filename)
+    writer.add("header", cPickle.dumps(header, cPickle.HIGHEST_PROTOCOL))
+    writer.add("urloff", pack_column('u', columns.url_offsets))
+    writer.add("urls", ''.join(columns.url_blob))
+    columns.pages.add_sections(writer, "")
+    writer.add("nkeys", pack_column('u', columns.node_keys))
+    columns.nodes.add_sections(writer, "n")
+    if url_index:
+        keys, offsets, page_ids = urlindex.build_index(columns.url_blob)
+        writer.add("tgkeys", pack_column('u', keys))
+        writer.add("tgoff", pack_column('u', offsets))
+        writer.add("tgpages", pack_column('u4', page_ids))
+    writer.write(durable)
+
+
+class WorkSetFile:
+    """ read access to a columnar workset file through mmap: counters of a
+        single page or whole columns can be read without building Page
+        objects. opening one only reads its header.
+    """
+
+    COLUMN_KINDS = {
+        'hits': 'u',
+        'errors': 'u',
+        'mintime': 'f',
+        'maxtime': 'f',
+        'tottime': 'f',
+        'shits': 'u',
+    }
+
+    # RowColumns attribute -> section
+    ROW_COLUMNS = [
+        ('hits', 'hits'),
+        ('errors', 'errors'),
+        ('min_times', 'mintime'),
+        ('max_times', 'maxtime'),
+        ('total_times', 'tottime'),
+        ('shape_hits', 'shits'),
+    ]
+
+    def __init__(self, filename):
+        self.filename = filename
+        infile = open(filename, "rb")
+        try:
+            self.buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            infile.close()
+
+        magic, version, dummy, section_count = PREAMBLE.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("[%s] is not a workset file" % (filename))
+        if version > VERSION:
+            raise ValueError("[%s] uses unsupported workset file version %d" % (filename, version))
+        self.version = version
+
+        self.sections = {}
+        for i in range(section_count):
+            name, offset, length = SECTION_ENTRY.unpack_from(self.buf, PREAMBLE.size + i * SECTION_ENTRY.size)
+            self.sections[name.rstrip('\0')] = (offset, length)
+
+        self.header = None
+        self.header = self.get_header()
+        self.page_count = self.header['page_count']
+        self.shape_width = self.header['shape_width']
+        self.shape_spec = self.header['shape'].get_spec()
+        self.urls_offset = self.sections['urls'][0]
+        self.trigram_keys = None
+        self.trigram_offsets = None
+
+    def __getattr__(self, name):
+        # the url table is read on first use
+        if name == 'url_offsets':
+            self.url_offsets = self.get_section_column('urloff', 'u')
+            return self.url_offsets
+        raise AttributeError(name)
+
+    def close(self):
+        self.buf.close()
+
+    def get_section(self, name):
+        offset, length = self.sections[name]
+        return self.buf[offset:offset + length]
+
+    def get_section_column(self, name, kind):
+        offset, length = self.sections[name]
+        return unpack_column(kind, self.buf, offset, length / ITEM_SIZES[kind])
+
+    def get_header(self):
+        if self.header is None:
+            self.header = cPickle.loads(self.get_section("header"))
+        return self.header
+
+    def get_url(self, page_id):
+        return self.buf[self.urls_offset + self.url_offsets[page_id]:self.urls_offset + self.url_offsets[page_id + 1]]
+
+    def get_urls(self):
+        blob = self.get_section("urls")
+        offsets = self.url_offsets
+        return [ blob[offsets[i]:offsets[i + 1]] for i in xrange(self.page_count) ]
+
+    def find_url(self, url):
+        """ binary search in the sorted url table, returns a page id or None
+        """
+        lo = 0
+        hi = self.page_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_url(mid) < url:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.page_count and self.get_url(lo) == url:
+            return lo
+        return None
+
+    def has_url_index(self):
+        return self.sections.has_key('tgkeys')
+
+    def find_prefix(self, prefix):
+        """ returns the range of page ids whose url starts with prefix
+        """
+        table = UrlTable(self)
+        start = bisect.bisect_left(table, prefix)
+        # the smallest string above every one starting with prefix
+        while len(prefix) > 0 and prefix[-1] == '\xff':
+            prefix = prefix[:-1]
+        if len(prefix) == 0:
+            return start, self.page_count
+        return start, bisect.bisect_left(table, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+
+    def get_trigram_range(self, trigram):
+        """ returns the (start, end) range of the tgpages items listing the
+            pages whose lowercased url holds trigram
+        """
+        if self.trigram_keys is None:
+            self.trigram_keys = self.get_section_column('tgkeys', 'u')
+            self.trigram_offsets = self.get_section_column('tgoff', 'u')
+        key = urlindex.trigram_key(trigram)
+        i = bisect.bisect_left(self.trigram_keys, key)
+        if i == len(self.trigram_keys) or self.trigram_keys[i] != key:
+            return 0, 0
+        return self.trigram_offsets[i], self.trigram_offsets[i + 1]
+
+    def find_candidates(self, query):
+        """ returns the sorted ids of the pages that may match a
+            urlindex.UrlQuery, or None when every page may
+        """
+        start, end = 0, self.page_count
+        if query.prefix is not None:
+            start, end = self.find_prefix(query.prefix)
+        ranges = []
+        if self.has_url_index():
+            ranges = [ self.get_trigram_range(trigram) for trigram in query.get_trigrams() ]
+            ranges.sort(key=lambda item: item[1] - item[0])
+
+        if len(ranges) == 0 or ranges[0][1] - ranges[0][0] > end - start:
+            if query.prefix is None:
+                return None
+            candidates = range(start, end)
+        else:
+            offset = self.sections['tgpages'][0]
+            candidates = None
+            for first, last in ranges:
+                page_ids = unpack_column('u4', self.buf, offset + 4 * first, last - first)
+                if candidates is None:
+                    candidates = [ page_id for page_id in page_ids if start <= page_id < end ]
+                else:
+                    page_ids = set(page_ids)
+                    candidates = [ page_id for page_id in candidates if page_id in page_ids ]
+                if len(candidates) == 0:
+                    break
+        return candidates
+
+    def select_pages(self, url_filter):
+        """ returns the ids and urls of the pages url_filter accepts. the
+            candidates come from the index when url_filter has a query
+        """
+        query = getattr(url_filter, 'query', None)
+        candidates = None
+        if query is not None:
+            candidates = self.find_candidates(query)
+        if candidates is None:
+            urls = self.get_urls()
+            page_ids = [ page_id for page_id in xrange(self.page_count) if url_filter(urls[page_id]) ]
+            return page_ids, [ urls[page_id] for page_id in page_ids ]
+        page_ids = []
+        urls = []
+        for page_id in candidates:
+            url = self.get_url(page_id)
+            if url_filter(url):
+                page_ids.append(page_id)
+                urls.append(url)
+        return page_ids, urls
+
+    def get_column(self, name):
+        return self.get_section_column(name, self.COLUMN_KINDS[name])
+
+    def get_value(self, name, page_id):
+        fmt = { 'u': U64_FORMAT, 'f': F64_FORMAT }[self.COLUMN_KINDS[name]]
+        return struct.unpack_from(fmt, self.buf, self.sections[name][0] + 8 * page_id)[0]
+
+    def get_page_shape(self, page_id):
+        return list(unpack_column('u', self.buf, self.sections['shape'][0] + 8 * page_id * self.shape_width, self.shape_width))
+
+    def get_page_http_codes(self, page_id):
+        pc_index_offset = self.sections['pcidx'][0]
+        start, end = struct.unpack_from("<QQ", self.buf, pc_index_offset + 8 * page_id)
+        codes = unpack_column('i', self.buf, self.sections['pccode'][0] + 8 * start, end - start)
+        counts = unpack_column('u', self.buf, self.sections['pccount'][0] + 8 * start, end - start)
+        return dict(zip(codes, counts))
+
+    def get_page_nodes(self):
+        """ returns {page_id: {node name: Node}}
+        """
+        if self.sections.has_key('pnodes'):
+            # version 1 files
+            return cPickle.loads(self.get_section("pnodes"))
+
+        columns = workset.RowColumns(self.shape_spec)
+        self.fill_row_columns(columns, "n")
+        node_names = self.header['node_names']
+        mask = (1 << workset.NODE_ID_BITS) - 1
+        page_nodes = {}
+        slot = 0
+        for key in self.get_section_column('nkeys', 'u'):
+            node = workset.Node(node_names[key & mask], self.shape_spec)
+            node.hits = columns.hits[slot]
+            node.errors = columns.errors[slot]
+            node.min_time = columns.min_times[slot]
+            node.max_time = columns.max_times[slot]
+            node.total_time = columns.total_times[slot]
+            node.shape = columns.get_shape(slot)
+            node.http_codes = columns.get_http_codes(slot)
+            page_nodes.setdefault(int(key >> workset.NODE_ID_BITS), {})[node_names[key & mask]] = node
+            slot += 1
+        return page_nodes
+
+    def get_page(self, page_id, page_nodes=None):
+        page = workset.Page(self.get_url(page_id), self.shape_spec)
+        page.hits = self.get_value('hits', page_id)
+        page.errors = self.get_value('errors', page_id)
+        page.min_time = self.get_value('mintime', page_id)
+        page.max_time = self.get_value('maxtime', page_id)
+        page.total_time = self.get_value('tottime', page_id)
+        page.shape.dist = self.get_page_shape(page_id)
+        page.shape.total_hits = self.get_value('shits', page_id)
+        page.http_codes = self.get_page_http_codes(page_id)
+        if page_nodes is not None:
+            page.nodes = page_nodes.get(page_id, {})
+        return page
+
+    def fill_header(self, workset_obj):
+        header = self.get_header()
+        workset_obj.total_hits = header['total_hits']
+        workset_obj.total_errors = header['total_errors']
+        workset_obj.total_ignored = header['total_ignored']
+        workset_obj.shape = header['shape']
+        workset_obj.shape_spec = self.shape_spec
+        workset_obj.nodes = header['nodes']
+        workset_obj.http_codes = header['http_codes']
+        workset_obj.metadata = header['metadata']
+
+    def to_workset(self, url_filter=None):
+        """ materializes a full WorkSet, columns are read in bulk. with
+            url_filter, only the pages whose url it accepts are built, the
+            totals are still the ones of the whole file.
+        """
+        wkset = workset.WorkSet()
+        self.fill_header(wkset)
+
+        if url_filter is None:
+            urls = self.get_urls()
+            page_ids = xrange(self.page_count)
+        else:
+            page_ids, urls = self.select_pages(url_filter)
+            if len(page_ids) == 0:
+                return wkset
+        hits = self.get_column('hits')
+        errors = self.get_column('errors')
+        min_times = self.get_column('mintime')
+        max_times = self.get_column('maxtime')
+        total_times = self.get_column('tottime')
+        shape_hits = self.get_column('shits')
+        shape = self.get_section_column('shape', 'u')
+        pc_index = self.get_section_column('pcidx', 'u')
+        pc_codes = self.get_section_column('pccode', 'i')
+        pc_counts = self.get_section_column('pccount', 'u')
+        page_nodes = self.get_page_nodes()
+        width = self.shape_width
+
+        pages = wkset.pages
+        for page_id, url in itertools.izip(page_ids, urls):
+            page = workset.Page(url, self.shape_spec)
+            page.hits = hits[page_id]
+            page.errors = errors[page_id]
+            page.min_time = min_times[page_id]
+            page.max_time = max_times[page_id]
+            page.total_time = total_times[page_id]
+            page.shape.dist = list(shape[page_id * width:(page_id + 1) * width])
+            page.shape.total_hits = shape_hits[page_id]
+            start = pc_index[page_id]
+            end = pc_index[page_id + 1]
+            if end > start:
+                page.http_codes = dict(zip(pc_codes[start:end], pc_counts[start:end]))
+            page.nodes = page_nodes.get(page_id, {})
+            pages[page.url] = page
+        return wkset
+
+    def get_section_rows(self, name, kind, rows, width=1):
+        """ returns the items of the given rows of a section holding width
+            items per row. a few rows are read one by one, many through the
+            whole column.
+        """
+        offset, length = self.sections[name]
+        row_size = ITEM_SIZES[kind] * width
+        if len(rows) * ROW_READ_RATIO < length / row_size:
+            column = []
+            for i in rows:
+                column.extend(unpack_column(kind, self.buf, offset + row_size * i, width))
+            return column
+        full_column = self.get_section_column(name, kind)
+        if width == 1:
+            return [ full_column[i] for i in rows ]
+        column = []
+        for i in rows:
+            column.extend(full_column[i * width:(i + 1) * width])
+        return column
+
+    def get_count_array(self, name, rows=None, width=1):
+        if rows is None:
+            column = self.get_section_column(name, 'i')
+        else:
+            column = self.get_section_rows(name, 'i', rows, width)
+        if not isinstance(column, array.array) or column.typecode != workset.COUNT_TYPECODE:
+            column = array.array(workset.COUNT_TYPECODE, column)
+        return column
+
+    def get_time_array(self, name, rows=None):
+        if rows is None:
+            column = self.get_section_column(name, 'f')
+        else:
+            column = self.get_section_rows(name, 'f', rows)
+        if not isinstance(column, array.array) or column.typecode != workset.TIME_TYPECODE:
+            column = array.array(workset.TIME_TYPECODE, column)
+        return column
+
+    def fill_row_columns(self, columns, prefix, rows=None):
+        """ loads the rows (all of them by default) of the PREFIX* sections
+            into an empty workset.RowColumns
+        """
+        for name, section in self.ROW_COLUMNS:
+            if section in self.COLUMN_KINDS and self.COLUMN_KINDS[section] == 'f':
+                column = self.get_time_array(prefix + section, rows)
+            else:
+                column = self.get_count_array(prefix + section, rows)
+            setattr(columns, name, column)
+        columns.shape = self.get_count_array(prefix + "shape", rows, self.shape_width)
+        columns.count = len(columns.hits)
+
+        pc_index = self.get_section_column(prefix + 'pcidx', 'u')
+        pc_codes = self.get_section_column(prefix + 'pccode', 'i')
+        pc_counts = self.get_section_column(prefix + 'pccount', 'u')
+        if rows is None:
+            rows = xrange(columns.count)
+        row = 0
+        for i in rows:
+            for j in xrange(pc_index[i], pc_index[i + 1]):
+                columns.get_code_column(pc_codes[j])[row] = pc_counts[j]
+            row += 1
+
+    def to_array_workset(self, url_filter=None):
+        """ materializes an ArrayWorkSet: the file columns are its page and
+            page node columns, no per page object is built
+        """
+        wkset = workset.ArrayWorkSet(self.shape_spec)
+        self.fill_header(wkset)
+
+        page_ids = None
+        if url_filter is None:
+            urls = self.get_urls()
+        else:
+            page_ids, urls = self.select_pages(url_filter)
+            if len(page_ids) == 0:
+                return wkset
+
+        self.fill_row_columns(wkset.page_columns, "", page_ids)
+        wkset.urls = urls
+        wkset.url_ids = dict(itertools.izip(urls, xrange(len(urls))))
+
+        positions = None
+        if page_ids is not None:
+            positions = dict(itertools.izip(page_ids, xrange(len(page_ids))))
+
+        if self.sections.has_key('pnodes'):
+            # version 1 files
+            for page_id, nodes in self.get_page_nodes().iteritems():
+                if positions is not None:
+                    page_id = positions.get(page_id, None)
+                    if page_id is None:
+                        continue
+                for node_name, node in nodes.iteritems():
+                    wkset.node_columns.merge_object(wkset.get_node_slot(page_id, node_name.rstrip('\r\n')), node)
+            return wkset
+
+        node_names = self.header['node_names']
+        wkset.node_names = list(node_names)
+        wkset.node_ids = dict(itertools.izip(node_names, xrange(len(node_names))))
+        keys = self.get_count_array('nkeys')
+        rows = None
+        if page_ids is not None:
+            # the node keys are sorted, the rows of a page are contiguous
+            mask = (1 << workset.NODE_ID_BITS) - 1
+            rows = []
+            selected_keys = []
+            start = 0
+            for position in xrange(len(page_ids)):
+                start = bisect.bisect_left(keys, page_ids[position] << workset.NODE_ID_BITS, start)
+                end = bisect.bisect_left(keys, (page_ids[position] + 1) << workset.NODE_ID_BITS, start)
+                for i in xrange(start, end):
+                    rows.append(i)
+                    selected_keys.append((position << workset.NODE_ID_BITS) | (keys[i] & mask))
+                start = end
+            keys = selected_keys
+        self.fill_row_columns(wkset.node_columns, "n", rows)
+        wkset.node_slots = dict(itertools.izip(keys, xrange(len(keys))))
+        return wkset
+
+
+class UrlTable:
+    """ the sorted urls of a WorkSetFile as a sequence, for bisect
+    """
+    def __init__(self, wsfile):
+        self.wsfile = wsfile
+
+    def __len__(self):
+        return self.wsfile.page_count
+
+    def __getitem__(self, page_id):
+        return self.wsfile.get_url(page_id)
+
+
+def read_workset(filename, url_filter=None, arrays=False):
+    wsfile = WorkSetFile(filename)
+    try:
+        if arrays:
+            return wsfile.to_array_workset(url_filter)
+        return wsfile.to_workset(url_filter)
+    finally:
+        wsfile.close()
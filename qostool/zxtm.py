@@ -4,37 +4,249 @@
 zxtm: read zxtm logfiles
 """
 
+import os, os.path
+import sys
 import time
 import re
+import bz2
+import gzip
+import Queue
 import logging
+import threading
+import subprocess
 
-def parse_zxtm_log_line(line):
-    try:
-        parts = line.split('|')
-        duration = parts[1]
-        host = parts[2]
-        url = parts[5]
-        http_code = parts[7]
-        node_name = parts[-1]
+import stats
 
-        try:
-            http_code = int(http_code)
-        except:
-            http_code = 0
+ZXTM_BLOCK_SIZE = 4 * 1024 * 1024 # in bytes
+
+# a log is parsed in parts of this size, each part costs a merge of its pages
+LOG_SHARD_SIZE = 64 * 1024 * 1024 # in bytes
+
+LOG_READ_AHEAD = 4 # blocks read and decompressed ahead of the parser
+
+# suffix -> decompressing command, and python module fallback
+COMPRESSED_SUFFIXES = {
+    ".gz": (["gzip", "-dc"], gzip.open),
+    ".bz2": (["bzip2", "-dc"], bz2.BZ2File),
+    ".xz": (["xz", "-dc"], None),
+}
+
+class ZxtmBatch:
+    """ fields of the lines of one log block, as parallel lists
+    """
+    def __init__(self):
+        self.timestamps = []
+        self.durations = []
+        self.hosts = []
+        self.urls = []
+        self.node_names = []
+        self.http_codes = []
+        self.bad_lines = 0
+        self.start = 0
+        self.end = 0
 
+    def __len__(self):
+        return len(self.urls)
+
+def parse_zxtm_block(block, batch=None):
+    """ parses a string made of whole log lines, keeping only the timestamp,
+        duration, host, url, status and node fields; malformed lines are only
+        counted
+    """
+    if batch is None:
+        batch = ZxtmBatch()
+
+    add_timestamp = batch.timestamps.append
+    add_duration = batch.durations.append
+    add_host = batch.hosts.append
+    add_url = batch.urls.append
+    add_node_name = batch.node_names.append
+    add_http_code = batch.http_codes.append
+    bad_lines = 0
+
+    for line in block.split('\n'):
+        # the fields we need are all before the 8th separator, except the
+        # node which is the last one
+        parts = line.split('|', 8)
+        if len(parts) < 9:
+            if line:
+                bad_lines += 1
+            continue
+
+        duration = parts[1]
         if duration == '-':
             duration = 0
         else:
-            duration = float(duration)
-        return duration, host, url, node_name, http_code
-    except:
-        logging.exception("parse_zxtm_log_line: could not parse line [%s]", line)
+            try:
+                duration = float(duration)
+            except ValueError:
+                bad_lines += 1
+                continue
+
+        try:
+            http_code = int(parts[7])
+        except ValueError:
+            http_code = 0
+
+        add_timestamp(parts[0])
+        add_duration(duration)
+        add_host(parts[2])
+        add_url(parts[5])
+        add_http_code(http_code)
+        add_node_name(line[line.rfind('|') + 1:])
+
+    batch.bad_lines += bad_lines
+    return batch
+
+def find_block_end(buf, start, end, block_size=ZXTM_BLOCK_SIZE):
+    """ returns the offset just after the last line starting in
+        buf[start:start+block_size], lines longer than a block are kept whole
+    """
+    if end - start <= block_size:
+        return end
+    eol = buf.rfind('\n', start, start + block_size)
+    if eol == -1:
+        eol = buf.find('\n', start + block_size, end)
+        if eol == -1:
+            return end
+    return eol + 1
+
+def iter_zxtm_batches(buf, start=0, end=None, block_size=ZXTM_BLOCK_SIZE):
+    """ parses buf[start:end] (a string or mmap) block by block, yielding one
+        ZxtmBatch per block
+    """
+    if end is None:
+        end = len(buf)
+    while start < end:
+        block_end = find_block_end(buf, start, end, block_size)
+        yield parse_batch(buf[start:block_end], start)
+        start = block_end
+
+def parse_batch(block, start):
+    """ parse_zxtm_block for the block found at offset start of a log
+    """
+    started = stats.start()
+    batch = parse_zxtm_block(block)
+    stats.stop("parse", started)
+    stats.count("lines", len(batch))
+    stats.count("bytes", len(block))
+    stats.count("bad_lines", batch.bad_lines)
+    batch.start = start
+    batch.end = start + len(block)
+    return batch
+
+
+def strip_compression_suffix(filename):
+    base, suffix = os.path.splitext(filename)
+    if COMPRESSED_SUFFIXES.has_key(suffix):
+        return base
+    return filename
+
+def is_plain_logfile(filename):
+    """ whether filename can be mapped in memory, see iter_zxtm_batches
+    """
+    return filename != '-' and strip_compression_suffix(filename) == filename
+
+def open_log(filename):
+    """ returns a file object reading the uncompressed lines of a log, "-"
+        being stdin, and the decompressing child process or None. python
+        decompresses when the command is missing.
+    """
+    if filename == '-':
+        return sys.stdin, None
+    infile = open(filename, "rb")
+    suffix = os.path.splitext(filename)[1]
+    if not COMPRESSED_SUFFIXES.has_key(suffix):
+        return infile, None
+    command, fallback = COMPRESSED_SUFFIXES[suffix]
+    try:
+        process = subprocess.Popen(command, stdin=infile, stdout=subprocess.PIPE, close_fds=True)
+    except OSError:
+        infile.close()
+        if fallback is None:
+            raise IOError("cannot read [%s]: %s is not available" % (filename, command[0]))
+        logging.debug("open_log: %s is not available, decompressing [%s] in python", command[0], filename)
+        return fallback(filename, "rb"), None
+    infile.close()
+    return process.stdout, process
+
+def read_blocks(infile, block_size, blocks, stopping):
+    """ reader thread: puts the blocks of infile in the blocks queue, then
+        an empty block, or the exception that stopped it
+    """
+    try:
+        while not stopping.is_set():
+            block = infile.read(block_size)
+            blocks.put(block)
+            if len(block) == 0:
+                return
+    except Exception, error:
+        blocks.put(error)
+
+def iter_zxtm_stream_batches(filename, start=0, block_size=ZXTM_BLOCK_SIZE):
+    """ parses a log that can't be mapped in memory (compressed, or stdin)
+        from offset start of its uncompressed data, which must be a line
+        start, yielding one ZxtmBatch per block. a thread reads the blocks
+        ahead, so reading and decompressing overlap the parsing.
+    """
+    infile, process = open_log(filename)
+    blocks = Queue.Queue(LOG_READ_AHEAD)
+    stopping = threading.Event()
+    reader = threading.Thread(target=read_blocks, args=(infile, block_size, blocks, stopping))
+    reader.daemon = True
+    reader.start()
+
+    complete = False
+    try:
+        offset = 0 # of the pending data in the log
+        pending = ''
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if len(block) == 0:
+                break
+            if offset + len(pending) + len(block) <= start:
+                offset += len(block)
+                continue
+            if offset < start:
+                block = block[start - offset:]
+                offset = start
+            pending += block
+            eol = pending.rfind('\n')
+            if eol == -1:
+                # a line longer than a block
+                continue
+            batch = parse_batch(pending[:eol + 1], offset)
+            offset = batch.end
+            pending = pending[eol + 1:]
+            yield batch
+        if len(pending) > 0:
+            yield parse_batch(pending, offset)
+        complete = True
+    finally:
+        stopping.set()
+        if process is not None and not complete:
+            process.kill()
+        if infile is not sys.stdin:
+            # the reader stops after its current block, once it can queue it
+            while reader.is_alive():
+                try:
+                    blocks.get(True, 0.1)
+                except Queue.Empty:
+                    pass
+            infile.close()
+        if process is not None:
+            process.wait()
+            if complete and process.returncode != 0:
+                raise IOError("cannot read [%s]: decompression exited with status %d" % (filename, process.returncode))
 
 def logfilename_to_vserver(logfilename):
     return logfilename.split('.')[0]
 
 def logfilename_to_timeperiod(logfilename):
-    return '.'.join(logfilename.split('.')[-3:-2])
+    # vs1.www.20070222.17.log[.gz] -> 20070222.17
+    return '.'.join(strip_compression_suffix(logfilename).split('.')[-3:-1])
 
 def get_actual_time_period():
     # ASSUMPTION on avedya zxtm logfile naming
@@ -1,13 +1,46 @@
+import os
 import re
+import bz2
+import gzip
+import math
+import time
+import random
+import shutil
+import signal
+import sys
+import cPickle
 import logging
+import multiprocessing
+import tempfile
 import unittest
+import StringIO
 
 import qostool
 import qostool.util
 import qostool.zxtm
 import qostool.workset
+import qostool.wsfile
+import qostool.aggregation
+import qostool.compare
+import qostool.urlindex
+import qostool.config
+import qostool.qostool
+import qostool.sync
+import qostool.rollup
+import qostool.sheet
+import qostool.server
+import qostool.munin
+import qostool.series
+import qostool.stats
 
 
+ZXTM_LINES = [
+    "[21/Nov/2007:15:00:22 +0100]|0.000732|blogsperso.orange.fr|77.200.218.23|GET|/web/img/arrowrt.gif|image/gif|200|-|305|-|http://blogsperso.orange.fr/web/jsp/blog.jsp?blogID=381853|Mozilla/5.0 (Windows; U; Windows NT 6.0; fr; rv:1.8.0.12) Gecko/20070508 Firefox/1.5.0.12|0|10.1.42.66:8080|10.1.42.66:8080",
+    "[21/Nov/2007:17:50:28 +0100]|0.016799|aolchat.fr|78.113.106.7|POST|/web/ChatServlet;jsessionid=agW4JcALfK19?U=1195663828382615|text/html|200|-|484|ebNewBandWidth_.aolchat.fr=1138%3A1193484501734; s_cc=true; s_sq=aolfrglobal%2Caolfrportalnew%3D%2526pid%253DChat%252520%25253A%252520s.prop1%252520%25253A%252520sprop2%252520%25253A%252520sprop16%2526pidt%253D1%2526oid%253Dfunctionanonymous%252528%252529%25257BsendMessage%252528%252529%25253B%25257D%2526oidt%253D2%2526ot%253DDIV%2526oi%253D317|http://aolchat.fr/web/chat.jsp;jsessionid=agW4JcALfK19?userID=2219794|Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 2.0.50727)|0|212.73.213.173:80|212.73.213.173:80",
+    "[21/Nov/2007:17:53:15 +0100]|-|www.mynrj.com|86.196.47.55|GET|/media/image?p=hDupF8MNFGtnZDCVtItPr0vpl86SveFbZ8vN@tqWQDPjtk30G9SSYGN18BtKcOFr.|-|200|-|3258|JSESSIONID=aM5iaHjUDSe-; X-Mapping-oihfabgp=DF6250420263888DDC5C6905A4082F8A|http://www.mynrj.com/web/membre/jenifer-lunatique|Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 1.1.4322)|0|-|-",
+    "[21/Nov/2007:17:54:08 +0100]|0.019221|www.zapzone.fr|90.1.154.63|GET|/web/jsp/inc/search_users_result.jsp?totalCount=508&onlyOnline=true&userFilterType=0|text/html; charset=iso-8859-1|200|-|1621|__utma=174439721.964439698.1168035844.1195653305.1195660951.812; __utmz=174439721.1188239596.627.1.utmccn=(direct)|utmcsr=(direct)|utmcmd=(none); __utmb=174439721; __utmc=174439721; JSESSIONID=aZ4zuH5PLxU7|http://www.zapzone.fr/web/jsp/searchUsersResult.jsp?onlyOnline=true|Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; FREE; .NET CLR 2.0.50727; .NET CLR 1.1.4322)|0|10.1.42.52:8080|10.1.42.52:8080",
+]
+
 
 class Test_Util_ValueList(unittest.TestCase):
     
@@ -79,15 +112,20 @@ class Test_Util_LockValueList(Test_Util_ValueList):
         logging.info("++++ </Expected warning>")
 
 
+class Test_Util_SplitRanges(unittest.TestCase):
+
+    def test_split_ranges(self):
+        data = "a\nbb\nccc\ndddd\ne"
+        self.assertEquals(qostool.util.split_ranges(data, 0, len(data), 100), [(0, len(data))])
+        ranges = qostool.util.split_ranges(data, 2, len(data), 3)
+        self.assertEquals(ranges, [(2, 5), (5, 9), (9, 14), (14, 15)])
+        self.assertEquals(qostool.util.split_ranges(data, 0, 9, 4), [(0, 5), (5, 9)])
+
+
 class Test_Zxtm(unittest.TestCase):
 
     def setUp(self):
-        self.lines = [ 
-            "[21/Nov/2007:15:00:22 +0100]|0.000732|blogsperso.orange.fr|77.200.218.23|GET|/web/img/arrowrt.gif|image/gif|200|-|305|-|http://blogsperso.orange.fr/web/jsp/blog.jsp?blogID=381853|Mozilla/5.0 (Windows; U; Windows NT 6.0; fr; rv:1.8.0.12) Gecko/20070508 Firefox/1.5.0.12|0|10.1.42.66:8080|10.1.42.66:8080",
-            "[21/Nov/2007:17:50:28 +0100]|0.016799|aolchat.fr|78.113.106.7|POST|/web/ChatServlet;jsessionid=agW4JcALfK19?U=1195663828382615|text/html|200|-|484|ebNewBandWidth_.aolchat.fr=1138%3A1193484501734; s_cc=true; s_sq=aolfrglobal%2Caolfrportalnew%3D%2526pid%253DChat%252520%25253A%252520s.prop1%252520%25253A%252520sprop2%252520%25253A%252520sprop16%2526pidt%253D1%2526oid%253Dfunctionanonymous%252528%252529%25257BsendMessage%252528%252529%25253B%25257D%2526oidt%253D2%2526ot%253DDIV%2526oi%253D317|http://aolchat.fr/web/chat.jsp;jsessionid=agW4JcALfK19?userID=2219794|Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 2.0.50727)|0|212.73.213.173:80|212.73.213.173:80",
-            "[21/Nov/2007:17:53:15 +0100]|-|www.mynrj.com|86.196.47.55|GET|/media/image?p=hDupF8MNFGtnZDCVtItPr0vpl86SveFbZ8vN@tqWQDPjtk30G9SSYGN18BtKcOFr.|-|200|-|3258|JSESSIONID=aM5iaHjUDSe-; X-Mapping-oihfabgp=DF6250420263888DDC5C6905A4082F8A|http://www.mynrj.com/web/membre/jenifer-lunatique|Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET CLR 1.1.4322)|0|-|-",
-            "[21/Nov/2007:17:54:08 +0100]|0.019221|www.zapzone.fr|90.1.154.63|GET|/web/jsp/inc/search_users_result.jsp?totalCount=508&onlyOnline=true&userFilterType=0|text/html; charset=iso-8859-1|200|-|1621|__utma=174439721.964439698.1168035844.1195653305.1195660951.812; __utmz=174439721.1188239596.627.1.utmccn=(direct)|utmcsr=(direct)|utmcmd=(none); __utmb=174439721; __utmc=174439721; JSESSIONID=aZ4zuH5PLxU7|http://www.zapzone.fr/web/jsp/searchUsersResult.jsp?onlyOnline=true|Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; FREE; .NET CLR 2.0.50727; .NET CLR 1.1.4322)|0|10.1.42.52:8080|10.1.42.52:8080",
-        ]
+        self.lines = ZXTM_LINES
         self.values = [
             (0.00073200000000000001, 'blogsperso.orange.fr', '/web/img/arrowrt.gif', '10.1.42.66:8080', 200),
             (0.016799000000000001, 'aolchat.fr', '/web/ChatServlet;jsessionid=agW4JcALfK19?U=1195663828382615', '212.73.213.173:80', 200),
@@ -96,10 +134,68 @@ class Test_Zxtm(unittest.TestCase):
         ]
     
 
-    def test_parse_zxtm_log_line(self):
+    def test_parse_zxtm_block_lines(self):
         for l, v in zip(self.lines, self.values):
-            values = qostool.zxtm.parse_zxtm_log_line(l)
-            self.assertEquals(values, v)
+            batch = qostool.zxtm.parse_zxtm_block(l)
+            self.assertEquals(zip(batch.durations, batch.hosts, batch.urls, batch.node_names, batch.http_codes), [v])
+
+    def test_parse_zxtm_block(self):
+        block = '\n'.join(self.lines[:2] + ["garbage line", "a|b|c|d|e|f|g|h|i|j"] + self.lines[2:]) + '\n'
+        batch = qostool.zxtm.parse_zxtm_block(block)
+        self.assertEquals(batch.bad_lines, 2)
+        values = zip(batch.durations, batch.hosts, batch.urls, batch.node_names, batch.http_codes)
+        self.assertEquals(values, self.values)
+
+    def test_iter_zxtm_batches(self):
+        block = '\n'.join(self.lines * 10)
+        batches = list(qostool.zxtm.iter_zxtm_batches(block, block_size=1000))
+        self.assertTrue(len(batches) > 1)
+        self.assertEquals(batches[0].start, 0)
+        self.assertEquals(batches[-1].end, len(block))
+        urls = []
+        for batch in batches:
+            urls.extend(batch.urls)
+        self.assertEquals(urls, [ v[2] for v in self.values ] * 10)
+
+    def test_iter_zxtm_stream_batches(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            data = '\n'.join(self.lines * 10)
+            expected_urls = [ v[2] for v in self.values ] * 10
+            filenames = []
+            for suffix, module in [ ("", None), (".gz", gzip.GzipFile), (".bz2", bz2.BZ2File) ]:
+                filename = os.path.join(tmpdir, "vs1.x.20071121.15.log" + suffix)
+                outfile = (module or open)(filename, "wb")
+                outfile.write(data)
+                outfile.close()
+                filenames.append(filename)
+
+            saved_suffixes = qostool.zxtm.COMPRESSED_SUFFIXES.copy()
+            try:
+                for decompress_in_python in (False, True):
+                    if decompress_in_python:
+                        for suffix, (command, module) in saved_suffixes.items():
+                            qostool.zxtm.COMPRESSED_SUFFIXES[suffix] = (["missing-" + command[0]], module)
+                    for filename in filenames:
+                        batches = list(qostool.zxtm.iter_zxtm_stream_batches(filename, block_size=1000))
+                        self.assertTrue(len(batches) > 1)
+                        self.assertEquals(batches[-1].end, len(data))
+                        self.assertEquals(sum([ batch.urls for batch in batches ], []), expected_urls)
+
+                        # from the start of the 7th line
+                        start = batches[1].start
+                        urls = sum([ batch.urls for batch in qostool.zxtm.iter_zxtm_stream_batches(filename, start, 1000) ], [])
+                        self.assertEquals(urls, expected_urls[-len(urls):])
+                        self.assertEquals(len(urls), len(expected_urls) - len(batches[0].urls))
+            finally:
+                qostool.zxtm.COMPRESSED_SUFFIXES.update(saved_suffixes)
+
+            self.assertEquals(qostool.zxtm.logfilename_to_timeperiod(os.path.basename(filenames[1])), "20071121.15")
+            self.assertEquals(qostool.zxtm.is_plain_logfile(filenames[0]), True)
+            self.assertEquals(qostool.zxtm.is_plain_logfile(filenames[2]), False)
+            self.assertRaises(IOError, list, qostool.zxtm.iter_zxtm_stream_batches(filenames[1] + ".missing"))
+        finally:
+            shutil.rmtree(tmpdir)
 
 class Test_Workset(unittest.TestCase):
 
@@ -137,9 +233,1506 @@ class Test_Workset(unittest.TestCase):
         keep_params_re = re.compile("^(onlyOnline|method|fantastic)$")
         for u, c in zip(self.urls, self.clean_urls_keep_params):
             self.assertEquals(qostool.workset.cleanup_url(u, keep_params_re), c)
+
+    def test_cleanup_url_edge_cases(self):
+        cases = [
+            ('', ''),
+            ('/a;b', '/a'),
+            ('/a;b?c=1', '/a?c'),
+            ('/a?b;c=1', '/a?b;c'),
+            ('/a?b&c=1&d', '/a?b&c&d'),
+            ('/a?b=1=2&c', '/a?b&c'),
+            ('/a?', '/a?'),
+        ]
+        for u, c in cases:
+            self.assertEquals(qostool.workset.cleanup_url(u), c)
+
+    def test_url_normalizer(self):
+        keep_params_re = re.compile("^(onlyOnline|method|fantastic)$")
+        normalizer = qostool.workset.UrlNormalizer(keep_params_re, cache_size=4)
+        self.assertEquals(normalizer.clean_batch(self.urls * 2), self.clean_urls_keep_params * 2)
+        self.assertEquals(normalizer.clean(self.urls[-1]), self.clean_urls_keep_params[-1])
+        stats = normalizer.stats()
+        self.assertEquals(stats['hits'] + stats['misses'], len(self.urls) * 2 + 1)
+        self.assertTrue(stats['size'] <= 4)
+        self.assertTrue(stats['evictions'] > 0)
+
+        normalizer = qostool.workset.UrlNormalizer(keep_params_re)
+        normalizer.clean_batch(self.urls * 3)
+        self.assertEquals(normalizer.stats()['misses'], len(self.urls))
+        self.assertTrue(qostool.workset.get_url_normalizer(keep_params_re) is qostool.workset.get_url_normalizer(keep_params_re))
         
 
 
+class LegacyQosShape:
+    """ stand-in for the cumulative QosShape layout written by older versions
+    """
+    pass
+
+class Test_QosShape(unittest.TestCase):
+
+    def setUp(self):
+        self.times = [0.0, 0.01, 0.09, 0.1, 0.15, 0.49, 0.5, 0.51, 1.2, 1.5, 2.7, 4.99, 5.0, 7.3, 120.0]
+
+    def legacy_cumulative(self, times):
+        shape = [0]*qostool.workset.QOS_SHAPE_MAX_INDEX
+        for t in times:
+            i = min(int(t/qostool.workset.QOS_SHAPE_RESOLUTION), qostool.workset.QOS_SHAPE_MAX_INDEX-1)
+            while i >= 0:
+                shape[i] += 1
+                i -= 1
+        return shape
+
+    def test_hits_above(self):
+        s = qostool.workset.QosShape()
+        for t in self.times:
+            s.hit(t)
+        self.assertEquals(s.get_cumulative(), self.legacy_cumulative(self.times))
+        self.assertEquals(s.get_hits_above(0.5), 9)
+        self.assertEquals(s.get_hits_above(0), len(self.times))
+        s.hit(0.7)
+        self.assertEquals(s.get_hits_above(0.5), 10)
+
+    def test_aggregate(self):
+        s1 = qostool.workset.QosShape()
+        s2 = qostool.workset.QosShape()
+        for t in self.times:
+            s1.hit(t)
+            s2.hit(t * 2)
+        s1.get_hits_above(0.5)
+        s1.aggregate(s2)
+        self.assertEquals(s1.total_hits, 2 * len(self.times))
+        self.assertEquals(s1.get_cumulative(), self.legacy_cumulative(self.times + [t * 2 for t in self.times]))
+
+    def test_load_legacy_pickle(self):
+        legacy = LegacyQosShape()
+        legacy.shape = self.legacy_cumulative(self.times)
+        legacy.total_hits = len(self.times)
+        legacy.resolution = qostool.workset.QOS_SHAPE_RESOLUTION
+        legacy.max_time = qostool.workset.QOS_SHAPE_MAX_TIME
+        data = cPickle.dumps(legacy).replace(__name__ + "\nLegacyQosShape", "qostool.workset\nQosShape")
+
+        s = cPickle.loads(data)
+        ref = qostool.workset.QosShape()
+        for t in self.times:
+            ref.hit(t)
+        self.assertEquals(s.get_dist(), ref.get_dist())
+        self.assertEquals(s.get_hits_above(1.0), ref.get_hits_above(1.0))
+        s.hit(0.2)
+        self.assertEquals(s.get_hits_above(0.2), ref.get_hits_above(0.2) + 1)
+
+    def test_pickle_roundtrip(self):
+        s = qostool.workset.QosShape()
+        for t in self.times:
+            s.hit(t)
+        s.get_hits_above(0.5)
+        s2 = cPickle.loads(cPickle.dumps(s))
+        self.assertEquals(s2.get_dist(), s.get_dist())
+        self.assertEquals(s2.get_cumulative(), s.get_cumulative())
+
+    def test_hits_above_max_time(self):
+        s = qostool.workset.QosShape()
+        for t in self.times:
+            s.hit(t)
+        # the last bucket holds everything from 4.9 on
+        self.assertEquals(s.get_hits_above(5.0), 4)
+        self.assertEquals(s.get_hits_above(60.0), 4)
+        self.assertAlmostEquals(s.get_percentile(50), 0.6)
+        self.assertAlmostEquals(s.get_percentile(100), 4.9)
+
+    def test_hdr_percentiles(self):
+        rnd = random.Random(42)
+        times = [ rnd.lognormvariate(-3, 1.5) for i in range(20000) ]
+        s = qostool.workset.HdrQosShape(0.001, 60, 0.01)
+        for t in times:
+            s.hit(t)
+        times.sort()
+        percentiles = [50, 90, 99, 99.9]
+        for pc, value in zip(percentiles, s.get_percentiles(percentiles)):
+            exact = times[int(math.ceil(pc / 100.0 * len(times))) - 1]
+            self.assertTrue(exact <= value <= max(exact * 1.01, 0.001), (pc, exact, value))
+        self.assertEquals(s.get_hits_above(0.05), len([ t for t in times if t >= s.bucket_start(s.index(0.05)) ]))
+        self.assertEquals(qostool.workset.HdrQosShape().get_percentile(50), None)
+
+    def test_hdr_aggregate(self):
+        s1 = qostool.workset.HdrQosShape()
+        s2 = qostool.workset.HdrQosShape()
+        ref = qostool.workset.HdrQosShape()
+        for t in self.times:
+            s1.hit(t)
+            s2.hit(t * 2)
+            ref.hit(t)
+            ref.hit(t * 2)
+        s1.aggregate(s2)
+        self.assertEquals(s1.get_dist(), ref.get_dist())
+        self.assertEquals(s1.total_hits, ref.total_hits)
+
+        # shapes with another layout are rebinned
+        linear = qostool.workset.QosShape()
+        for t in self.times:
+            linear.hit(t)
+        s1.aggregate(linear)
+        self.assertEquals(s1.total_hits, 3 * len(self.times))
+        self.assertEquals(sum(s1.get_dist()), sum(ref.get_dist()) + sum(linear.get_dist()))
+
+    def test_hdr_workset(self):
+        spec = (qostool.workset.QOS_SHAPE_HDR, 0.001, 30, 0.02)
+        ws = qostool.workset.WorkSet(spec)
+        for t in self.times:
+            ws.hit('/a', t, 'node1', 200)
+        self.assertEquals(ws.pages['/a'].shape.get_spec(), spec)
+        self.assertEquals(ws.nodes['node1'].shape.get_spec(), spec)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "hdr.ws")
+            qostool.workset.WorkSetManager().save(ws, filename)
+            loaded = qostool.workset.WorkSetManager().load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        assert_worksets_equal(self, ws, loaded)
+        self.assertEquals(loaded.pages['/a'].shape.get_spec(), spec)
+
+        dest = qostool.workset.WorkSet()
+        dest.aggregate(loaded)
+        dest.aggregate(create_sample_workset())
+        self.assertEquals(dest.shape.get_spec(), spec)
+        self.assertEquals(dest.pages['/b?x'].shape.get_spec(), spec)
+        self.assertEquals(dest.pages['/a'].hits, len(self.times) + 3)
+
+
+def create_sample_workset():
+    ws = qostool.workset.WorkSet()
+    ws.metadata["creator"] = "test"
+    hits = [
+        ('/a', 0.12, 'node1', 200),
+        ('/a', 0.7, 'node2', 200),
+        ('/a', 0, 'node1', 500),
+        ('/b?x', 1.3, 'node1', 404),
+        ('/c', 0, '-', 0),
+        ('/b?x', 6.2, 'node2', 200),
+        ('/d/e', 0.01, 'node2', 302),
+    ]
+    for url, time, node_name, http_code in hits:
+        ws.hit(url, time, node_name, http_code)
+    ws.ignore_hit('/ignored', 0.2)
+    return ws
+
+def assert_worksets_equal(test, ws1, ws2):
+    test.assertEquals(ws1.total_hits, ws2.total_hits)
+    test.assertEquals(ws1.total_errors, ws2.total_errors)
+    test.assertEquals(ws1.total_ignored, ws2.total_ignored)
+    test.assertEquals(ws1.http_codes, ws2.http_codes)
+    test.assertEquals(ws1.shape.get_dist(), ws2.shape.get_dist())
+    test.assertEquals(sorted(ws1.nodes.keys()), sorted(ws2.nodes.keys()))
+    test.assertEquals(sorted(ws1.pages.keys()), sorted(ws2.pages.keys()))
+    for url in ws1.pages.keys():
+        p1 = ws1.pages[url]
+        p2 = ws2.pages[url]
+        test.assertEquals((p1.url, p1.hits, p1.errors, p1.min_time, p1.max_time, p1.total_time, p1.http_codes),
+                          (p2.url, p2.hits, p2.errors, p2.min_time, p2.max_time, p2.total_time, p2.http_codes))
+        test.assertEquals(p1.shape.get_dist(), p2.shape.get_dist())
+        test.assertEquals(p1.shape.total_hits, p2.shape.total_hits)
+        test.assertEquals(sorted(p1.nodes.keys()), sorted(p2.nodes.keys()))
+        for name, node in p1.nodes.items():
+            test.assertEquals((node.name, node.hits, node.errors, node.total_time, node.shape.get_dist(), node.http_codes),
+                              (p2.nodes[name].name, p2.nodes[name].hits, p2.nodes[name].errors, p2.nodes[name].total_time,
+                               p2.nodes[name].shape.get_dist(), p2.nodes[name].http_codes))
+
+class Test_WorkSetManager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ws = create_sample_workset()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_columnar_roundtrip(self):
+        filename = os.path.join(self.tmpdir, "a.ws")
+        manager = qostool.workset.WorkSetManager()
+        manager.save(self.ws, filename)
+        self.assertTrue(qostool.wsfile.is_workset_file(filename))
+        loaded = manager.load(filename)
+        assert_worksets_equal(self, self.ws, loaded)
+        self.assertEquals(loaded.metadata, self.ws.metadata)
+
+    def test_pickle_roundtrip(self):
+        filename = os.path.join(self.tmpdir, "a.ws")
+        manager = qostool.workset.WorkSetManager(qostool.workset.FORMAT_PICKLE)
+        manager.save(self.ws, filename)
+        self.assertFalse(qostool.wsfile.is_workset_file(filename))
+        assert_worksets_equal(self, self.ws, manager.load(filename))
+
+    def test_delta_segments(self):
+        filename = os.path.join(self.tmpdir, "a.ws")
+        manager = qostool.workset.WorkSetManager()
+        manager.save_delta(create_sample_workset(), filename)
+        manager.save_delta(create_sample_workset(), filename)
+        self.assertEquals([ seq for seq, name in manager.get_deltas(filename) ], [1, 2])
+
+        expected = create_sample_workset()
+        expected.aggregate(create_sample_workset())
+        assert_worksets_equal(self, expected, manager.load(filename))
+
+        shutil.copy(filename + ".d2", os.path.join(self.tmpdir, "leftover"))
+        manager.compact(filename)
+        self.assertEquals(manager.get_deltas(filename), [])
+        assert_worksets_equal(self, expected, manager.load(filename))
+
+        # a segment left behind by an interrupted compaction is not counted again
+        shutil.copy(os.path.join(self.tmpdir, "leftover"), filename + ".d2")
+        assert_worksets_equal(self, expected, manager.load(filename))
+        os.unlink(filename + ".d2")
+
+        manager.save_delta(create_sample_workset(), filename)
+        self.assertEquals([ seq for seq, name in manager.get_deltas(filename) ], [3])
+        expected.aggregate(create_sample_workset())
+        assert_worksets_equal(self, expected, manager.load(filename))
+
+    def test_load_lazy(self):
+        filename = os.path.join(self.tmpdir, "a.ws")
+        manager = qostool.workset.WorkSetManager()
+        manager.save(self.ws, filename)
+        lazy = manager.load_lazy(filename)
+        self.assertTrue(isinstance(lazy, qostool.workset.LazyWorkSet))
+        self.assertEquals((lazy.total_hits, lazy.total_errors, lazy.http_codes), (self.ws.total_hits, self.ws.total_errors, self.ws.http_codes))
+        self.assertEquals(lazy.shape.get_dist(), self.ws.shape.get_dist())
+        self.assertEquals(lazy.get_page_count(), 3)
+        self.assertEquals(lazy.get_pages_total_hits(), self.ws.get_pages_total_hits())
+        self.assertFalse(lazy.is_loaded())
+        assert_worksets_equal(self, self.ws, lazy)
+        self.assertTrue(lazy.is_loaded())
+
+        # the folded deltas are skipped, as load() does
+        manager.save_delta(create_sample_workset(), filename)
+        manager.compact(filename)
+        shutil.copy(filename, filename + ".d1")
+        manager.save_delta(create_sample_workset(), filename)
+        lazy = manager.load_lazy(filename)
+        self.assertEquals([ name for name, count in lazy.segments ], [filename, filename + ".d2"])
+        loaded = manager.load(filename)
+        self.assertEquals((lazy.total_hits, lazy.shape.get_dist()), (loaded.total_hits, loaded.shape.get_dist()))
+        self.assertEquals(lazy.get_pages_total_hits(), loaded.get_pages_total_hits())
+        self.assertEquals(lazy.get_page_count(), 3)
+        self.assertTrue(lazy.is_loaded())
+
+        # no separate header in the pickle format
+        manager = qostool.workset.WorkSetManager(qostool.workset.FORMAT_PICKLE)
+        manager.save(self.ws, filename)
+        os.unlink(filename + ".d1")
+        os.unlink(filename + ".d2")
+        self.assertFalse(isinstance(manager.load_lazy(filename), qostool.workset.LazyWorkSet))
+
+    def test_columnar_direct_access(self):
+        filename = os.path.join(self.tmpdir, "a.ws")
+        manager = qostool.workset.WorkSetManager()
+        manager.save(self.ws, filename)
+        wsfile = manager.open(filename)
+        try:
+            self.assertEquals(wsfile.page_count, 3)
+            self.assertEquals(wsfile.get_urls(), ['/a', '/b?x', '/d/e'])
+            page_id = wsfile.find_url('/b?x')
+            self.assertEquals(page_id, 1)
+            self.assertEquals(wsfile.find_url('/b'), None)
+            self.assertEquals(wsfile.get_value('hits', page_id), 2)
+            self.assertEquals(wsfile.get_page_http_codes(0), {200: 2})
+            self.assertEquals(list(wsfile.get_column('hits')), [3, 2, 1])
+            self.assertEquals(wsfile.get_header()['total_hits'], self.ws.total_hits)
+        finally:
+            wsfile.close()
+
+
+class Test_ArrayWorkSet(unittest.TestCase):
+
+    def setUp(self):
+        batch = qostool.zxtm.parse_zxtm_block('\n'.join(ZXTM_LINES) + '\n')
+        self.hits = zip(batch.urls, batch.durations, batch.node_names, batch.http_codes)
+        self.hits += [('/a', 0.12, 'node1', 200), ('/a', 0, 'node1', 500), ('/c', 0, '-', 0), ('/b', 7.5, 'node2', 404)]
+
+    def fill(self, wkset, hits):
+        for url, duration, node_name, http_code in hits:
+            wkset.hit(url, duration, node_name, http_code)
+        return wkset
+
+    def test_hit(self):
+        ws = self.fill(qostool.workset.WorkSet(), self.hits)
+        array_ws = self.fill(qostool.workset.ArrayWorkSet(), self.hits)
+        assert_worksets_equal(self, ws, array_ws)
+        self.assertEquals(len(array_ws.pages), len(ws.pages))
+
+        page = array_ws.pages['/a']
+        page.hit(0.3, 'node1', 200)
+        self.assertEquals(page.hits, 3)
+        self.assertEquals(array_ws.pages['/a'].nodes['node1'].hits, 2)
+        copy = page.copy()
+        self.assertTrue(isinstance(copy, qostool.workset.Page))
+        page.hit(0.3, 'node1', 200)
+        self.assertEquals(copy.hits, 3)
+        self.assertEquals(array_ws.pages['/a'].hits, 4)
+
+        out1 = StringIO.StringIO()
+        out2 = StringIO.StringIO()
+        ws.pages['/b'].summary(out1)
+        array_ws.pages['/b'].summary(out2)
+        self.assertEquals(out1.getvalue(), out2.getvalue())
+
+    def test_aggregate(self):
+        half = len(self.hits) / 2
+        ref = self.fill(qostool.workset.WorkSet(), self.hits + self.hits[:half])
+        part1 = self.fill(qostool.workset.ArrayWorkSet(), self.hits)
+        part2 = self.fill(qostool.workset.ArrayWorkSet(), self.hits[:half])
+        dest = qostool.workset.ArrayWorkSet()
+        dest.aggregate(part1)
+        dest.aggregate(part2)
+        assert_worksets_equal(self, ref, dest)
+        assert_worksets_equal(self, part1, self.fill(qostool.workset.WorkSet(), self.hits))
+
+        # mixed storages
+        dest = qostool.workset.ArrayWorkSet()
+        dest.aggregate(self.fill(qostool.workset.WorkSet(), self.hits))
+        dest.aggregate(part2)
+        assert_worksets_equal(self, ref, dest)
+        dest = qostool.workset.WorkSet()
+        dest.aggregate(part1)
+        dest.aggregate(part2)
+        assert_worksets_equal(self, ref, dest)
+
+    def test_filter_aggregate(self):
+        options = qostool.qostool.MatcherOptions()
+        ref = qostool.workset.WorkSet()
+        ref.filter_aggregate(self.fill(qostool.workset.WorkSet(), self.hits), qostool.qostool.grep_matcher, '/a', options)
+        dest = qostool.workset.ArrayWorkSet()
+        dest.filter_aggregate(self.fill(qostool.workset.ArrayWorkSet(), self.hits), qostool.qostool.grep_matcher, '/a', options)
+        self.assertEquals(sorted(dest.pages.keys()), ['/a', '/web/img/arrowrt.gif'])
+        assert_worksets_equal(self, ref, dest)
+
+    def test_set_delete(self):
+        ref = self.fill(qostool.workset.WorkSet(), self.hits)
+        array_ws = self.fill(qostool.workset.ArrayWorkSet(), self.hits)
+        size = qostool.server.get_workset_size(array_ws)
+        rows = array_ws.page_columns.count, array_ws.node_columns.count
+
+        # a page replaced through pages[...] keeps its rows
+        for wkset in (ref, array_ws):
+            replacement = qostool.workset.Page('/a')
+            replacement.hit(0.7, 'node2', 200)
+            wkset.pages['/a'] = replacement
+            wkset.pages['/b'] = wkset.pages['/b']
+        assert_worksets_equal(self, ref, array_ws)
+        self.assertEquals(array_ws.pages['/a'].nodes.keys(), ['node2'])
+        self.assertEquals(array_ws.page_columns.count, rows[0])
+        self.assertEquals(array_ws.get_dead_rows(), 1)
+        # the node1 row of /a is dead, the node2 row is new
+        self.assertEquals(array_ws.node_columns.count, rows[1] + 1)
+        self.assertEquals(qostool.server.get_workset_size(array_ws), size)
+
+        for wkset in (ref, array_ws):
+            del wkset.pages['/a']
+            del wkset.pages['/web/img/arrowrt.gif']
+        assert_worksets_equal(self, ref, array_ws)
+        # the dead rows are dropped once they are more than a quarter
+        self.assertEquals(array_ws.get_dead_rows(), 0)
+        self.assertEquals(array_ws.page_columns.count, len(array_ws.pages))
+        self.assertEquals(len(array_ws.urls), len(array_ws.pages))
+        self.assertTrue(qostool.server.get_workset_size(array_ws) < size)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "a.ws")
+            qostool.workset.WorkSetManager().save(array_ws, filename)
+            loaded = qostool.workset.WorkSetManager().load(filename)
+            assert_worksets_equal(self, ref, loaded)
+            self.assertEquals(loaded.page_columns.count, len(ref.pages))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_save_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for storage in (qostool.workset.STORAGE_OBJECTS, qostool.workset.STORAGE_ARRAYS):
+                manager = qostool.workset.WorkSetManager(storage=storage)
+                ws = self.fill(manager.new_workset(), self.hits)
+                filename = os.path.join(tmpdir, storage + ".ws")
+                manager.save(ws, filename)
+                for load_storage in (qostool.workset.STORAGE_OBJECTS, qostool.workset.STORAGE_ARRAYS):
+                    loaded = qostool.workset.WorkSetManager(storage=load_storage).load(filename)
+                    assert_worksets_equal(self, ws, loaded)
+                filtered = manager.load(filename, lambda url: url.startswith('/b'))
+                self.assertEquals(filtered.pages.keys(), ['/b'])
+                self.assertEquals(sorted(filtered.pages['/b'].nodes.keys()), ['node2'])
+
+                manager.save_format = qostool.workset.FORMAT_PICKLE
+                manager.save(ws, filename + ".pickle")
+                assert_worksets_equal(self, ws, manager.load(filename + ".pickle"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class Test_Parse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sources = []
+        for i in range(3):
+            filename = os.path.join(self.tmpdir, "vs%d.log" % (i))
+            logfile = open(filename, "w")
+            for j in range(5):
+                for line in ZXTM_LINES[i:] + ZXTM_LINES[:i]:
+                    logfile.write(line + "\n")
+            logfile.close()
+            self.sources.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def parse(self, *options):
+        dest_filename = os.path.join(self.tmpdir, "dest%d.ws" % (len(os.listdir(self.tmpdir))))
+        qostool.qostool.parse_cmd(list(options) + self.sources + [dest_filename])
+        return qostool.workset.WorkSetManager().load(dest_filename)
+
+    def test_parallel_parse(self):
+        sequential = self.parse()
+        self.assertEquals(sequential.total_hits, 3 * 5 * len(ZXTM_LINES))
+        parallel = self.parse('-j', '2')
+        assert_worksets_equal(self, sequential, parallel)
+
+    def test_sharded_parse(self):
+        whole = self.parse()
+        saved_shard_size = qostool.zxtm.LOG_SHARD_SIZE
+        qostool.zxtm.LOG_SHARD_SIZE = 500
+        try:
+            self.assert_(len(qostool.qostool.get_source_parts(self.sources[0])) > 1)
+            sequential = self.parse('-j', '1')
+            parallel = self.parse('-j', '3')
+        finally:
+            qostool.zxtm.LOG_SHARD_SIZE = saved_shard_size
+        assert_worksets_equal(self, sequential, parallel)
+        self.assertEquals(sequential.total_hits, whole.total_hits)
+        self.assertEquals(sorted(sequential.pages.keys()), sorted(whole.pages.keys()))
+
+
+
+class Test_Compare(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old = create_sample_workset()
+        self.new = qostool.workset.WorkSet()
+        hits = [
+            ('/a', 0.1, 'node1', 200),
+            ('/a', 0.3, 'node2', 200),
+            ('/b?x', 1.1, 'node1', 200),
+            ('/b?x', 2.5, 'node2', 503),
+            ('/b?x', 0.9, 'node2', 200),
+            ('/f', 0.6, 'node1', 500),
+            ('/f', 0.2, 'node1', 200),
+        ]
+        for url, time, node_name, http_code in hits:
+            self.new.hit(url, time, node_name, http_code)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_fields(self, comparison):
+        return dict([ (fields[0], fields) for fields in map(comparison.get_fields, comparison.get_ranking()) ])
+
+    def test_ranking(self):
+        comparison = qostool.compare.Comparison(self.old, self.new, 0.5)
+        self.assertEquals(sorted(comparison.urls), ['/a', '/b?x', '/d/e', '/f'])
+        # the page impacts add up to the change of the global slow %
+        self.assertAlmostEqual(sum(comparison.impacts), self.new.shape.get_hits_pc_above(0.5) - self.old.shape.get_hits_pc_above(0.5))
+        self.assertEquals([ comparison.urls[i] for i in comparison.get_ranking(2) ], ['/f', '/b?x'])
+        self.assertAlmostEqual(comparison.impacts[comparison.urls.index('/f')], 100.0 / 7)
+
+        fields = self.get_fields(comparison)
+        self.assertEquals(fields['/b?x'][1:3], (3, 1))
+        self.assertAlmostEqual(fields['/b?x'][4], 100.0 - 100.0)
+        self.assertAlmostEqual(fields['/b?x'][8], 100.0 / 3)
+        self.assertEquals(fields['/f'][6], None)
+        self.assertEquals(fields['/d/e'][1:3], (0, -1))
+        self.assertAlmostEqual(fields['/a'][6], 0.2 - (0.12 + 0.7) / 2)
+
+        # same results from the columns of array worksets
+        manager = qostool.workset.WorkSetManager()
+        manager.save(self.old, os.path.join(self.tmpdir, "old.ws"))
+        manager.save(self.new, os.path.join(self.tmpdir, "new.ws"))
+        old = manager.load(os.path.join(self.tmpdir, "old.ws"))
+        self.assertTrue(isinstance(old, qostool.workset.ArrayWorkSet))
+        array_comparison = qostool.compare.Comparison(old, manager.load(os.path.join(self.tmpdir, "new.ws")), 0.5)
+        for url, array_fields in self.get_fields(array_comparison).items():
+            for value, array_value in zip(fields[url], array_fields):
+                if type(value) == float:
+                    self.assertAlmostEqual(value, array_value)
+                else:
+                    self.assertEquals(value, array_value)
+        self.assertEquals(comparison.get_total_fields(), array_comparison.get_total_fields())
+
+    def test_tsv(self):
+        comparison = qostool.compare.Comparison(self.old, self.new, 0.5)
+        out = StringIO.StringIO()
+        comparison.write_tsv(2, out)
+        lines = [ line.split('\t') for line in out.getvalue().splitlines() ]
+        self.assertEquals(lines[0], list(qostool.compare.COLUMNS))
+        self.assertEquals([ line[0] for line in lines[1:] ], ['Total', '/f', '/b?x'])
+        self.assertEquals(lines[2][6], '')
+        self.assertEquals(int(lines[1][1]), self.new.total_hits)
+
+    def test_shape_compare(self):
+        out = StringIO.StringIO()
+        self.old.shape.compare(self.new.shape, (50,), out)
+        self.assertEquals(out.getvalue(), "shape_hits_diff:  1\np50_diff: +0.400 (0.200 -> 0.600)\n")
+
+
+class Test_Aggregation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = qostool.workset.WorkSetManager()
+        self.sources = []
+        for i in range(5):
+            # dyadic times, so the sums don't depend on the merge order
+            ws = qostool.workset.WorkSet()
+            for j in range(i + 1):
+                ws.hit('/a', 0.25 * (j + 1), 'node%d' % (j % 2), 200)
+                ws.hit('/p%d' % (i), 1.5, 'node1', 500)
+            filename = os.path.join(self.tmpdir, "agg%d.ws" % (i))
+            self.manager.save(ws, filename)
+            self.sources.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_copy_on_write(self):
+        ws1 = create_sample_workset()
+        ws2 = create_sample_workset()
+        dest = qostool.workset.WorkSet()
+        dest.aggregate(ws1)
+        dest.hit('/d/e', 0.3, 'node1', 200)
+        dest.aggregate(ws2)
+        self.assertEquals(dest.pages['/a'].hits, 6)
+        self.assertEquals(dest.pages['/d/e'].hits, 3)
+        self.assertEquals(ws1.pages['/a'].hits, 3)
+        self.assertEquals(ws1.pages['/d/e'].hits, 1)
+        assert_worksets_equal(self, ws1, create_sample_workset())
+        assert_worksets_equal(self, ws2, create_sample_workset())
+        self.assertEquals(ws1.pages['/a'].nodes['node1'].hits, 1)
+        self.assertEquals(dest.pages['/a'].nodes['node1'].hits, 2)
+
+    def test_parallel_aggregate(self):
+        sequential = qostool.aggregation.AggregationEngine(self.manager, 1).aggregate(self.sources)
+        self.assertEquals(sequential.total_hits, 30)
+        self.assertEquals(sequential.pages['/a'].hits, 15)
+        parallel = qostool.aggregation.AggregationEngine(self.manager, 3).aggregate(self.sources + self.sources[:2])
+        assert_worksets_equal(self, sequential, parallel)
+
+    def test_filtered_load(self):
+        url_filter = qostool.aggregation.PageFilter(qostool.qostool.grep_matcher, '/p', qostool.qostool.MatcherOptions())
+        wkset = self.manager.load(self.sources[3], url_filter)
+        self.assertEquals(wkset.pages.keys(), ['/p3'])
+        self.assertEquals(wkset.total_hits, 8)
+        filtered = qostool.aggregation.AggregationEngine(self.manager, 2).aggregate(self.sources, url_filter)
+        self.assertEquals(sorted(filtered.pages.keys()), ['/p0', '/p1', '/p2', '/p3', '/p4'])
+        self.assertEquals(filtered.total_hits, 30)
+
+
+class Test_UrlIndex(unittest.TestCase):
+
+    URLS = ['/web/page1.jsp', '/web/Page2.jsp', '/web/img/1.gif', '/media/page3.jsp', '/api/search', '/w']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        ws = qostool.workset.WorkSet()
+        for url in self.URLS:
+            ws.hit(url, 0.25, 'node1', 200)
+        self.indexed = os.path.join(self.tmpdir, "indexed.ws")
+        qostool.workset.WorkSetManager().save(ws, self.indexed)
+        self.plain = os.path.join(self.tmpdir, "plain.ws")
+        qostool.workset.WorkSetManager(url_index=False).save(ws, self.plain)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_regex_query(self):
+        query = qostool.urlindex.regex_query(re.compile(r'/web/.*\.jsp'), True)
+        self.assertEquals(query.prefix, '/web/')
+        self.assertEquals(query.literals, ['/web/', '.jsp'])
+        query = qostool.urlindex.regex_query(re.compile(r'^/api/sea?rch'))
+        self.assertEquals(query.prefix, '/api/se')
+        query = qostool.urlindex.regex_query(re.compile(r'page\d'))
+        self.assertEquals((query.prefix, query.literals), (None, ['page']))
+        query = qostool.urlindex.regex_query(re.compile(r'web|api'), True)
+        self.assertFalse(query.is_selective())
+        query = qostool.urlindex.regex_query(re.compile(r'(?i)/web/'), True)
+        self.assertEquals((query.prefix, query.literals), (None, ['/web/']))
+
+    def test_find_candidates(self):
+        wsfile = qostool.wsfile.WorkSetFile(self.indexed)
+        try:
+            self.assertTrue(wsfile.has_url_index())
+            urls = wsfile.get_urls()
+            self.assertEquals(wsfile.find_prefix('/web/'), (3, 6))
+            self.assertEquals(wsfile.find_prefix('/x'), (6, 6))
+            candidates = wsfile.find_candidates(qostool.urlindex.substring_query('page'))
+            self.assertEquals([ urls[i] for i in candidates ], ['/media/page3.jsp', '/web/Page2.jsp', '/web/page1.jsp'])
+            self.assertEquals(wsfile.find_candidates(qostool.urlindex.substring_query('nothere')), [])
+            self.assertEquals(wsfile.find_candidates(qostool.urlindex.substring_query('/w')), None)
+        finally:
+            wsfile.close()
+
+    def test_search(self):
+        grep = qostool.qostool.grep_matcher
+        search = qostool.qostool.re_search_matcher
+        match = qostool.qostool.re_match_matcher
+        options = qostool.qostool.MatcherOptions()
+        ignore_case = qostool.qostool.MatcherOptions()
+        ignore_case.case_insensitive = True
+        invert = qostool.qostool.MatcherOptions()
+        invert.invert_match = True
+        cases = [
+            (grep, 'page', options, ['/media/page3.jsp', '/web/page1.jsp']),
+            (grep, 'page', ignore_case, ['/media/page3.jsp', '/web/Page2.jsp', '/web/page1.jsp']),
+            (grep, '.jsp', invert, ['/api/search', '/w', '/web/img/1.gif']),
+            (search, re.compile(r'[pP]age\d\.jsp$'), options, ['/media/page3.jsp', '/web/Page2.jsp', '/web/page1.jsp']),
+            (match, re.compile(r'/web/[a-z]+\d'), options, ['/web/page1.jsp']),
+            (match, re.compile(r'/w'), options, ['/w', '/web/Page2.jsp', '/web/img/1.gif', '/web/page1.jsp']),
+        ]
+        for storage in (qostool.workset.STORAGE_OBJECTS, qostool.workset.STORAGE_ARRAYS):
+            manager = qostool.workset.WorkSetManager(storage=storage)
+            for matcher, pattern, matcher_options, expected in cases:
+                url_filter = qostool.aggregation.PageFilter(matcher, pattern, matcher_options,
+                                                            qostool.qostool.get_url_query(matcher, pattern, matcher_options))
+                for filename in (self.indexed, self.plain):
+                    wkset = manager.load(filename, url_filter)
+                    self.assertEquals(sorted(wkset.pages.keys()), expected)
+                    self.assertEquals(wkset.total_hits, len(self.URLS))
+
+
+class Test_Server(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "a.ws")
+        qostool.workset.WorkSetManager().save(create_sample_workset(), self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache(self):
+        cache = qostool.server.WorkSetCache(1)
+        cache.put('a', 1, create_sample_workset())
+        cache.put('b', 1, create_sample_workset())
+        # over budget, only the last one is kept
+        self.assertEquals(cache.entries.keys(), ['b'])
+        self.assertEquals(cache.get('b', 2), None)
+        self.assertEquals(cache.size, 0)
+
+        cache.budget = 1 << 20
+        manager = qostool.server.CachingWorkSetManager(cache)
+        wkset = manager.load(self.filename)
+        self.assertTrue(manager.load(self.filename) is wkset)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        filtered = manager.load(self.filename, lambda url: url.startswith('/b'))
+        self.assertEquals(filtered.pages.keys(), ['/b?x'])
+        self.assertEquals(filtered.total_hits, wkset.total_hits)
+        self.assertEquals(len(wkset.pages), 3)
+
+        manager.save_delta(create_sample_workset(), self.filename)
+        reloaded = manager.load(self.filename)
+        self.assertFalse(reloaded is wkset)
+        self.assertEquals(reloaded.total_hits, 2 * wkset.total_hits)
+
+    def test_query(self):
+        socket_path = os.path.join(self.tmpdir, "qostool.sock")
+        process = multiprocessing.Process(target=qostool.qostool.serve_cmd, args=(['-s', socket_path],))
+        process.start()
+        try:
+            for i in range(100):
+                if qostool.server.is_server_running(socket_path):
+                    break
+                time.sleep(0.05)
+            expected = "%s %s\n" % (self.filename, 100 - create_sample_workset().shape.get_hits_pc_above(0.5))
+            for i in range(2):
+                out = StringIO.StringIO()
+                self.assertEquals(qostool.server.query(['qos', '0.5', self.filename], socket_path, out), 0)
+                self.assertEquals(out.getvalue(), expected)
+            err = StringIO.StringIO()
+            self.assertEquals(qostool.server.query(['summary', self.filename + '.missing'], socket_path, err=err), 1)
+            self.assertTrue('No such file' in err.getvalue())
+        finally:
+            process.terminate()
+            process.join()
+        self.assertFalse(os.path.exists(socket_path))
+        self.assertEquals(qostool.server.query(['qos', '0.5', self.filename], socket_path), None)
+
+    def test_socket_owner(self):
+        saved_environ = dict(os.environ)
+        try:
+            os.environ.pop(qostool.server.SOCKET_ENV, None)
+            os.environ["XDG_RUNTIME_DIR"] = self.tmpdir
+            self.assertEquals(qostool.server.get_socket_path(), os.path.join(self.tmpdir, "qostool.sock"))
+            del os.environ["XDG_RUNTIME_DIR"]
+            self.assertEquals(os.path.dirname(qostool.server.get_socket_path()), qostool.server.get_socket_dir())
+            self.assertNotEquals(qostool.server.get_socket_dir(), tempfile.gettempdir())
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+        socket_path = os.path.join(self.tmpdir, "sub", "qostool.sock")
+        query_server = qostool.server.QueryServer({}, socket_path)
+        query_server.bind()
+        try:
+            self.assertEquals(os.stat(os.path.dirname(socket_path)).st_mode & 0777, 0700)
+            self.assertTrue(qostool.server.is_trusted(socket_path))
+            # the socket of another user is not used
+            saved_getuid = os.getuid
+            os.getuid = lambda: saved_getuid() + 1
+            try:
+                self.assertFalse(qostool.server.is_trusted(socket_path))
+                self.assertEquals(qostool.server.query(['qos', '0.5', self.filename], socket_path), None)
+                self.assertRaises(Exception, qostool.server.QueryServer({}, socket_path).bind)
+            finally:
+                os.getuid = saved_getuid
+        finally:
+            query_server.sock.close()
+
+    def test_request_timeout(self):
+        socket_path = os.path.join(self.tmpdir, "qostool.sock")
+        query_server = qostool.server.QueryServer({}, socket_path)
+        query_server.request_timeout = 0.1
+        query_server.bind()
+        client = qostool.server.connect(socket_path)
+        try:
+            # a client connected without sending its request is dropped
+            client.sendall('["qos"')
+            conn, dummy = query_server.sock.accept()
+            started = time.time()
+            query_server.handle(conn)
+            conn.close()
+            self.assertTrue(time.time() - started < 5)
+            self.assertEquals(client.recv(10), '')
+        finally:
+            client.close()
+            query_server.sock.close()
+
+
+class Test_Rollup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager = qostool.workset.WorkSetManager()
+        for time_period in ['20070227.10', '20070227.11', '20070228.23', '20070301.00']:
+            filename = os.path.join(self.tmpdir, qostool.sync.generate_workset_file_name(time_period, 'svc', 'app'))
+            self.manager.save(create_sample_workset(), filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, filename):
+        return self.manager.load(os.path.join(self.tmpdir, filename))
+
+    def test_periods(self):
+        self.assertEquals(qostool.rollup.day_to_week('20070101'), '2007w01')
+        self.assertEquals(qostool.rollup.day_to_week('20061231'), '2006w52')
+        self.assertEquals(qostool.rollup.week_days('2007w09'), ['20070226', '20070227', '20070228', '20070301', '20070302', '20070303', '20070304'])
+        self.assertEquals(len(qostool.rollup.month_days('200802')), 29)
+
+    def test_rollup(self):
+        engine = qostool.rollup.RollupEngine(self.tmpdir, self.manager)
+        engine.run('20070301')
+        hits = create_sample_workset().total_hits
+        self.assertEquals(self.load('svc/2007/02/27/app.20070227.ws').total_hits, 2 * hits)
+        self.assertEquals(self.load('svc/2007/02/28/app.20070228.ws').total_hits, hits)
+        self.assertEquals(self.load('svc/2007/02/app.200702.ws').total_hits, 3 * hits)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'svc/2007/03/01/app.20070301.ws')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'svc/2007/w09/app.2007w09.ws')))
+
+        # rerunning later builds the newly closed periods only
+        engine.run('20070306')
+        self.assertEquals(self.load('svc/2007/w09/app.2007w09.ws').total_hits, 4 * hits)
+        self.assertEquals(self.load('svc/2007/02/app.200702.ws').total_hits, 3 * hits)
+        self.assertFalse(engine.build(os.path.join(self.tmpdir, 'svc/2007/02/27/app.20070227.ws'),
+                                      engine.find_hourly_worksets()[('svc', 'app', '20070227')], '20070227'))
+
+    def test_retention(self):
+        engine = qostool.rollup.RollupEngine(self.tmpdir, self.manager, retention_days=5)
+        engine.run('20070305')
+        self.assertEquals(sorted(engine.find_hourly_worksets().keys()), [('svc', 'app', '20070228'), ('svc', 'app', '20070301')])
+        self.assertEquals(self.load('svc/2007/02/27/app.20070227.ws').total_hits, 2 * create_sample_workset().total_hits)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'svc/2007/02/27/10')))
+
+
+TEST_CONFIG = """
+[global]
+root = %(root)s
+services = blog,chat,other
+
+[blog.service]
+name = Blog
+apps = we,web,media
+zxtm_vservers = vs1
+zxtm_host_re = ^blog
+munin_apps = web
+
+[chat.service]
+name = Chat
+apps = web,im.*
+shape = hdr
+shape_precision = 0.02
+zxtm_vservers = vs1,vs2
+zxtm_host_re = chat
+ignore_re = ^/web/ping
+
+[other.service]
+name = Other
+apps = web
+zxtm_vservers = vs2
+
+[zxtm]
+root = %(zxtm_root)s
+vservers = vs1,vs2
+"""
+
+def create_test_config(root, zxtm_root):
+    parser = qostool.util.ConfigParserDef()
+    parser.readfp(StringIO.StringIO(TEST_CONFIG % { 'root': root, 'zxtm_root': zxtm_root }))
+    engine_config = qostool.config.QosEngineConfig()
+    engine_config.parse_file("<test>", parser)
+    return engine_config
+
+class Test_Sheet(unittest.TestCase):
+
+    def test_top(self):
+        random_gen = random.Random(3)
+        lines = [ ("/p%d" % (i), random_gen.randint(0, 20)) for i in range(200) ]
+        sorted_sheet = qostool.sheet.Sheet()
+        sorted_sheet.header("URL", "Hits")
+        top_sheet = qostool.sheet.Sheet()
+        top_sheet.header("URL", "Hits")
+        top_sheet.top(1, 15)
+        for line in lines:
+            sorted_sheet.line(*line)
+            if top_sheet.accepts(line[1]):
+                top_sheet.line(*line)
+        sorted_sheet.sort(1)
+        sorted_sheet.limit(15)
+        # equal values keep the line order, as with a stable sort
+        self.assertEquals(top_sheet.get_lines(), sorted_sheet.get_lines())
+        self.assertFalse(top_sheet.accepts(-1))
+
+    def test_hits_above(self):
+        ws = create_sample_workset()
+        array_ws = qostool.workset.ArrayWorkSet()
+        array_ws.aggregate(ws)
+        expected = dict([ (page.url, page.shape.get_hits_above(0.5)) for page in ws.pages.values() ])
+        for wkset in (ws, array_ws):
+            self.assertEquals(dict([ (page.url, hits) for page, hits in wkset.iter_hits_above(0.5) ]), expected)
+
+
+class Test_Munin(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_summary(self):
+        for spec in (None, (qostool.workset.QOS_SHAPE_HDR, 0.001, 60, 0.02)):
+            ws = qostool.workset.WorkSet(spec)
+            for url, time, node_name, http_code in [('/a', 0.12, 'n1', 200), ('/a', 0.7, 'n1', 503), ('/b', 0, 'n1', 0), ('/b', 1.3, 'n1', 500)]:
+                ws.hit(url, time, node_name, http_code)
+            filename = os.path.join(self.tmpdir, "app.ws.sum")
+            qostool.munin.write_summary(qostool.munin.create_summary(ws, 0.5), filename)
+            summary = qostool.munin.read_summary(filename)
+            self.assertEquals((summary.total_hits, summary.total_errors, summary.http_5xx, summary.hits_above), (4, 1, 2, 2))
+            self.assertEquals(summary.shape.get_spec(), ws.shape.get_spec())
+            for target_time in (0.5, 1.0):
+                self.assertEquals(summary.get_qos(target_time), 100 - ws.shape.get_hits_pc_above(target_time))
+        self.assertRaises(IOError, qostool.munin.read_summary, filename + ".missing")
+
+    def test_sync_summaries(self):
+        config_file = os.path.join(self.tmpdir, "qos.cfg")
+        outfile = open(config_file, "w")
+        outfile.write(TEST_CONFIG % { 'root': self.tmpdir, 'zxtm_root': self.tmpdir })
+        outfile.close()
+        engine = qostool.sync.SyncEngine(config_file)
+        ws = engine.get_munin_workset('blog', 'web')
+        ws.hit('/web/a', 0.3, 'n1', 200)
+        ws.hit('/web/b', 0.9, 'n1', 200)
+        engine.save_or_reset_munin_worksets()
+
+        fname = os.path.join(self.tmpdir, "munin", qostool.sync.generate_munin_workset_file_name('blog', 'web'))
+        summary = qostool.munin.read_summary(fname + qostool.munin.SUMMARY_SUFFIX)
+        self.assertEquals(summary.get_qos(0.5), 50.0)
+
+        # once munin read it, the workset is reset
+        open(fname + ".read", "w").close()
+        engine.save_or_reset_munin_worksets()
+        for suffix in ("", ".read", qostool.munin.SUMMARY_SUFFIX):
+            self.assertFalse(os.path.exists(fname + suffix))
+
+    def test_munin_cmd(self):
+        config_file = os.path.join(self.tmpdir, "qos.cfg")
+        outfile = open(config_file, "w")
+        outfile.write(TEST_CONFIG % { 'root': self.tmpdir, 'zxtm_root': self.tmpdir })
+        outfile.close()
+        engine = qostool.sync.SyncEngine(config_file)
+        ws = engine.get_munin_workset('blog', 'web')
+        ws.hit('/web/a', 0.3, 'n1', 200)
+        ws.hit('/web/b', 0.9, 'n1', 200)
+        engine.save_or_reset_munin_worksets()
+        fname = os.path.join(self.tmpdir, "munin", qostool.sync.generate_munin_workset_file_name('blog', 'web'))
+        # a summary it can't read: the workset gives the value
+        open(fname + qostool.munin.SUMMARY_SUFFIX, "wb").write("bad")
+
+        saved_config_file = qostool.config.DEFAULT_CONFIG_FILE
+        saved_stdout = sys.stdout
+        qostool.config.DEFAULT_CONFIG_FILE = config_file
+        sys.stdout = StringIO.StringIO()
+        try:
+            qostool.qostool.munin_cmd([])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = saved_stdout
+            qostool.config.DEFAULT_CONFIG_FILE = saved_config_file
+        self.assertEquals(output, "blog_web.value 50.00\n")
+        self.assertTrue(os.path.exists(fname + ".read"))
+
+
+class Test_Series(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_minutes(self):
+        self.assertEquals(qostool.series.parse_log_minute("[01/Jan/1970:01:01:59 +0100]"), 1)
+        self.assertEquals(qostool.series.parse_log_minute("[21/Nov/2007:15:00:22 -0130]"), qostool.series.parse_log_minute("[21/Nov/2007:16:30:00 +0000]"))
+        start, end = qostool.series.parse_period("20071121.15")
+        self.assertEquals((qostool.series.format_minute(start), end - start), ("20071121.1500", 60))
+        self.assertEquals(qostool.series.parse_period("20071121.1503")[1] - qostool.series.parse_period("20071121.1503")[0], 1)
+        self.assertRaises(ValueError, qostool.series.parse_period, "2007112115")
+
+    def test_appends(self):
+        engine_config = create_test_config(self.tmpdir, self.tmpdir)
+        svc = engine_config.services['blog']
+        collector = qostool.series.SeriesCollector(self.tmpdir)
+        collector.hit(svc, 'web', "[21/Nov/2007:15:00:22 +0100]", 0.2, 200)
+        collector.hit(svc, 'web', "[21/Nov/2007:15:01:22 +0100]", 0.9, 503)
+        collector.ignore_hit(svc, 'web', "[21/Nov/2007:15:00:30 +0100]")
+        appends = collector.take_appends()
+        self.assertEquals(len(appends), 1)
+        self.assertEquals(collector.records, {})
+        filename, data = appends[0]
+        offset = qostool.series.get_append_offset(filename)
+        self.assertEquals(offset, 0)
+        # a replayed append at the same offset is harmless
+        for repeat in range(2):
+            qostool.series.append_data(filename, data, offset)
+        minute = qostool.series.parse_log_minute("[21/Nov/2007:15:00:00 +0100]")
+        records = qostool.series.scan(self.tmpdir, 'blog', 'web', minute, minute + 60)
+        self.assertEquals([ record.counters for record in records ], [[1, 1, 0, 0, 0], [1, 0, 0, 1, 1]])
+        self.assertEquals(qostool.series.get_append_offset(filename), os.path.getsize(filename))
+
+    def test_sync(self):
+        config_file = os.path.join(self.tmpdir, "qos.cfg")
+        outfile = open(config_file, "w")
+        outfile.write(TEST_CONFIG % { 'root': self.tmpdir, 'zxtm_root': self.tmpdir })
+        outfile.close()
+        engine = qostool.sync.SyncEngine(config_file)
+        line = "[21/Nov/2007:15:%s +0100]|%s|%s|1.2.3.4|GET|%s|text/html|%d|-|1|-|-|-|0|n1|n1"
+        lines = [ line % ('00:01', '0.3', 'blog.fr', '/web/a', 200),
+                  line % ('00:59', '0.9', 'blog.fr', '/web/b', 503),
+                  line % ('00:30', '-', 'blog.fr', '/web/c', 0),
+                  line % ('01:00', '0.1', 'blog.fr', '/web/a', 200),
+                  line % ('01:00', '0.1', 'blog.fr', '/media/a', 200),
+                  line % ('01:02', '0.1', 'chat.fr', '/web/ping', 200),
+                  "[bad]|0.2|blog.fr|1.2.3.4|GET|/web/a|text/html|200|-|1|-|-|-|0|n1|n1" ]
+        logfile = open(os.path.join(self.tmpdir, "vs1.x.%s.log" % (engine.current_time_period)), "w")
+        logfile.write('\n'.join(lines) + '\n')
+        logfile.close()
+        engine.sync()
+
+        root = os.path.join(self.tmpdir, "series")
+        minute = qostool.series.parse_log_minute("[21/Nov/2007:15:00:00 +0100]")
+        # the blog apps regexp gives "we" for /web urls
+        records = qostool.series.scan(root, 'blog', 'we', minute, minute + 60)
+        self.assertEquals([ (record.minute, record.counters) for record in records ], [(minute, [3, 0, 1, 1, 1]), (minute + 1, [1, 0, 0, 0, 0])])
+        self.assertEquals(records[0].buckets, [0, 0, 1, 1, 0, 0, 0, 0])
+        self.assertEquals(records[0].get_qos(), 50.0)
+        self.assertEquals(qostool.series.scan(root, 'chat', 'web', minute, minute + 60)[0].counters, [0, 1, 0, 0, 0])
+
+        # a second sync run appends, a partial record is dropped, steps add minutes up
+        filename = os.path.join(root, qostool.series.generate_series_file_name(qostool.series.minute_to_day(minute), 'blog', 'we'))
+        open(filename, "ab").write("xyz")
+        logfile = open(os.path.join(self.tmpdir, "vs1.x.%s.log" % (engine.current_time_period)), "a")
+        logfile.write(lines[0] + '\n')
+        logfile.close()
+        engine = qostool.sync.SyncEngine(config_file)
+        engine.sync()
+        records = qostool.series.scan(root, 'blog', 'we', minute, minute + 60, 10)
+        self.assertEquals([ (record.minute, record.counters) for record in records ], [(minute, [5, 0, 1, 1, 1])])
+
+
+class Test_Stats(unittest.TestCase):
+
+    def test_report(self):
+        run_stats = qostool.stats.Stats()
+        run_stats.count("lines", 10)
+        run_stats.stop("parse", time.time() - 1)
+        since = run_stats.snapshot()
+        run_stats.count("lines", 5)
+        run_stats.count("bytes", 100)
+        report = run_stats.get_report(since)
+        self.assertEquals(report["counts"], { "lines": 5, "bytes": 100 })
+        self.assertEquals(report["times"], {})
+        report = run_stats.get_report()
+        self.assertEquals(report["counts"], { "lines": 15, "bytes": 100 })
+        self.assert_(report["times"]["parse"] >= 1)
+
+    def test_sync_history(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config_file = os.path.join(tmpdir, "qos.cfg")
+            outfile = open(config_file, "w")
+            outfile.write(TEST_CONFIG % { 'root': tmpdir, 'zxtm_root': tmpdir })
+            outfile.close()
+            engine = qostool.sync.SyncEngine(config_file)
+            logfile = open(os.path.join(tmpdir, "vs1.x.%s.log" % (engine.current_time_period)), "w")
+            logfile.write('\n'.join(self.get_lines()) + '\n')
+            logfile.close()
+            engine.sync()
+            engine.sync()
+
+            engine = qostool.sync.SyncEngine(config_file)
+            engine.load_state()
+            history = engine.state.stats_history
+            self.assertEquals(len(history), 2)
+            self.assertEquals(history[0]["counts"]["lines"], 4)
+            self.assertEquals(history[0]["counts"]["pages_saved"], 3)
+            self.assert_("sync.hit" in history[0]["times"])
+            self.assertFalse("lines" in history[1]["counts"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def get_lines(self):
+        return [ "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|%s|text/html|200|-|1|-|-|-|0|n1|n1" % (url)
+                 for url in ('/web/a', '/web/b', '/web/a', '/media/c') ]
+
+
+class Test_SyncCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, "qos.cfg")
+        outfile = open(self.config_file, "w")
+        outfile.write(TEST_CONFIG % { 'root': self.tmpdir, 'zxtm_root': self.tmpdir })
+        outfile.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_engine(self):
+        engine = qostool.sync.SyncEngine(self.config_file)
+        engine.block_size = 64 * 1024
+        engine.config.checkpoint_mb = 1
+        return engine
+
+    def get_total_hits(self, engine):
+        fname = os.path.join(self.tmpdir, "data", qostool.sync.generate_workset_file_name(engine.current_time_period, 'blog', 'we'))
+        return engine.workset_manager.load(fname).total_hits
+
+    def test_resume(self):
+        engine = self.create_engine()
+        logfilename = "vs1.x.%s.log" % (engine.current_time_period)
+        line = "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n"
+        data = ''.join([ line % (i % 500) for i in range(12000) ])
+        logfile = open(os.path.join(self.tmpdir, logfilename), "w")
+        # the last line is still being written
+        logfile.write(data[:-20])
+        logfile.close()
+
+        # a crash right after the first checkpoint state was saved
+        class Crash(Exception):
+            pass
+        def crash():
+            raise Crash()
+        engine.load_state()
+        engine.apply_commit = crash
+        self.assertRaises(Crash, engine.update_current_logfile, engine.state.current_logfiles[logfilename], logfilename)
+        self.assert_(0 < engine.state.current_logfiles[logfilename].size < len(data) - 20)
+
+        # the next run puts the checkpoint files in place and goes on from there
+        engine = self.create_engine()
+        engine.sync()
+        self.assertEquals(self.get_total_hits(engine), 11999)
+        minute = qostool.series.parse_log_minute("[21/Nov/2007:15:00:00 +0100]")
+        self.assertEquals(qostool.series.scan(os.path.join(self.tmpdir, "series"), 'blog', 'we', minute, minute + 1)[0].counters[0], 11999)
+        for folder, dummy, file_names in os.walk(self.tmpdir):
+            self.assertEquals([ name for name in file_names if name.endswith(qostool.sync.COMMIT_SUFFIX) ], [])
+
+        logfile = open(os.path.join(self.tmpdir, logfilename), "a")
+        logfile.write(data[-20:])
+        logfile.close()
+        engine = self.create_engine()
+        engine.sync()
+        self.assertEquals(self.get_total_hits(engine), 12000)
+
+    def test_parallel(self):
+        engine = self.create_engine()
+        engine.config.sync_jobs = 2
+        lines = { "vs1": "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n",
+                  "vs2": "[21/Nov/2007:15:01:22 +0100]|0.3|www.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n" }
+        for vserver, line in lines.items():
+            logfile = open(os.path.join(self.tmpdir, "%s.x.%s.log" % (vserver, engine.current_time_period)), "w")
+            logfile.write(''.join([ line % (i % 500) for i in range(15000) ]))
+            logfile.close()
+        engine.sync()
+
+        self.assertEquals(self.get_total_hits(engine), 15000)
+        fname = os.path.join(self.tmpdir, "data", qostool.sync.generate_workset_file_name(engine.current_time_period, 'other', 'web'))
+        wkset = engine.workset_manager.load(fname)
+        self.assertEquals(wkset.total_hits, 15000)
+        self.assertEquals(len(wkset.pages), 500)
+        self.assertEquals(engine.state.stats_history[-1]["counts"]["lines"], 30000)
+        minute = qostool.series.parse_log_minute("[21/Nov/2007:15:00:00 +0100]")
+        for svc_id, counts in (('blog', [15000, 0]), ('other', [0, 15000])):
+            records = qostool.series.scan(os.path.join(self.tmpdir, "series"), svc_id, svc_id == 'blog' and 'we' or 'web', minute, minute + 2)
+            self.assertEquals([ record.counters[0] for record in records if record.counters[0] ], [ count for count in counts if count ])
+
+    def test_sharded_tail(self):
+        engine = self.create_engine()
+        engine.config.sync_jobs = 2
+        logfilename = "vs1.x.%s.log" % (engine.current_time_period)
+        line = "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n"
+        logfile = open(os.path.join(self.tmpdir, logfilename), "w")
+        logfile.write(''.join([ line % (i % 500) for i in range(15000) ]))
+        logfile.close()
+        engine.load_state()
+        logfile = engine.state.current_logfiles[logfilename]
+        saved_shard_size = qostool.sync.SHARD_MIN_SIZE
+        qostool.sync.SHARD_MIN_SIZE = 100000
+        try:
+            ranges = engine.split_unread_lines(logfile, logfilename, engine.get_unread_end(logfile, logfilename), 1 << 20, 2)
+            self.assertEquals(len(ranges), 2)
+            self.assertEquals(ranges[0][1], ranges[1][0])
+            engine.sync()
+        finally:
+            qostool.sync.SHARD_MIN_SIZE = saved_shard_size
+        self.assertEquals(self.get_total_hits(engine), 15000)
+        self.assertEquals(sum([ report["counts"].get("logfiles_read", 0) for report in engine.state.stats_history ]), 4)
+
+
+class Test_Backfill(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, "qos.cfg")
+        outfile = open(self.config_file, "w")
+        outfile.write(TEST_CONFIG % { 'root': self.tmpdir, 'zxtm_root': os.path.join(self.tmpdir, "zxtm") })
+        outfile.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_backfill(self):
+        line = "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n"
+        filename = os.path.join(self.tmpdir, "vs1.x.20071121.15.log.gz")
+        outfile = gzip.GzipFile(filename, "wb")
+        outfile.write(''.join([ line % (i % 50) for i in range(300) ]))
+        outfile.close()
+
+        for repeat in range(2):
+            engine = qostool.sync.SyncEngine(self.config_file, qostool.sync.BACKFILL_STATE)
+            engine.backfill([filename])
+        wkset = engine.workset_manager.load(os.path.join(self.tmpdir, "data", qostool.sync.generate_workset_file_name('20071121.15', 'blog', 'we')))
+        self.assertEquals((wkset.total_hits, len(wkset.pages)), (300, 50))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "munin")))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "state", "sync.state")))
+
+    def write_backfill_log(self, time_period, count):
+        line = "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n"
+        filename = os.path.join(self.tmpdir, "vs1.x.%s.log.gz" % (time_period))
+        outfile = gzip.GzipFile(filename, "wb")
+        outfile.write(''.join([ line % (i % 500) for i in range(count) ]))
+        outfile.close()
+        return filename
+
+    def test_along_sync(self):
+        zxtm_root = os.path.join(self.tmpdir, "zxtm")
+        os.makedirs(zxtm_root)
+        engine = qostool.sync.SyncEngine(self.config_file)
+        engine.block_size = 64 * 1024
+        engine.config.checkpoint_mb = 1
+        time_period = engine.current_time_period
+        line = "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n"
+        logfile = open(os.path.join(zxtm_root, "vs1.x.%s.log" % (time_period)), "w")
+        logfile.write(''.join([ line % (i % 500) for i in range(12000) ]))
+        logfile.close()
+        filename = self.write_backfill_log(time_period, 12000)
+
+        # munin already read the live workset: sync resets it, backfill not
+        munin_fname = os.path.join(self.tmpdir, "munin", qostool.sync.generate_munin_workset_file_name('blog', 'web'))
+        qostool.util.makedirs_for_file(munin_fname)
+        for suffix in ("", ".read"):
+            open(munin_fname + suffix, "w").close()
+
+        # a whole backfill of the same hour between two sync checkpoints
+        checkpoint = engine.checkpoint
+        def checkpoint_and_backfill():
+            checkpoint()
+            if not os.path.exists(os.path.join(self.tmpdir, "state", "backfill.state")):
+                backfill_engine = qostool.sync.SyncEngine(self.config_file, qostool.sync.BACKFILL_STATE)
+                backfill_engine.block_size = 64 * 1024
+                backfill_engine.config.checkpoint_mb = 1
+                backfill_engine.backfill([filename])
+                self.assertTrue(os.path.exists(munin_fname + ".read"))
+        engine.checkpoint = checkpoint_and_backfill
+        engine.sync()
+
+        self.assertFalse(os.path.exists(munin_fname + ".read"))
+        wkset = engine.workset_manager.load(os.path.join(self.tmpdir, "data", qostool.sync.generate_workset_file_name(time_period, 'blog', 'we')))
+        self.assertEquals((wkset.total_hits, len(wkset.pages)), (24000, 500))
+        minute = qostool.series.parse_log_minute("[21/Nov/2007:15:00:00 +0100]")
+        records = qostool.series.scan(os.path.join(self.tmpdir, "series"), 'blog', 'we', minute, minute + 1, 1)
+        self.assertEquals(records[0].counters[0], 24000)
+
+    def test_interrupted_checkpoint(self):
+        filename = self.write_backfill_log('20071121.15', 300)
+        class Crash(Exception):
+            pass
+        def crash():
+            raise Crash()
+        engine = qostool.sync.SyncEngine(self.config_file, qostool.sync.BACKFILL_STATE)
+        engine.apply_commit = crash
+        self.assertRaises(Crash, engine.backfill, [filename])
+
+        # the next sync puts the backfill checkpoint in place before writing
+        os.makedirs(os.path.join(self.tmpdir, "zxtm"))
+        engine = qostool.sync.SyncEngine(self.config_file)
+        engine.sync()
+        wkset = engine.workset_manager.load(os.path.join(self.tmpdir, "data", qostool.sync.generate_workset_file_name('20071121.15', 'blog', 'we')))
+        self.assertEquals(wkset.total_hits, 300)
+        minute = qostool.series.parse_log_minute("[21/Nov/2007:15:00:00 +0100]")
+        self.assertEquals(qostool.series.scan(os.path.join(self.tmpdir, "series"), 'blog', 'we', minute, minute + 1)[0].counters[0], 300)
+        engine.load_state()
+        backfill_state = qostool.sync.read_state(engine.get_state_file_name(qostool.sync.BACKFILL_STATE))
+        self.assertEquals(backfill_state.pending_commit, None)
+
+    def test_stale_commit_files(self):
+        filename = self.write_backfill_log('20071121.15', 300)
+        class Crash(Exception):
+            pass
+        def crash():
+            raise Crash()
+        engine = qostool.sync.SyncEngine(self.config_file, qostool.sync.BACKFILL_STATE)
+        engine.save_state = crash
+        self.assertRaises(Crash, engine.backfill, [filename])
+        def find_commit_files():
+            found = []
+            for folder, dirs, files in os.walk(os.path.join(self.tmpdir, "data")):
+                found.extend([ f for f in files if f.endswith(qostool.sync.COMMIT_SUFFIX) ])
+            return found
+        self.assertEquals(len(find_commit_files()), 1)
+
+        # no state lists the segment, the next run removes it
+        engine = qostool.sync.SyncEngine(self.config_file, qostool.sync.BACKFILL_STATE)
+        engine.load_state()
+        self.assertEquals(find_commit_files(), [])
+        engine.backfill([filename])
+        wkset = engine.workset_manager.load(os.path.join(self.tmpdir, "data", qostool.sync.generate_workset_file_name('20071121.15', 'blog', 'we')))
+        self.assertEquals(wkset.total_hits, 300)
+
+
+class FakeWatcher:
+    """ runs action before each wait, stops the engine after count waits
+    """
+    def __init__(self, engine, count, action=None):
+        self.engine = engine
+        self.count = count
+        self.action = action
+        self.waits = 0
+        self.closed = False
+
+    def wait(self):
+        self.waits += 1
+        if self.action is not None:
+            self.action(self.waits)
+        if self.waits >= self.count:
+            self.engine.stop()
+
+    def close(self):
+        self.closed = True
+
+
+class Test_Follow(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, "qos.cfg")
+        outfile = open(self.config_file, "w")
+        outfile.write(TEST_CONFIG % { 'root': self.tmpdir, 'zxtm_root': self.tmpdir })
+        outfile.close()
+        self.line = "[21/Nov/2007:15:00:22 +0100]|0.2|blog.fr|1.2.3.4|GET|/web/page%d|text/html|200|-|1|-|-|-|0|n1|n1\n"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_lines(self, time_period, count):
+        logfile = open(os.path.join(self.tmpdir, "vs1.x.%s.log" % (time_period)), "a")
+        logfile.write(''.join([ self.line % (i % 10) for i in range(count) ]))
+        logfile.close()
+
+    def get_total_hits(self, engine, time_period):
+        fname = os.path.join(self.tmpdir, "data", qostool.sync.generate_workset_file_name(time_period, 'blog', 'we'))
+        if not os.path.exists(fname) and len(engine.workset_manager.get_deltas(fname)) == 0:
+            return 0
+        return engine.workset_manager.load(fname).total_hits
+
+    def test_follow(self):
+        engine = qostool.sync.SyncEngine(self.config_file)
+        engine.config.follow_flush_interval = 0
+        time_period = engine.current_time_period
+        self.write_lines(time_period, 100)
+        saved = []
+        def action(waits):
+            # flushed on every iteration with a 0 interval
+            saved.append(self.get_total_hits(engine, time_period))
+            self.write_lines(time_period, 10)
+        watcher = FakeWatcher(engine, 3, action)
+        engine.follow(watcher)
+        self.assertEquals(saved, [100, 110, 120])
+        self.assert_(watcher.closed)
+        # the last flush saves what was read, the lines written during the
+        # last wait are left for the next run
+        self.assertEquals(self.get_total_hits(engine, time_period), 120)
+        self.assertEquals(engine.state.current_logfiles.values()[0].size, 120 * len(self.line % 0))
+
+    def test_parallel(self):
+        engine = qostool.sync.SyncEngine(self.config_file)
+        engine.config.sync_jobs = 2
+        engine.config.follow_flush_interval = 0
+        time_period = engine.current_time_period
+        self.write_lines(time_period, 100)
+        pools = []
+        def action(waits):
+            pools.append(engine.pool)
+            if waits == 2:
+                self.write_lines(time_period, 10)
+        engine.follow(FakeWatcher(engine, 3, action))
+        # one pool for the run, and no task when no logfile grew
+        self.assertEquals(len(set(pools)), 1)
+        self.assertNotEquals(pools[0], None)
+        self.assertEquals(engine.pool, None)
+        self.assertEquals([ report["counts"].get("logfiles_read", 0) for report in engine.state.stats_history ], [1, 0, 1, 0])
+        self.assertEquals(self.get_total_hits(engine, time_period), 110)
+
+    def test_stop_on_signal(self):
+        engine = qostool.sync.SyncEngine(self.config_file)
+        self.write_lines(engine.current_time_period, 20)
+        handler = signal.getsignal(signal.SIGTERM)
+        watcher = FakeWatcher(engine, 1000, lambda waits: os.kill(os.getpid(), signal.SIGTERM))
+        engine.follow(watcher)
+        self.assertEquals(watcher.waits, 1)
+        self.assertEquals(signal.getsignal(signal.SIGTERM), handler)
+        self.assertEquals(self.get_total_hits(engine, engine.current_time_period), 20)
+
+    def test_rollover(self):
+        # the engine creation and the first iteration are in the old hour
+        periods = ["20071121.15", "20071121.15", "20071121.16"]
+        def next_period():
+            time_period = periods[0]
+            if len(periods) > 1:
+                del periods[0]
+            return time_period
+        saved_get_actual_time_period = qostool.zxtm.get_actual_time_period
+        qostool.zxtm.get_actual_time_period = next_period
+        try:
+            engine = qostool.sync.SyncEngine(self.config_file)
+            engine.config.follow_flush_interval = 3600
+            self.write_lines("20071121.15", 50)
+            saved = []
+            watcher = FakeWatcher(engine, 2, lambda waits: saved.append(self.get_total_hits(engine, "20071121.15")))
+            engine.follow(watcher)
+        finally:
+            qostool.zxtm.get_actual_time_period = saved_get_actual_time_period
+        # nothing saved before the hour is over, then the rollover flushes it
+        self.assertEquals(saved, [0, 50])
+        self.assertEquals(engine.current_time_period, "20071121.16")
+        self.assertEquals(engine.state.current_logfiles, {})
+        self.assertEquals(engine.state.pending_deltas, {})
+
+
+class Test_PollingWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_wait(self):
+        watcher = qostool.sync.PollingWatcher(self.tmpdir, 0.3)
+        watcher.step = 0.01
+        started = time.time()
+        watcher.wait()
+        self.assert_(time.time() - started >= 0.3)
+
+        # a new file, then a file growing, end the wait early
+        watcher.interval = 60
+        for data in ("a", "bc"):
+            outfile = open(os.path.join(self.tmpdir, "vs1.x.20071121.15.log"), "a")
+            outfile.write(data)
+            outfile.close()
+            started = time.time()
+            watcher.wait()
+            self.assert_(time.time() - started < 5)
+
+
+class Test_Routing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = create_test_config(self.tmpdir, self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_routing_plan(self):
+        hosts = ['blogsperso.orange.fr', 'aolchat.fr', 'www.mynrj.com', 'blog.chat.fr']
+        urls = ['/web/img/a.gif', '/we', '/website', '/media/image?p=1', '/im/x', '/imx', '/', '', '/web/ping?x', '/other']
+        for vserver in ['vs1', 'vs2', 'vs3']:
+            services = [ svc for svc in self.config.services.values() if vserver in svc.zxtm_vservers ]
+            services.sort(key=lambda svc: svc.svc_id)
+            plan = qostool.sync.RoutingPlan(services)
+            for repeat in range(2):
+                for host in hosts:
+                    expected_svc = None
+                    for svc in services:
+                        if svc.zxtm_host_re.search(host):
+                            expected_svc = svc
+                            break
+                    route = plan.route_host(host)
+                    if expected_svc is None:
+                        self.assertEquals(route, None)
+                        continue
+                    self.assertEquals(route.svc_id, expected_svc.svc_id)
+                    for url in urls:
+                        m = expected_svc.apps_re.search(url)
+                        expected_app = "other"
+                        if m is not None:
+                            expected_app = m.group(1)
+                        self.assertEquals(route.find_app(url), expected_app)
+                        self.assertEquals(bool(route.is_ignored(url)), expected_svc.ignore_re.search(url) is not None)
+
+    def test_shape_spec(self):
+        self.assertEquals(self.config.services['blog'].shape_spec, None)
+        self.assertEquals(self.config.services['chat'].shape_spec, (qostool.workset.QOS_SHAPE_HDR, 0.001, 60, 0.02))
+
+
 if __name__ == '__main__':
     logging.baseConfig()
     unittest.main()